@@ -0,0 +1,191 @@
+"""
+Adaptive concurrency of the irods calls. A fixed --jobs is either too low at night or overloads the shared iCAT server
+during the day, and then the calls fail. With the limiter --jobs is only the maximum: the number of calls which are
+run at the same time starts at 1, grows while the latency of the iCAT calls (imkdir, imeta) stays flat and is cut in
+half when it climbs or a call fails with a transient error (AIMD, like TCP). Transient failures (lost connection,
+timeout, busy catalog) are tried again after a random (jittered) back-off, so the samples do not all come back at the
+same moment
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# errors of the icommands and python-irodsclient which go away if the call is tried again later
+TRANSIENT = ('SYS_SOCK_', 'SYS_HEADER_READ_LEN_ERR', 'SYS_AGENT_INIT_ERR', 'SYS_TOO_MANY_', 'CAT_CONNECT_ERR',
+             'CAT_SQL_ERR', 'USER_SOCK_CONNECT_ERR', 'USER_SOCK_CONNECT_TIMEDOUT', 'NetworkException',
+             'Connection reset', 'Connection refused', 'Broken pipe', 'timed out')
+# the kinds of operation whose latency is the latency of the iCAT server. A transfer takes as long as the file is big
+LATENCY_OPS = ('mkdir', 'imeta', 'sync')
+
+
+class ConcurrencyLimiter:
+    """
+    This class will limit the number of irods calls which run at the same time and adapt the limit to the latency and
+    the errors of the calls. It can be used from many threads at the same time
+    """
+
+    def __init__(self, maximum, minimum=1, initial=1, tolerance=2.0, decrease=0.5, retries=3, backoff=1.0,
+                 max_backoff=60.0):
+        """
+        Args:
+            maximum: the highest limit. e.g. --jobs
+            minimum: the lowest limit
+            initial: the limit at the start
+            tolerance: the limit is cut when the smoothed latency is more than tolerance times the baseline (the lowest
+            smoothed latency seen)
+            decrease: factor the limit is multiplied with when it is cut
+            retries: number of times a call with a transient error is tried again
+            backoff: seconds of the first back-off. It doubles with every retry
+            max_backoff: the longest back-off in seconds
+        """
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.active = 0
+        self.condition = threading.Condition()
+        self.smoothed = {}
+        self.baseline = {}
+        # the limit doubles every round until the first cut (slow start), then it grows by one every round
+        self.slow_start = True
+        self.cut_at = 0.0
+        self.stats = {'calls': 0, 'transient': 0, 'cuts': 0, 'lowest': self.limit, 'highest': self.limit}
+
+    @contextmanager
+    def slot(self):
+        """
+        waits until less calls than the limit are running and holds a place for the call
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def retrying(self, op, attempt, log=None):
+        """
+        runs a call in a slot and tries it again after a jittered back-off as long as it fails with a transient error
+        Args:
+            op: kind of operation. mkdir, transfer, imeta or sync
+            attempt: callable without arguments which runs the call once and returns (exit code, transient). transient
+            is True if a failure is worth trying again
+            log: opened log file of the sample where the retries are written. None to not write them
+
+        Returns: (exit code of the last try, number of retries)
+
+        """
+        retries = 0
+        while True:
+            with self.slot():
+                start = time.perf_counter()
+                exit_code, transient = attempt()
+                seconds = time.perf_counter() - start
+            self.observing(op=op, seconds=seconds, transient=exit_code != 0 and transient)
+            if exit_code == 0 or not transient or retries >= self.retries:
+                return exit_code, retries
+            retries += 1
+            seconds = self.backing_off(retries)
+            if log is not None:
+                log.write(f'transient error, try {retries + 1} of {self.retries + 1} in {seconds:.1f} s\n')
+                log.flush()
+            time.sleep(seconds)
+
+    def backing_off(self, retry):
+        """
+        Args:
+            retry: number of the retry, starting at 1
+
+        Returns: seconds to wait before the retry. A random time up to the exponential back-off (full jitter)
+
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (retry - 1)))
+
+    def observing(self, op, seconds, transient=False):
+        """
+        adapts the limit to a finished call. A transient error or a latency above tolerance times the baseline cuts
+        it, every other call lets it grow
+        Args:
+            op: kind of operation. Only the latency of LATENCY_OPS is looked at
+            seconds: duration of the call
+            transient: True if the call failed with a transient error
+        """
+        with self.condition:
+            self.stats['calls'] += 1
+            self.stats['transient'] += 1 if transient else 0
+            if transient:
+                self.cutting()
+            elif op in LATENCY_OPS:
+                smoothed = self.smoothed.get(op, seconds) * 0.8 + seconds * 0.2
+                self.smoothed[op] = smoothed
+                # the baseline follows a server which is slower for good (another day), but only slowly
+                baseline = self.baseline.get(op, smoothed)
+                self.baseline[op] = smoothed if smoothed < baseline else baseline + (smoothed - baseline) * 0.01
+                if smoothed > self.baseline[op] * self.tolerance:
+                    self.cutting()
+                else:
+                    self.growing()
+            else:
+                self.growing()
+            self.stats['lowest'] = min(self.stats['lowest'], self.limit)
+            self.stats['highest'] = max(self.stats['highest'], self.limit)
+            self.condition.notify_all()
+
+    def growing(self):
+        self.limit = min(self.maximum, self.limit + (1 if self.slow_start else 1 / self.limit))
+
+    def cutting(self):
+        # the calls which were already running when the limit was cut do not cut it again
+        now = time.monotonic()
+        if now - self.cut_at < max(self.smoothed.values(), default=0.0):
+            return
+        self.cut_at = now
+        self.slow_start = False
+        self.limit = max(self.minimum, self.limit * self.decrease)
+        self.stats['cuts'] += 1
+
+    def report(self):
+        """
+        prints how the limit changed during the run
+
+        Returns: dict of the number of calls, transient errors and cuts and the lowest, highest and last limit
+
+        """
+        stats = dict(self.stats, last=int(self.limit))
+        print(f"adaptive: {stats['calls']} calls, {stats['transient']} transient errors, concurrency between "
+              f"{int(stats['lowest'])} and {int(stats['highest'])} (last {stats['last']}), cut {stats['cuts']} times")
+        return stats
+
+    @classmethod
+    def transient(cls, text):
+        """
+        Args:
+            text: output of an icommand or the text of an error
+
+        Returns: True if it has one of the TRANSIENT errors
+
+        """
+        return any(error in text for error in TRANSIENT)
+
+    @classmethod
+    def transient_error(cls, error):
+        """
+        Args:
+            error: exception of python-irodsclient or of a subprocess
+
+        Returns: True if it is worth trying again. Lost connections and timeouts, or one of the TRANSIENT errors in
+        the name of the exception (or its parents) or its text
+
+        """
+        if isinstance(error, (ConnectionError, TimeoutError)):
+            return True
+        names = " ".join(kind.__name__ for kind in type(error).__mro__)
+        return cls.transient(f"{names} {error} {getattr(error, 'stderr', '') or ''}")
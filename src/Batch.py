@@ -0,0 +1,241 @@
+"""
+Uploading many Metadata sheets in one run. After a big sequencing week a dozen runs used to be started, every one of
+them scanning the same run folder and fighting for the same link. Here all the sheets (given on the command line or in
+a manifest) are planned in one process, so the run folder is scanned once (Scan.FolderIndex) and the plans are merged
+into one. A sample name or upload folder which is in more than one sheet is an error. The samples are ordered so that
+every project (project name column) gets the same share of the link, then they are run by one executor with one pool of
+workers and irods sessions
+<sheet>[<tab><ifolder>[<tab><folder>]] on every line of the manifest, # for comments
+"""
+import os
+import sys
+
+import MetaSheet
+import Scan
+import Validate
+
+
+class SheetBatch:
+    """
+    This class will plan the uploads of many Metadata sheets as one plan
+    """
+
+    @classmethod
+    def main(cls, uploader, entries, remotes=None, validation_report='validation_report.tsv', **options):
+        """
+        The main wrapper to plan all the sheets. All the sheets are validated before the first one is planned, so
+        the problems of every sheet are in its report. It exits if a sheet has errors or a sample is in more than one
+        sheet
+        Args:
+            uploader: iRodsClass.UploadFastq or iRodsClass.UploadCram
+            entries: list of (sheet, ifolder, folder). output of reading_entries
+            remotes: dict of ifolder and its Remote.RemoteState (pre-flight). None for no pre-flight
+            validation_report: the validation report. With more than one sheet every sheet has its own,
+            <sheet name>_<validation_report>
+            **options: the other arguments of uploader.main (upload, meta, sync, batch_meta, verify, jobs, ...)
+
+        Returns: dict of sample name and its operations (or its metadata with sync=True) of all the sheets, in the
+        order they should be run
+
+        """
+        cls.checking_duplicates(entries=entries)
+        if options.get('collection_meta') == 'project':
+            ifolders = [ifolder.rstrip('/') for sheet, ifolder, folder in entries]
+            repeated = sorted({ifolder for ifolder in ifolders if ifolders.count(ifolder) > 1})
+            if repeated:
+                print("With --collection-meta project the irods folder is the collection of the project, so every "
+                      "sheet needs its own. These irods folders are used by more than one sheet")
+                print("\n".join(repeated))
+                sys.exit(1)
+        cls.validating(uploader=uploader, entries=entries, validation_report=validation_report,
+                       upload=options.get('upload', False), jobs=options.get('jobs', 1), scan=options.get('scan'))
+        commands = {}
+        projects = {}
+        owners = {}
+        problems = []
+        for sheet, ifolder, folder in entries:
+            plan = uploader.main(metadata=sheet, ifolder=ifolder, folder=folder, validate=False,
+                                 remote=(remotes or {}).get(ifolder), **options)
+            for name in plan:
+                if name in owners:
+                    problems.append(f'{name} is uploaded by {owners[name]} and {sheet}')
+                    continue
+                owners[name] = sheet
+                commands[name] = plan[name]
+            projects.update(cls.projecting(uploader=uploader, sheet=sheet, folder=folder))
+        if problems:
+            print("These upload folders are in more than one sheet. Please remove them from all but one sheet")
+            for problem in problems:
+                print(problem)
+            sys.exit(1)
+        if len(entries) > 1:
+            print(f'batch: {len(commands)} samples of {len(set(projects.values()))} projects in {len(entries)} sheets')
+        sizes = None if options.get('sync') else {name: cls.sizing(commands[name]) for name in commands}
+        return cls.scheduling(commands=commands, projects=projects, sizes=sizes)
+
+    @classmethod
+    def validating(cls, uploader, entries, validation_report='validation_report.tsv', upload=False, jobs=1, scan=None):
+        """
+        validates every sheet and writes its report (check Validate.py). It exits once after all the sheets if any of
+        them has errors
+        Args:
+            uploader: iRodsClass.UploadFastq or iRodsClass.UploadCram
+            entries: list of (sheet, ifolder, folder)
+            validation_report: the validation report. With more than one sheet every sheet has its own,
+            <sheet name>_<validation_report>
+            upload: If upload=True only the upload is checked, not the metadata
+            jobs: number of rows which are validated at the same time
+            scan: saved index of the local folder. check Scan.py
+        """
+        if scan:
+            Scan.FolderIndex.loading(scan)
+        failed = []
+        for sheet, ifolder, folder in entries:
+            report = validation_report
+            if len(entries) > 1 and validation_report:
+                report = os.path.join(os.path.dirname(validation_report), f'{cls.naming(sheet)}_'
+                                                                          f'{os.path.basename(validation_report)}')
+            metadata = MetaSheet.MetadataSheet.loading(sheet)
+            problems = Validate.SheetValidator.validating(sheet=metadata, uploader=uploader, ifolder=ifolder,
+                                                          folder=folder, upload=upload, jobs=jobs)
+            if len(entries) > 1:
+                print(f'batch: {sheet}')
+            if Validate.SheetValidator.reporting(problems=problems, rows=metadata.samples, report=report):
+                failed.append(sheet)
+        if failed:
+            print("Please update these sheets (or their run folders) and run it again")
+            print("\n".join(failed))
+            sys.exit(1)
+
+    @classmethod
+    def reading_entries(cls, sheets=(), manifest=None, ifolder=None, folder=None):
+        """
+        the sheets of the command line and of the manifest with their irods folder and local folder
+        Args:
+            sheets: list of Metadata sheets. They are uploaded in ifolder and looked up in folder
+            manifest: file with <sheet>[<tab><ifolder>[<tab><folder>]] on every line. ifolder and folder are the
+            default. A relative sheet or folder is relative to the manifest. None for no manifest
+            ifolder: The abs path of irods folder (--ifolder)
+            folder: The path of the local run folder (--folder)
+
+        Returns: list of (sheet, ifolder, folder)
+
+        """
+        entries = [(sheet, ifolder, folder) for sheet in sheets]
+        if manifest:
+            base = os.path.dirname(os.path.abspath(manifest))
+            with open(manifest) as f:
+                for line in f:
+                    if not line.strip() or line.lstrip().startswith('#'):
+                        continue
+                    words = [word.strip() for word in line.rstrip("\n").split("\t")] + ['', '']
+                    entry_folder = os.path.join(base, words[2]) if words[2] else folder
+                    entries.append((os.path.join(base, words[0]), words[1] or ifolder, entry_folder))
+        for sheet, entry_ifolder, entry_folder in entries:
+            if not os.path.isfile(sheet):
+                print(f"The file {sheet} does not exist!")
+                sys.exit(1)
+            if not entry_ifolder:
+                print(f"{sheet} has no irods folder. Please use --ifolder or give it in the manifest")
+                sys.exit(1)
+        if not entries:
+            print("Please give at least one Metadata sheet or a manifest")
+            sys.exit(1)
+        return entries
+
+    @classmethod
+    def checking_duplicates(cls, entries):
+        """
+        exits if a sample name is in more than one sheet. Repeated sample names inside a sheet are found by the
+        validation of the sheet (Validate.py)
+        Args:
+            entries: list of (sheet, ifolder, folder)
+        """
+        sheets = {}
+        for sheet, ifolder, folder in entries:
+            for sample in set(MetaSheet.MetadataSheet.loading(sheet).column('sample name')):
+                if sample is not None:
+                    sheets.setdefault(str(sample), []).append(sheet)
+        repeated = {sample: sheets[sample] for sample in sheets if len(sheets[sample]) > 1}
+        if repeated:
+            print("These sample names are in more than one sheet. Please remove them from all but one sheet")
+            for sample in sorted(repeated):
+                print(f'{sample}\t{", ".join(repeated[sample])}')
+            sys.exit(1)
+
+    @classmethod
+    def projecting(cls, uploader, sheet, folder=None):
+        """
+        Args:
+            uploader: iRodsClass.UploadFastq or iRodsClass.UploadCram
+            sheet: path of the Metadata sheet
+            folder: The path of the local run folder
+
+        Returns: dict of upload folder name and its project. The project name column, or the name of the sheet if
+        it is empty
+
+        """
+        projects = {}
+        for row in uploader.sheet_rows(MetaSheet.MetadataSheet.loading(sheet)):
+            values = {attribute: value for attribute, value, unit in row}
+            project = str(values.get('project name') or cls.naming(sheet))
+            for lane_row, target_folder in uploader.resolving_folders(row=row, folder=folder):
+                projects[os.path.basename(target_folder.rstrip('/'))] = project
+        return projects
+
+    @classmethod
+    def sizing(cls, commands):
+        """
+        Args:
+            commands: the newline joined commands of a sample or its list of typed operations (Plan.py)
+
+        Returns: number of bytes the sample uploads
+
+        """
+        import Executor
+        size = 0
+        for text, argvs in Executor.ShellExecutor.steps(commands):
+            transfer = Executor.ShellExecutor.transfer_arguments(argvs[0])
+            if transfer:
+                size += sum(os.path.getsize(local) for local in transfer[0] if os.path.exists(local))
+        return size
+
+    @classmethod
+    def scheduling(cls, commands, projects, sizes=None):
+        """
+        orders the samples so that every project gets the same share of the link. The next sample is always taken
+        from the project with the fewest bytes ordered so far (the fewest samples if nothing is uploaded). The
+        executors start the samples in this order
+        Args:
+            commands: dict of sample name and its commands
+            projects: dict of sample name and its project
+            sizes: dict of sample name and its bytes. None to count every sample the same
+
+        Returns: the same dict in the new order
+
+        """
+        queues = {}
+        for name in commands:
+            queues.setdefault(projects.get(name, ''), []).append(name)
+        scheduled = {project: 0 for project in queues}
+        ordered = {}
+        while queues:
+            project = min(queues, key=lambda key: (scheduled[key], key))
+            name = queues[project].pop(0)
+            ordered[name] = commands[name]
+            # the bytes count when there are uploads, one per sample otherwise
+            scheduled[project] += max(1, sizes[name]) if sizes else 1
+            if not queues[project]:
+                del queues[project]
+        return ordered
+
+    @classmethod
+    def naming(cls, sheet):
+        """
+        Args:
+            sheet: path of the Metadata sheet
+
+        Returns: the file name of the sheet without its extension
+
+        """
+        return os.path.splitext(os.path.basename(sheet))[0]
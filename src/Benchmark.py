@@ -0,0 +1,401 @@
+"""
+Benchmark of the upload pipeline without an irods server. It generates a synthetic Metadata sheet and run folder (N
+samples, M lanes, files of any size as sparse files, so nothing is really written), plans the upload with
+UploadFastq.main or UploadCram.main and runs the commands against fake icommands (or a fake python-irodsclient
+session) with a configurable latency per call. Every result is added as one json line to benchmarks.jsonl with the git
+commit, so runs of different commits can be compared
+
+python src/Benchmark.py --samples 500 --lanes 2 --latency 0.01 --jobs 8
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+import Executor
+import MetaSheet
+import Pipeline
+import Scan
+import Verify
+import iRodsClass
+
+CORE_ATTRIBUTES = ['library id', 'sample barcode', 'project name', 'sample name', 'tax id', 'flowcell id',
+                   'flowcell lane', 'fasta']
+
+
+class FakeMeta:
+    """
+    metadata of a fake data object. Same interface as the metadata of python-irodsclient which is used by Executor
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.avus = []
+
+    def items(self):
+        time.sleep(self.latency)
+        return list(self.avus)
+
+    def add(self, name, value, units=''):
+        time.sleep(self.latency)
+        self.avus.append(FakeAVU(name, value, units))
+
+    def remove(self, avu):
+        time.sleep(self.latency)
+        self.avus.remove(avu)
+
+
+class FakeAVU:
+    def __init__(self, name, value, units=''):
+        self.name = name
+        self.value = value
+        self.units = units
+
+
+class FakeDataObject:
+    def __init__(self, path, size, latency, checksum=None):
+        self.path = path
+        self.size = size
+        self.checksum = checksum
+        self.metadata = FakeMeta(latency)
+
+    def chksum(self):
+        return self.checksum
+
+
+class FakeSession:
+    """
+    An in memory stand in of irods.session.iRODSSession with <latency> seconds for every call. All the sessions of a
+    run share the same store
+    """
+    store = {}
+    latency = 0.0
+
+    def __init__(self):
+        self.collections = self
+        self.data_objects = self
+
+    def create(self, path, recurse=True):
+        time.sleep(self.latency)
+
+    def exists(self, path):
+        time.sleep(self.latency)
+        return path in self.store
+
+    def get(self, path):
+        time.sleep(self.latency)
+        if path not in self.store:
+            raise KeyError(path)
+        return self.store[path]
+
+    def put(self, local, path, **options):
+        time.sleep(self.latency)
+        # a server side checksum (regChksum) is the md5sum of the .md5 file, the sparse files are not hashed
+        checksum = Verify.Md5Verify.reading_md5file(local) if 'regChksum' in options else None
+        self.store[path] = FakeDataObject(path=path, size=os.path.getsize(local), latency=self.latency,
+                                          checksum=checksum)
+
+    def cleanup(self):
+        pass
+
+
+class UploadBenchmark:
+    """
+    This class will generate the synthetic data, run the pipeline on it and write the results
+    """
+
+    @classmethod
+    def main(cls, kind='fastq', samples=100, lanes=1, size=1024, columns=40, latency=0.0, jobs=4, backend='shell',
+             batch_meta=False, execute=True, workdir=None, output='benchmarks.jsonl', pipeline=False):
+        """
+        The main wrapper of a benchmark run. The synthetic data is written in workdir (a temporary folder by default,
+        which is removed at the end)
+        Args:
+            kind: fastq or cram
+            samples: number of rows in the Metadata sheet
+            lanes: number of lane folders of every library (fastq) or lanes in flowcell lane (cram)
+            size: size of every fastq.gz or cram file in MB. They are sparse files
+            columns: number of metadata columns of the sheet
+            latency: seconds every fake icommand or fake session call takes
+            jobs: number of samples which are run at the same time
+            backend: shell (fake icommands) or native (fake session)
+            batch_meta: If batch_meta=True all the metadata of a data object is sent in one imeta call
+            execute: If execute=False the commands are only planned and not run
+            workdir: folder where the synthetic data is written. default is a temporary folder
+            output: json lines file where the result is added. None to not write it
+            pipeline: If pipeline=True the commands are run with Pipeline.PipelineExecutor
+
+        Returns: dict of the result
+
+        """
+        keep = workdir is not None
+        workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix='catch-all-bench-'))
+        cwd = os.getcwd()
+        try:
+            metadata, folder = cls.generating(workdir=workdir, kind=kind, samples=samples, lanes=lanes, size=size,
+                                              columns=columns)
+            os.chdir(workdir)
+            result = {'commit': cls.commit(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                      'python': platform.python_version(), 'kind': kind, 'samples': samples, 'lanes': lanes,
+                      'size_mb': size, 'columns': columns, 'latency': latency, 'jobs': jobs, 'backend': backend,
+                      'batch_meta': batch_meta, 'pipeline': pipeline}
+            result.update(cls.measuring(kind=kind, metadata=metadata, folder=folder, latency=latency, jobs=jobs,
+                                        backend=backend, batch_meta=batch_meta, execute=execute, pipeline=pipeline))
+            result.update(cls.importing())
+        finally:
+            os.chdir(cwd)
+            if not keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+        if output:
+            with open(output, 'a') as f:
+                f.write(json.dumps(result) + "\n")
+        return result
+
+    @classmethod
+    def measuring(cls, kind, metadata, folder, latency=0.0, jobs=4, backend='shell', batch_meta=False, execute=True,
+                  pipeline=False):
+        """
+        measures every step of the pipeline on the generated data
+        Args:
+            kind: fastq or cram
+            metadata: path of the generated sheet
+            folder: path of the generated run folder
+            latency: seconds every fake icommand or fake session call takes
+            jobs: number of samples which are run at the same time
+            backend: shell or native
+            batch_meta: If batch_meta=True all the metadata of a data object is sent in one imeta call
+            execute: If execute=False the commands are only planned and not run
+            pipeline: If pipeline=True the commands are run with Pipeline.PipelineExecutor
+
+        Returns: dict of the measured seconds and counts
+
+        """
+        upload = iRodsClass.UploadCram if kind == 'cram' else iRodsClass.UploadFastq
+        result = {}
+        Scan.FolderIndex.indexes.clear()
+        start = time.perf_counter()
+        Scan.FolderIndex.scanning(folder)
+        result['scan_s'] = time.perf_counter() - start
+        if os.path.exists(metadata + '.cache.json'):
+            os.remove(metadata + '.cache.json')
+        start = time.perf_counter()
+        MetaSheet.MetadataSheet.loading(metadata)
+        result['sheet_cold_s'] = time.perf_counter() - start
+        start = time.perf_counter()
+        MetaSheet.MetadataSheet.loading(metadata)
+        result['sheet_warm_s'] = time.perf_counter() - start
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            commands = upload.main(metadata=metadata, ifolder='/benchZone/home/bench', folder=folder,
+                                   batch_meta=batch_meta, operations=True)
+        result['plan_s'] = time.perf_counter() - start
+        parsed = {name: Executor.ShellExecutor.steps(commands[name]) for name in commands}
+        result['sample_jobs'] = len(commands)
+        result['calls'] = sum(len(parsed[name]) for name in parsed)
+        result['operations'] = sum(len(argvs) for name in parsed for text, argvs in parsed[name])
+        if execute:
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                exit_codes = cls.executing(commands=commands, latency=latency, jobs=jobs, backend=backend,
+                                           pipeline=pipeline)
+            result['execute_s'] = time.perf_counter() - start
+            result['failed'] = sum(1 for name in exit_codes if exit_codes[name] != 0)
+        return result
+
+    @classmethod
+    def importing(cls, runs=5):
+        """
+        measures the start of the command line in new python processes: importing Submit_iRods and its --help. The
+        best of runs is taken, as the first run also reads the files from the disk
+        Args:
+            runs: number of times every command is started
+
+        Returns: dict of the measured seconds and the heavy modules which are loaded by importing Submit_iRods
+
+        """
+        src = os.path.dirname(os.path.abspath(__file__))
+        heavy = ['pandas', 'openpyxl', 'asyncio', 'multiprocessing', 'irods', 'sqlite3']
+        code = ('import sys, Submit_iRods; '
+                f'print(",".join(module for module in {heavy!r} if module in sys.modules))')
+        result = {}
+        for key, command in (('import_s', [sys.executable, '-c', code]),
+                             ('help_s', [sys.executable, os.path.join(src, 'Submit_iRods.py'), '--help'])):
+            seconds = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                process = subprocess.run(command, capture_output=True, text=True, cwd=src)
+                seconds.append(time.perf_counter() - start)
+            result[key] = min(seconds)
+            if key == 'import_s':
+                result['import_modules'] = process.stdout.strip()
+        return result
+
+    @classmethod
+    def executing(cls, commands, latency=0.0, jobs=4, backend='shell', pipeline=False):
+        """
+        runs the commands against the fake icommands (shell) or the fake session (native)
+        Args:
+            commands: dict of sample name and its typed operations (Plan.py)
+            latency: seconds every fake icommand or fake session call takes
+            jobs: number of samples which are run at the same time
+            backend: shell or native
+            pipeline: If pipeline=True the commands are run with Pipeline.PipelineExecutor
+
+        Returns: dict of sample name and exit code
+
+        """
+        FakeSession.store = {}
+        FakeSession.latency = latency
+        if pipeline:
+            path = os.environ['PATH']
+            if backend == 'shell':
+                os.environ['PATH'] = cls.fake_icommands(folder=os.path.abspath('bin'), latency=latency) + os.pathsep + \
+                                     path
+            try:
+                return Pipeline.PipelineExecutor.main(commands=commands, prefix='bench', verify_jobs=jobs,
+                                                      transfer_jobs=jobs, meta_jobs=jobs, backend=backend,
+                                                      session_factory=FakeSession)
+            finally:
+                os.environ['PATH'] = path
+        if backend == 'native':
+            return Executor.NativeExecutor.main(commands=commands, prefix='bench', jobs=jobs,
+                                                session_factory=FakeSession)
+        path = os.environ['PATH']
+        os.environ['PATH'] = cls.fake_icommands(folder=os.path.abspath('bin'), latency=latency) + os.pathsep + path
+        try:
+            return Executor.ShellExecutor.main(commands=commands, prefix='bench', jobs=jobs)
+        finally:
+            os.environ['PATH'] = path
+
+    @classmethod
+    def fake_icommands(cls, folder, latency=0.0):
+        """
+        writes fake icommands, which only take <latency> seconds. imeta without arguments reads its sub-commands from
+        stdin (pipe mode)
+        Args:
+            folder: folder where the fake icommands are written
+            latency: seconds every call takes
+
+        Returns: the folder
+
+        """
+        os.makedirs(folder, exist_ok=True)
+        for icommand in ('imkdir', 'irsync', 'iput', 'imeta', 'ichksum', 'iquest', 'ils'):
+            script = os.path.join(folder, icommand)
+            with open(script, 'w') as f:
+                f.write("#!/bin/sh\n")
+                if icommand == 'imeta':
+                    f.write('[ $# -eq 0 ] && cat > /dev/null\n')
+                if latency:
+                    f.write(f'sleep {latency}\n')
+                f.write("exit 0\n")
+            os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        return folder
+
+    @classmethod
+    def generating(cls, workdir, kind='fastq', samples=100, lanes=1, size=1024, columns=40):
+        """
+        writes the synthetic Metadata sheet (as tsv, check MetaSheet.py) and run folder
+        Args:
+            workdir: folder where everything is written
+            kind: fastq or cram
+            samples: number of rows in the Metadata sheet
+            lanes: number of lane folders of every library (fastq) or lanes in flowcell lane (cram)
+            size: size of every fastq.gz or cram file in MB
+            columns: number of metadata columns of the sheet
+
+        Returns: path of the sheet and path of the run folder
+
+        """
+        folder = os.path.join(workdir, 'run')
+        os.makedirs(folder, exist_ok=True)
+        attributes = CORE_ATTRIBUTES + [f'attribute {index}' for index in range(len(CORE_ATTRIBUTES), columns)]
+        rows = [['String'] * len(attributes), attributes]
+        for sample in range(1, samples + 1):
+            barcode = f'2302{sample:08d}-DL{sample}'
+            library = f'BENCH-DL{sample:03d}'
+            values = {'library id': library, 'sample barcode': barcode, 'project name': 'benchmark',
+                      'sample name': f'S{sample}', 'tax id': '9606', 'flowcell id': 'HBENCHXX',
+                      'flowcell lane': ",".join(f'L{lane:03d}' for lane in range(1, lanes + 1)),
+                      'fasta': 'GRCh38.fa'}
+            rows.append([values.get(attribute, f'value {sample}') for attribute in attributes])
+            if kind == 'cram':
+                target = os.path.join(folder, f'S{sample}')
+                cls.writing_files(target, [f'S{sample}.cram'], size=size)
+                cls.writing_files(target, [f'S{sample}.cram.crai'], size=1)
+            else:
+                for lane in range(1, lanes + 1):
+                    name = f'{barcode.replace("-DL", "-DS")}_{library}_S{sample}_L{lane:03d}'
+                    cls.writing_files(os.path.join(folder, name),
+                                      [f'{name}_R1_001.fastq.gz', f'{name}_R2_001.fastq.gz'], size=size)
+        metadata = os.path.join(workdir, f'{kind}.tsv')
+        with open(metadata, 'w') as f:
+            f.write("\n".join("\t".join(row) for row in rows) + "\n")
+        return metadata, folder
+
+    @classmethod
+    def writing_files(cls, folder, files, size=1024):
+        """
+        writes sparse files of <size> MB and their .md5 files
+        Args:
+            folder: folder where the files are written
+            files: list of file names
+            size: size of every file in MB
+        """
+        os.makedirs(folder, exist_ok=True)
+        for file in files:
+            with open(os.path.join(folder, file), 'wb') as f:
+                f.truncate(size * 1024 * 1024)
+            with open(os.path.join(folder, file + '.md5'), 'w') as f:
+                f.write(f'{"0" * 32}  {file}\n')
+
+    @classmethod
+    def commit(cls):
+        """
+        Returns: the short git commit of this code. empty string if it is not a git repository
+
+        """
+        try:
+            return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        except OSError:
+            return ''
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the upload pipeline against fake icommands")
+    parser.add_argument('--kind', help='fastq or cram. default is fastq', choices=['fastq', 'cram'], default='fastq')
+    parser.add_argument('--samples', help='Number of samples. default is 100', type=int, default=100)
+    parser.add_argument('--lanes', help='Number of lanes of every library. default is 1', type=int, default=1)
+    parser.add_argument('--size', help='Size of every fastq.gz or cram in MB (sparse files). default is 1024',
+                        type=int, default=1024)
+    parser.add_argument('--columns', help='Number of metadata columns. default is 40', type=int, default=40)
+    parser.add_argument('--latency', help='Seconds every fake irods call takes. default is 0', type=float,
+                        default=0.0)
+    parser.add_argument('--jobs', help='Number of samples which are run at the same time. default is 4', type=int,
+                        default=4)
+    parser.add_argument('--backend', help='shell (fake icommands) or native (fake session). default is shell',
+                        choices=['shell', 'native'], default='shell')
+    parser.add_argument('--batch-meta', help='Send all the metadata of a file in one imeta call', action="store_true")
+    parser.add_argument('--pipeline', help='Run the commands with the pipeline (check Pipeline.py)',
+                        action="store_true")
+    parser.add_argument('--no-execute', help='Only plan the commands, do not run them', action="store_true")
+    parser.add_argument('--workdir', help='Folder for the synthetic data. It is kept. default is a temporary folder '
+                                          'which is removed at the end')
+    parser.add_argument('--output', help='Json lines file where the result is added. default is benchmarks.jsonl',
+                        default='benchmarks.jsonl')
+    args = parser.parse_args()
+    result = UploadBenchmark.main(kind=args.kind, samples=args.samples, lanes=args.lanes, size=args.size,
+                                  columns=args.columns, latency=args.latency, jobs=args.jobs, backend=args.backend,
+                                  batch_meta=args.batch_meta, execute=not args.no_execute, workdir=args.workdir,
+                                  output=args.output, pipeline=args.pipeline)
+    for key in result:
+        print(f'{key}\t{round(result[key], 4) if isinstance(result[key], float) else result[key]}')
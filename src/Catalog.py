@@ -0,0 +1,369 @@
+"""
+Local mirror of the irods catalog. Every data object this tool uploads and every AVU it adds or removes is written in
+a small sqlite database as soon as its sample is finished, with indexes on the object path and on attribute and value.
+Questions like "which samples of project X with tax_id 9606 are already in irods and with which metadata" are answered
+from it without a single query to the iCAT server. reconcile replaces the mirror of a folder with one bulk query of
+the server (the same queries as the pre-flight, check Remote.py), for what was changed by others or by failed samples.
+The AVUs of the collections (--collection-meta) are kept as well, and the queries look at the effective metadata of a
+data object: its own metadata merged over the metadata of its collections (check Inherit.py)
+"""
+import os
+import sqlite3
+import time
+
+import Executor
+import Inherit
+import Remote
+import Verify
+
+
+class CatalogMirror:
+    """
+    This class will keep the mirror of the data objects and their AVUs up to date and answer the queries
+    """
+
+    def __init__(self, path='irods_catalog.sqlite'):
+        """
+        Args:
+            path: path of the sqlite mirror. It is created if it does not exist
+        """
+        self.path = path
+        self.planned = {}
+        self.connection = sqlite3.connect(path)
+        # imeta rmw and iquest like are case sensitive
+        self.connection.execute("PRAGMA case_sensitive_like = ON")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS objects (path TEXT PRIMARY KEY, collection TEXT, size INTEGER, checksum TEXT,
+                                                updated_at TEXT, source TEXT);
+            CREATE TABLE IF NOT EXISTS avus (path TEXT, attribute TEXT, value TEXT, units TEXT, updated_at TEXT);
+            CREATE TABLE IF NOT EXISTS collection_avus (path TEXT, attribute TEXT, value TEXT, units TEXT,
+                                                        updated_at TEXT);
+            CREATE INDEX IF NOT EXISTS objects_collection ON objects (collection);
+            CREATE INDEX IF NOT EXISTS avus_path ON avus (path);
+            CREATE INDEX IF NOT EXISTS avus_attribute_value ON avus (attribute, value);
+            CREATE INDEX IF NOT EXISTS collection_avus_path ON collection_avus (path);
+        """)
+
+    def planning(self, commands):
+        """
+        keeps the uploads and imeta calls of every sample until the sample is finished (record)
+        Args:
+            commands: dict of sample name and the newline joined commands or its list of typed operations (Plan.py)
+        """
+        for name in commands:
+            self.planned[name] = [argv for text, argvs in Executor.ShellExecutor.steps(commands[name])
+                                  for argv in argvs]
+
+    def record(self, name, exit_code):
+        """
+        writes the uploads and metadata of a finished sample in the mirror, in the order they were run. A failed
+        sample is not written, as it is not known which of its commands went through (check reconcile). It is meant
+        to be given as on_done to Executor, like Journal.UploadJournal.record
+        Args:
+            name: sample name
+            exit_code: exit code of the sample
+        """
+        argvs = self.planned.pop(name, [])
+        if exit_code != 0 or not argvs:
+            return
+        now = time.strftime('%Y-%m-%dT%H:%M:%S')
+        with self.connection:
+            for argv in argvs:
+                transfer = Executor.ShellExecutor.transfer_arguments(argv)
+                if transfer:
+                    locals_, icollection, threads = transfer
+                    icollection = icollection.rstrip('/')
+                    self.connection.executemany(
+                        "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, 'upload')",
+                        [(f'{icollection}/{os.path.basename(local)}', icollection, os.path.getsize(local),
+                          Verify.Md5Verify.reading_md5file(local), now) for local in locals_])
+                elif argv[0] == 'imeta' and argv[1:3] in (['add', '-d'], ['add', '-C']):
+                    self.connection.execute(f"INSERT INTO {self.avus_table(argv[2])} VALUES (?, ?, ?, ?, ?)",
+                                            (argv[3], argv[4], argv[5], argv[6] if len(argv) > 6 else '', now))
+                elif argv[0] == 'imeta' and argv[1:3] in (['rmw', '-d'], ['rmw', '-C']):
+                    # the wildcards of imeta rmw (% and _) are the same as the ones of LIKE
+                    attribute, value, units = (argv[4:7] + ['%', '%'])[:3]
+                    self.connection.execute(f"DELETE FROM {self.avus_table(argv[2])} WHERE path = ? AND attribute "
+                                            f"LIKE ? AND value LIKE ? AND units LIKE ?",
+                                            (argv[3], attribute, value, units))
+
+    @classmethod
+    def avus_table(cls, flag):
+        """
+        Args:
+            flag: -d for a data object, -C for a collection (imeta)
+
+        Returns: the table of the AVUs
+
+        """
+        return 'collection_avus' if flag == '-C' else 'avus'
+
+    def syncing(self, avus, exit_codes):
+        """
+        writes the metadata of the synced samples (Sync.py) in the mirror. After a sync a data object has exactly the
+        desired AVUs of the attributes in the sheet
+        Args:
+            avus: dict of sample name and the dict of irods data object path and its list of (attribute, value, unit)
+            exit_codes: dict of sample name and exit code. Only the samples which went fine are written
+        """
+        now = time.strftime('%Y-%m-%dT%H:%M:%S')
+        with self.connection:
+            for name in avus:
+                if exit_codes.get(name) != 0:
+                    continue
+                for ipath in avus[name]:
+                    desired = {(str(attribute), str(value), str(unit or '')) for attribute, value, unit in
+                               avus[name][ipath]}
+                    self.connection.executemany("DELETE FROM avus WHERE path = ? AND attribute = ?",
+                                                [(ipath, attribute) for attribute in {avu[0] for avu in desired}])
+                    self.connection.executemany("INSERT INTO avus VALUES (?, ?, ?, ?, ?)",
+                                                [(ipath,) + avu + (now,) for avu in sorted(desired)])
+
+    def reconciling(self, ifolder, backend='shell', irods_env=None, session_factory=None):
+        """
+        replaces the mirror of everything under ifolder (and the metadata of ifolder itself) with what is in irods now.
+        It is four bulk queries, whatever the number of data objects
+        Args:
+            ifolder: The abs path of irods folder
+            backend: shell (iquest) or native (python-irodsclient)
+            irods_env: path of the irods environment file for the native backend
+            session_factory: callable returning a new session for the native backend. by default an iRODSSession
+
+        Returns: (number of data objects, number of AVUs) in the mirror of ifolder
+
+        """
+        ifolder = ifolder.rstrip('/')
+        Remote.RemoteState.checking(ifolder)
+        if backend == 'native':
+            session_factory = session_factory or Executor.NativeExecutor.irods_session_factory(irods_env=irods_env)
+            session = session_factory()
+            try:
+                objects, avus, collection_avus = self.native_query(session=session, ifolder=ifolder)
+            finally:
+                session.cleanup()
+        else:
+            objects, avus, collection_avus = self.shell_query(ifolder=ifolder)
+        now = time.strftime('%Y-%m-%dT%H:%M:%S')
+        like = self.under(ifolder)
+        with self.connection:
+            self.connection.execute("DELETE FROM objects WHERE path LIKE ? ESCAPE '\\'", (like,))
+            self.connection.execute("DELETE FROM avus WHERE path LIKE ? ESCAPE '\\'", (like,))
+            self.connection.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, 'reconcile')",
+                                        [(ipath, os.path.dirname(ipath), size, checksum, now)
+                                         for ipath, (size, checksum) in objects.items()])
+            self.connection.executemany("INSERT INTO avus VALUES (?, ?, ?, ?, ?)",
+                                        [avu + (now,) for avu in sorted(avus)])
+            self.connection.execute("DELETE FROM collection_avus WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                                    (ifolder, like))
+            self.connection.executemany("INSERT INTO collection_avus VALUES (?, ?, ?, ?, ?)",
+                                        [avu + (now,) for avu in sorted(collection_avus)])
+        print(f'reconcile: {len(objects)} data objects, {len(avus)} AVUs and {len(collection_avus)} AVUs of '
+              f'collections of {ifolder} are in {self.path}')
+        return len(objects), len(avus)
+
+    @classmethod
+    def shell_query(cls, ifolder):
+        """
+        queries the data objects and AVUs under ifolder with iquest
+        Args:
+            ifolder: The abs path of irods folder
+
+        Returns: dict of irods data object path and (size, checksum), set of (path, attribute, value, unit) of the
+        data objects and set of (path, attribute, value, unit) of the collections
+
+        """
+        like = f"COLL_NAME like '{ifolder}/%'"
+        objects = {}
+        for coll, name, size, checksum in Remote.RemoteState.iquest(
+                ['%s', '%s', '%s', '%s'], f'SELECT COLL_NAME, DATA_NAME, DATA_SIZE, DATA_CHECKSUM WHERE {like}'):
+            if Remote.RemoteState.inside(coll, ifolder):
+                objects.setdefault(f'{coll}/{name}', (int(size), checksum))
+        avus = {(f'{coll}/{name}', attribute, value, units) for coll, name, attribute, value, units in
+                Remote.RemoteState.iquest(['%s', '%s', '%s', '%s', '%s'],
+                                          f'SELECT COLL_NAME, DATA_NAME, META_DATA_ATTR_NAME, META_DATA_ATTR_VALUE, '
+                                          f'META_DATA_ATTR_UNITS WHERE {like}')
+                if Remote.RemoteState.inside(coll, ifolder)}
+        collection_avus = {tuple(row) for where in (like, f"COLL_NAME = '{ifolder}'") for row in
+                           Remote.RemoteState.iquest(['%s', '%s', '%s', '%s'],
+                                                     f'SELECT COLL_NAME, META_COLL_ATTR_NAME, META_COLL_ATTR_VALUE, '
+                                                     f'META_COLL_ATTR_UNITS WHERE {where}')
+                           if Remote.RemoteState.inside(row[0], ifolder)}
+        return objects, avus, collection_avus
+
+    @classmethod
+    def native_query(cls, session, ifolder):
+        """
+        queries the data objects and AVUs under ifolder with GenQuery of python-irodsclient
+        Args:
+            session: irods session
+            ifolder: The abs path of irods folder
+
+        Returns: dict of irods data object path and (size, checksum), set of (path, attribute, value, unit) of the
+        data objects and set of (path, attribute, value, unit) of the collections
+
+        """
+        from irods.column import Criterion, Like
+        from irods.models import Collection, CollectionMeta, DataObject, DataObjectMeta
+        like = Like(Collection.name, f'{ifolder}/%')
+        objects = {}
+        for row in session.query(Collection.name, DataObject.name, DataObject.size, DataObject.checksum).filter(like):
+            if Remote.RemoteState.inside(row[Collection.name], ifolder):
+                objects.setdefault(f'{row[Collection.name]}/{row[DataObject.name]}',
+                                   (int(row[DataObject.size]), row[DataObject.checksum]))
+        avus = {(f'{row[Collection.name]}/{row[DataObject.name]}', row[DataObjectMeta.name], row[DataObjectMeta.value],
+                 row[DataObjectMeta.units] or '')
+                for row in session.query(Collection.name, DataObject.name, DataObjectMeta.name, DataObjectMeta.value,
+                                         DataObjectMeta.units).filter(like)
+                if Remote.RemoteState.inside(row[Collection.name], ifolder)}
+        collection_avus = {(row[Collection.name], row[CollectionMeta.name], row[CollectionMeta.value],
+                            row[CollectionMeta.units] or '')
+                           for where in (like, Criterion('=', Collection.name, ifolder))
+                           for row in session.query(Collection.name, CollectionMeta.name, CollectionMeta.value,
+                                                    CollectionMeta.units).filter(where)
+                           if Remote.RemoteState.inside(row[Collection.name], ifolder)}
+        return objects, avus, collection_avus
+
+    def querying(self, conditions=(), ifolder=None):
+        """
+        finds the data objects which have all the given AVUs in their effective metadata (their own metadata merged
+        over the metadata of their collections). It only uses the local mirror
+        Args:
+            conditions: list of (attribute, value). The value can have the wildcard %
+            ifolder: only data objects under this irods folder. None for all
+
+        Returns: dict of irods data object path and its list of (attribute, value, unit), sorted by path
+
+        """
+        # a data object which only got metadata from this tool (--meta) is only in avus
+        query = "SELECT path FROM (SELECT path FROM objects UNION SELECT path FROM avus) AS found"
+        parameters = []
+        clauses = []
+        for attribute, value in conditions:
+            match = 'LIKE' if '%' in value else '='
+            clauses.append(f"(path IN (SELECT path FROM avus WHERE attribute = ? AND value {match} ?) OR EXISTS "
+                           f"(SELECT 1 FROM collection_avus AS c WHERE c.attribute = ? AND c.value {match} ? AND "
+                           f"substr(found.path, 1, length(c.path) + 1) = c.path || '/'))")
+            parameters.extend((attribute, value, attribute, value))
+        if ifolder:
+            clauses.append("path LIKE ? ESCAPE '\\'")
+            parameters.append(self.under(ifolder))
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        paths = [row[0] for row in self.connection.execute(query + " ORDER BY path", parameters)]
+        found = {}
+        for path, avus in self.effective(paths).items():
+            # an attribute of the data object replaces the one of its collection, even if the collection matched
+            if all(any(avu[0] == attribute and self.matching(avu[1], value) for avu in avus)
+                   for attribute, value in conditions):
+                found[path] = sorted(avu[:3] for avu in avus)
+        return found
+
+    def effective(self, paths):
+        """
+        Args:
+            paths: list of irods data object paths
+
+        Returns: dict of irods data object path and its effective metadata, list of (attribute, value, unit, path the
+        AVU comes from). check Inherit.InheritedMetadata.merging
+
+        """
+        own = {path: [] for path in paths}
+        for path, attribute, value, units in self.selecting(table='avus', paths=paths):
+            own[path].append((attribute, value, units))
+        collections = {}
+        ancestors = {path: Inherit.InheritedMetadata.ancestors(path) for path in paths}
+        for path, attribute, value, units in self.selecting(
+                table='collection_avus', paths=list({ancestor for path in paths for ancestor in ancestors[path]})):
+            collections.setdefault(path, []).append((attribute, value, units))
+        return {path: Inherit.InheritedMetadata.merging([(ancestor, collections.get(ancestor, []))
+                                                         for ancestor in ancestors[path]] + [(path, own[path])])
+                for path in paths}
+
+    def selecting(self, table, paths):
+        """
+        Args:
+            table: avus or collection_avus
+            paths: list of paths
+
+        Returns: list of (path, attribute, value, units) of all the paths
+
+        """
+        rows = []
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            rows.extend(self.connection.execute(
+                f"SELECT path, attribute, value, units FROM {table} WHERE path IN ({', '.join('?' * len(chunk))}) "
+                f"ORDER BY path, attribute, value", chunk))
+        return rows
+
+    def resolving(self, ipath):
+        """
+        Args:
+            ipath: irods data object path
+
+        Returns: the effective metadata of the data object in the mirror. list of (attribute, value, unit, path the
+        AVU comes from)
+
+        """
+        return self.effective([ipath])[ipath]
+
+    @classmethod
+    def matching(cls, value, pattern):
+        """
+        Args:
+            value: metadata value
+            pattern: value of a condition. With % it is a LIKE pattern (% and _ are the wildcards)
+
+        Returns: True if the value matches the pattern, the same as the query
+
+        """
+        if '%' not in pattern:
+            return value == pattern
+        return Executor.NativeExecutor.like(pattern).fullmatch(value) is not None
+
+    def remote_state(self, ifolder):
+        """
+        the state of ifolder as the pre-flight would query it from the server (check Remote.py), but from the mirror
+        Args:
+            ifolder: The abs path of irods folder
+
+        Returns: Remote.RemoteState
+
+        """
+        ifolder = ifolder.rstrip('/')
+        objects = {path: (size, checksum or '') for path, (size, checksum) in self.querying_objects(ifolder).items()}
+        avus = {path: len(found) for path, found in self.querying(ifolder=ifolder).items()}
+        collections = {os.path.dirname(path) for path in objects}
+        metadata = [tuple(row) for row in self.connection.execute(
+            "SELECT attribute, value, units FROM collection_avus WHERE path = ?", (ifolder,))]
+        print(f'preflight: {len(objects)} data objects and {len(collections)} collections are already in {ifolder} '
+              f'according to {self.path}. {sum(1 for path in objects if not avus.get(path))} of them have no metadata')
+        return Remote.RemoteState(ifolder=ifolder, objects=objects, avus=avus, collections=collections,
+                                  metadata=metadata)
+
+    def querying_objects(self, ifolder):
+        """
+        Args:
+            ifolder: The abs path of irods folder
+
+        Returns: dict of irods data object path and (size, checksum) of all the data objects under ifolder
+
+        """
+        like = self.under(ifolder)
+        return {path: (size, checksum) for path, size, checksum in
+                self.connection.execute("SELECT path, size, checksum FROM objects WHERE path LIKE ? ESCAPE '\\'",
+                                        (like,))}
+
+    @classmethod
+    def under(cls, ifolder):
+        """
+        Args:
+            ifolder: The abs path of irods folder
+
+        Returns: the LIKE pattern (ESCAPE '\\') of every path under ifolder
+
+        """
+        return ifolder.rstrip('/').replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '/%'
+
+    def close(self):
+        self.connection.close()
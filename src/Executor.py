@@ -0,0 +1,722 @@
+"""
+Running the commands generated by iRodsClass. Every sample (key of the commands dict) is its own job and the jobs are
+run on a bounded pool of workers, so a big flowcell is not uploaded one sample after the other anymore. There are two
+backends to run them
+shell: ShellExecutor, runs the shell script of every sample with the icommands
+native: NativeExecutor, runs the same commands in process with python-irodsclient over a pool of reusable sessions
+"""
+import hashlib
+import os
+import queue
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import partial
+
+import Adaptive
+import Misc
+import Transfer
+import Verify
+
+
+class ShellExecutor:
+    """
+    This class will write the commands of every sample in shfiles/<prefix>_<name>.sh and run them with sh
+    """
+
+    @classmethod
+    def main(cls, commands, prefix, jobs=1, on_done=None, timing=None, limiter=None, precheck=True):
+        """
+        The main wrapper to run all the samples. It will write the shell script for every sample and run them in
+        parallel with at most <jobs> samples at the same time. The shell script is run like sh -e so the first failing
+        command stops that sample (no metadata is added to a file which was not uploaded) but the other samples keep
+        going. stdout and stderr of every sample is written to shfiles/<prefix>_<name>.log
+        Args:
+            commands: dict of sample (upload folder) name and the newline joined commands or its list of typed
+            operations (Plan.py). Output of UploadFastq.main or UploadCram.main
+            prefix: prefix of the shell script. upload, meta or all
+            jobs: number of samples which are run at the same time. default is 1, one sample after the other
+            on_done: callable(name, exit_code) which is called as soon as a sample is finished. e.g. Journal
+            timing: Timing.TimingLog where the timing of every command is written. None for no timing
+            limiter: Adaptive.ConcurrencyLimiter which limits the commands running at the same time (at most <jobs>)
+            and tries the transient failures again. None to run every sample as fast as it goes
+            precheck: If precheck=False the checksum in irods is not asked before a trusted transfer (iput -k), e.g.
+            when the preflight already removed the files which are in irods
+
+        Returns: dict of sample name and the exit code of its shell script. 0 means everything went fine
+
+        """
+        shfiles = cls.writing_shfiles(commands=commands, prefix=prefix)
+        jobs_to_run = {name: partial(cls.run_sample, shfile=shfiles[name], name=name, timing=timing,
+                                     steps=cls.steps(commands[name]), limiter=limiter, precheck=precheck)
+                       for name in shfiles}
+        return cls.running_pool(jobs_to_run=jobs_to_run, prefix=prefix, jobs=jobs, on_done=on_done)
+
+    @classmethod
+    def writing_shfiles(cls, commands, prefix):
+        """
+        writes the commands of every sample in shfiles/<prefix>_<name>.sh. Every backend writes them, so there is
+        always a record of what was run for a sample
+        Args:
+            commands: dict of sample name and the newline joined commands or its list of typed operations
+            prefix: prefix of the shell script. upload, meta or all
+
+        Returns: dict of sample name and its shell script path
+
+        """
+        Misc.creatingfolders("shfiles")
+        return {name: Misc.writing_bylines4mlist([cls.script(commands[name])], output=f'shfiles/{prefix}_{name}.sh')
+                for name in commands}
+
+    @classmethod
+    def script(cls, commands):
+        """
+        Args:
+            commands: the newline joined commands of a sample or its list of typed operations (Plan.py)
+
+        Returns: the newline joined commands of the shell script
+
+        """
+        if isinstance(commands, str):
+            return commands
+        return Misc.joinginglistbyspecificstring([operation.command() for operation in commands], "\n")
+
+    @classmethod
+    def steps(cls, commands):
+        """
+        the commands of a sample with their arguments. The typed operations already know their arguments, only the
+        newline joined commands are split
+        Args:
+            commands: the newline joined commands of a sample or its list of typed operations (Plan.py)
+
+        Returns: list of (text, arguments), same as splitting_commands
+
+        """
+        if isinstance(commands, str):
+            return cls.splitting_commands(commands)
+        return [(operation.command(), operation.argvs()) for operation in commands]
+
+    @classmethod
+    def running_pool(cls, jobs_to_run, prefix, jobs=1, on_done=None):
+        """
+        runs the jobs of all the samples on a bounded pool of workers and collects their exit codes
+        Args:
+            jobs_to_run: dict of sample name and a callable without arguments returning the exit code of the sample
+            prefix: prefix of the shell script. upload, meta or all
+            jobs: number of samples which are run at the same time
+            on_done: callable(name, exit_code) which is called in the main thread as soon as a sample is finished
+
+        Returns: dict of sample name and exit code
+
+        """
+        exit_codes = {}
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            futures = {pool.submit(jobs_to_run[name]): name for name in jobs_to_run}
+            for future in as_completed(futures):
+                name = futures[future]
+                exit_codes[name] = future.result()
+                if exit_codes[name] == 0:
+                    print(f'{prefix} {name} is done')
+                else:
+                    print(f'{prefix} {name} failed with exit code {exit_codes[name]}. '
+                          f'check shfiles/{prefix}_{name}.log')
+                if on_done is not None:
+                    on_done(name, exit_codes[name])
+        return exit_codes
+
+    @classmethod
+    def run_sample(cls, shfile, name=None, timing=None, steps=None, limiter=None, precheck=True):
+        """
+        runs the commands of a single shell script one after the other with sh and stops at the first failing command,
+        same as sh -e. Every transfer is timed and its throughput is written in the log
+        Args:
+            shfile: path of the shell script (shfiles/<prefix>_<name>.sh)
+            name: sample name for the timing
+            timing: Timing.TimingLog where the timing of every command is written. None for no timing
+            steps: the commands of the sample with their arguments (output of steps). None to read the shell script
+            limiter: Adaptive.ConcurrencyLimiter. None for no limit and no retries
+            precheck: If precheck=False a trusted transfer is run without asking irods for its checksum first
+
+        Returns: the exit code of the first failing command, 0 if all of them went fine
+
+        """
+        logfile = shfile[:-len('.sh')] + '.log'
+        if steps is None:
+            with open(shfile) as f:
+                steps = cls.splitting_commands(f.read())
+        with open(logfile, 'w') as log:
+            for text, argvs in steps:
+                exit_code = cls.running_command(text=text, argvs=argvs, log=log, name=name, timing=timing,
+                                                limiter=limiter, precheck=precheck)
+                if exit_code != 0:
+                    return exit_code
+        return 0
+
+    @classmethod
+    def running_command(cls, text, argvs, log, name=None, timing=None, limiter=None, precheck=True):
+        """
+        runs a single command of a shell script with sh. A transfer with a checksum of the server (iput -k) is skipped
+        if irods already has the checksum of the .md5 file (only with precheck) and is checked against it after the
+        transfer
+        Args:
+            text: the command as it is in the shell script
+            argvs: list of argument lists of the command. output of splitting_commands
+            log: opened log file of the sample
+            name: sample name for the timing
+            timing: Timing.TimingLog where the timing of the command is written. None for no timing
+            limiter: Adaptive.ConcurrencyLimiter. The command waits for a slot and is tried again if its output has a
+            transient error. None to run it once, right away
+            precheck: If precheck=False the data object is known to be missing (or different) in irods, its checksum
+            is only asked after the transfer
+
+        Returns: the exit code of the command
+
+        """
+        start = time.perf_counter()
+        trusted = cls.trusted_transfer(argvs[0])
+        if trusted and precheck and cls.remote_checksum(trusted[1]) == trusted[2]:
+            log.write(f'skipped: {trusted[1]} has the checksum of {trusted[0]}.md5\n')
+            log.flush()
+            return 0
+
+        def attempt():
+            process = subprocess.run(['sh', '-c', text], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                                     errors='replace')
+            log.write(process.stdout)
+            if trusted and process.returncode == 0 and not cls.checksum_matches(
+                    checksum=cls.remote_checksum(trusted[1]), expected=trusted[2]):
+                log.write(f'checksum of {trusted[1]} in irods does not match {trusted[0]}.md5\n')
+                return 1, False
+            return process.returncode, Adaptive.ConcurrencyLimiter.transient(process.stdout)
+
+        if limiter is None:
+            exit_code, retries = attempt()[0], 0
+        else:
+            exit_code, retries = limiter.retrying(op=cls.operation_kind(argvs), attempt=attempt, log=log)
+        if timing is not None:
+            timing.recording_command(sample=name, argvs=argvs, seconds=time.perf_counter() - start,
+                                     status=exit_code, retries=retries)
+        transfer = cls.transfer_arguments(argvs[0])
+        if transfer and exit_code == 0:
+            log.write(Transfer.TransferPlanner.throughput(files=transfer[0],
+                                                          seconds=time.perf_counter() - start) + "\n")
+        log.flush()
+        return exit_code
+
+    @classmethod
+    def operation_kind(cls, argvs):
+        """
+        Args:
+            argvs: list of argument lists of a command. output of splitting_commands
+
+        Returns: the kind of operation. transfer, mkdir, imeta or the name of the command
+
+        """
+        if cls.transfer_arguments(argvs[0]):
+            return 'transfer'
+        if argvs[0][0] == 'imkdir':
+            return 'mkdir'
+        return argvs[0][0]
+
+    @classmethod
+    def transfer_arguments(cls, argv):
+        """
+        the files and the target of a transfer command. irsync -K [-N <threads>] <local> i:<collection>,
+        iput -f -k [-N <threads>] <local> <collection> or iput -b -f -K <local> ... <collection>
+        Args:
+            argv: arguments of a single command
+
+        Returns: (list of local files, irods collection, number of threads (0 is the default of the server)). None if
+        it is not a transfer command
+
+        """
+        if argv[0] not in ('irsync', 'iput'):
+            return None
+        threads = 0
+        positional = []
+        index = 1
+        while index < len(argv):
+            if argv[index] == '-N':
+                threads = int(argv[index + 1])
+                index += 1
+            elif not argv[index].startswith('-'):
+                positional.append(argv[index])
+            index += 1
+        icollection = positional[-1][len('i:'):] if positional[-1].startswith('i:') else positional[-1]
+        return positional[:-1], icollection, threads
+
+    @classmethod
+    def trusted_transfer(cls, argv):
+        """
+        a transfer with a checksum calculated by the server (iput -k) of a single file with a .md5 file beside it
+        Args:
+            argv: arguments of a single command
+
+        Returns: (local file, irods data object, md5sum from the .md5 file). None if it is not such a transfer
+
+        """
+        if argv[0] != 'iput' or '-k' not in argv:
+            return None
+        locals_, icollection, threads = cls.transfer_arguments(argv)
+        if len(locals_) != 1:
+            return None
+        expected = Verify.Md5Verify.reading_md5file(locals_[0])
+        if not expected:
+            return None
+        return locals_[0], f'{icollection}/{os.path.basename(locals_[0])}', expected
+
+    @classmethod
+    def remote_checksum(cls, ipath):
+        """
+        the checksum of a data object in irods with ichksum. It is calculated by the server if it is not there yet
+        Args:
+            ipath: irods data object path
+
+        Returns: the checksum (md5 hex or sha2:<base64>). empty string if the data object does not exist
+
+        """
+        process = subprocess.run(['ichksum', ipath], capture_output=True, text=True)
+        if process.returncode != 0:
+            return ''
+        for line in process.stdout.split("\n"):
+            words = line.split()
+            if len(words) >= 2 and words[0] == os.path.basename(ipath):
+                return words[-1]
+        return ''
+
+    @classmethod
+    def checksum_matches(cls, checksum, expected):
+        """
+        Args:
+            checksum: checksum of the server
+            expected: md5sum from the .md5 file
+
+        Returns: True if they are same. A sha2 checksum of the server can not be compared with a md5sum, it is
+        trusted as it is (the server calculated it from the uploaded data)
+
+        """
+        if checksum.startswith('sha2:'):
+            return True
+        return checksum.lower() == expected.lower()
+
+    @classmethod
+    def splitting_commands(cls, commands):
+        """
+        splits the newline joined commands of a sample into single commands and their arguments. A batched imeta
+        call (imeta <<'EOF' ... EOF) is kept together as one command
+        Args:
+            commands: the newline joined commands of a sample
+
+        Returns: list of (text, arguments) for every command. text is the command as it is in the shell script and
+        arguments is a list of argument lists. it has more than one argument list only for a batched imeta call
+
+        """
+        lines = commands.split("\n")
+        parsed = []
+        index = 0
+        while index < len(lines):
+            line = lines[index].strip()
+            if line == "imeta <<'EOF'":
+                start = index
+                batch = []
+                index += 1
+                while lines[index].strip() != 'EOF':
+                    if lines[index].strip() not in ('', 'quit'):
+                        batch.append(['imeta'] + shlex.split(lines[index]))
+                    index += 1
+                parsed.append((Misc.joinginglistbyspecificstring(lines[start:index + 1], "\n"), batch))
+            elif line:
+                parsed.append((lines[index], [shlex.split(line)]))
+            index += 1
+        return parsed
+
+    @classmethod
+    def report(cls, exit_codes, prefix):
+        """
+        It will print a small summary of the run, with all the samples which failed so that they can be rerun
+        Args:
+            exit_codes: dict of sample name and exit code. output of main
+            prefix: prefix of the shell script. upload, meta or all
+
+        Returns: the list of failed samples. empty list if everything went fine
+
+        """
+        failed = sorted(name for name in exit_codes if exit_codes[name] != 0)
+        print(f'{prefix}: {len(exit_codes) - len(failed)} of {len(exit_codes)} samples are done')
+        if failed:
+            print("These samples failed. Please check their log files and rerun them")
+            for name in failed:
+                print(f'{name}\t exit code {exit_codes[name]}\t shfiles/{prefix}_{name}.log')
+        return failed
+
+
+class SessionPool:
+    """
+    A pool of reusable irods sessions. A session is only opened when no free one is available, so at most one session
+    per worker is opened for the whole run instead of one connection per icommand
+    """
+
+    def __init__(self, session_factory, size=1):
+        """
+        Args:
+            session_factory: callable without arguments which returns a new session. Anything with the same interface
+            as irods.session.iRODSSession (collections, data_objects and cleanup) can be used. e.g. a fake for testing
+            size: maximum number of sessions kept open
+        """
+        self.session_factory = session_factory
+        self.size = max(1, size)
+        self.free = queue.LifoQueue()
+        self.sessions = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def session(self):
+        """
+        gives a free session or opens a new one. the session is given back to the pool after use
+        """
+        try:
+            session = self.free.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                if len(self.sessions) < self.size:
+                    session = self.session_factory()
+                    self.sessions.append(session)
+                else:
+                    session = None
+            if session is None:
+                session = self.free.get()
+        try:
+            yield session
+        finally:
+            self.free.put(session)
+
+    def close(self):
+        """
+        closes all the opened sessions
+        """
+        for session in self.sessions:
+            session.cleanup()
+        self.sessions = []
+
+
+class NativeExecutor(ShellExecutor):
+    """
+    This class will run the commands of every sample in process with python-irodsclient instead of starting an
+    icommand for every line. The shell scripts are still written in shfiles/ as a record. Only the commands generated
+    by iRodsClass are known: imkdir -p, irsync -K, iput -k, iput -b, imeta add, imeta rmw and the batched imeta pipe
+    mode
+    """
+
+    @classmethod
+    def main(cls, commands, prefix, jobs=1, session_factory=None, irods_env=None, on_done=None, timing=None,
+             limiter=None):
+        """
+        The main wrapper to run all the samples with the native backend. Same as ShellExecutor.main but the commands
+        are run over a pool of <jobs> irods sessions.
+        Args:
+            commands: dict of sample (upload folder) name and the newline joined commands or its list of typed
+            operations (Plan.py). Output of UploadFastq.main or UploadCram.main
+            prefix: prefix of the shell script. upload, meta or all
+            jobs: number of samples which are run at the same time. same number of sessions are opened
+            session_factory: callable returning a new session. by default an iRODSSession from irods_env
+            irods_env: path of the irods environment file. default is ~/.irods/irods_environment.json. You need to
+            login first using iinit
+            on_done: callable(name, exit_code) which is called as soon as a sample is finished. e.g. Journal
+            timing: Timing.TimingLog where the timing of every command is written. None for no timing
+            limiter: Adaptive.ConcurrencyLimiter which limits the commands running at the same time (at most <jobs>)
+            and tries the transient failures again. None to run every sample as fast as it goes
+
+        Returns: dict of sample name and the exit code. 0 means everything went fine
+
+        """
+        session_factory = session_factory or cls.irods_session_factory(irods_env=irods_env)
+        shfiles = cls.writing_shfiles(commands=commands, prefix=prefix)
+        pool = SessionPool(session_factory=session_factory, size=jobs)
+        jobs_to_run = {name: partial(cls.run_sample, shfile=shfiles[name], pool=pool, name=name, timing=timing,
+                                     steps=cls.steps(commands[name]), limiter=limiter) for name in shfiles}
+        try:
+            return cls.running_pool(jobs_to_run=jobs_to_run, prefix=prefix, jobs=jobs, on_done=on_done)
+        finally:
+            pool.close()
+
+    @classmethod
+    def irods_session_factory(cls, irods_env=None):
+        """
+        Gives a callable which opens a new iRODSSession with the same environment and login (iinit) as the icommands
+        Args:
+            irods_env: path of the irods environment file. default is ~/.irods/irods_environment.json
+
+        Returns: callable without arguments which returns a new iRODSSession
+
+        """
+        try:
+            from irods.session import iRODSSession
+        except ImportError:
+            print("python-irodsclient is needed for the native backend. Please update the environment using "
+                  "src/requirements.yml or use --backend shell")
+            sys.exit(1)
+        irods_env = os.path.expanduser(irods_env or os.environ.get('IRODS_ENVIRONMENT_FILE',
+                                                                   '~/.irods/irods_environment.json'))
+        if not os.path.exists(irods_env):
+            print("could not find the irods environment file. Please login first using iinit:", irods_env)
+            sys.exit(1)
+        return partial(iRODSSession, irods_env_file=irods_env)
+
+    @classmethod
+    def run_sample(cls, shfile, pool, name=None, timing=None, steps=None, limiter=None):
+        """
+        runs all the commands of a single sample with one session from the pool. Like sh -e it stops at the first
+        failing command
+        Args:
+            shfile: path of the shell script (shfiles/<prefix>_<name>.sh)
+            pool: SessionPool
+            name: sample name for the timing
+            timing: Timing.TimingLog where the timing of every command is written. None for no timing
+            steps: the commands of the sample with their arguments (output of steps). None to read the shell script
+            limiter: Adaptive.ConcurrencyLimiter. None for no limit and no retries
+
+        Returns: the exit code. 0 if all the commands went fine, 1 otherwise
+
+        """
+        logfile = shfile[:-len('.sh')] + '.log'
+        if steps is None:
+            with open(shfile) as f:
+                commands = cls.parsing_commands(f.read())
+        else:
+            commands = [argvs for text, argvs in steps]
+        with open(logfile, 'w') as log, pool.session() as session:
+            for command in commands:
+                if cls.running_session_command(session=session, command=command, log=log, name=name,
+                                               timing=timing, limiter=limiter) != 0:
+                    return 1
+        return 0
+
+    @classmethod
+    def running_session_command(cls, session, command, log, name=None, timing=None, limiter=None):
+        """
+        runs a single command with the session and writes it, its throughput or its error in the log
+        Args:
+            session: irods session
+            command: list of argument lists. output of parsing_commands
+            log: opened log file of the sample
+            name: sample name for the timing
+            timing: Timing.TimingLog where the timing of the command is written. None for no timing
+            limiter: Adaptive.ConcurrencyLimiter. The command waits for a slot and is tried again if it fails with a
+            transient error. None to run it once, right away
+
+        Returns: the exit code. 0 if the command went fine, 1 otherwise
+
+        """
+        log.write(Misc.joinginglistbyspecificstring([shlex.join(argv) for argv in command], "\n") + "\n")
+        start = time.perf_counter()
+
+        def attempt():
+            try:
+                cls.run_command(session=session, command=command)
+            except Exception as error:
+                log.write(traceback.format_exc())
+                return 1, Adaptive.ConcurrencyLimiter.transient_error(error)
+            return 0, False
+
+        if limiter is None:
+            exit_code, retries = attempt()[0], 0
+        else:
+            exit_code, retries = limiter.retrying(op=cls.operation_kind(command), attempt=attempt, log=log)
+        if timing is not None:
+            timing.recording_command(sample=name, argvs=command, seconds=time.perf_counter() - start,
+                                     status=exit_code, retries=retries)
+        if exit_code != 0:
+            return 1
+        transfer = cls.transfer_arguments(command[0])
+        if transfer:
+            log.write(Transfer.TransferPlanner.throughput(files=transfer[0], seconds=time.perf_counter() - start) +
+                      "\n")
+        return 0
+
+    @classmethod
+    def parsing_commands(cls, commands):
+        """
+        splits the newline joined commands into arguments. A batched imeta call (imeta <<'EOF' ... EOF) is kept
+        together
+        Args:
+            commands: the newline joined commands of a sample
+
+        Returns: list of commands. Every command is a list of argument lists. it has more than one argument list only
+        for a batched imeta call
+
+        """
+        return [argvs for text, argvs in cls.splitting_commands(commands)]
+
+    @classmethod
+    def run_command(cls, session, command):
+        """
+        runs a single (or batched imeta) command with the session
+        Args:
+            session: irods session
+            command: list of argument lists. output of parsing_commands
+        """
+        if command[0][0] == 'imeta':
+            cls.metadata(session=session, command=command)
+        elif command[0][:2] == ['imkdir', '-p']:
+            session.collections.create(command[0][2], recurse=True)
+        elif command[0][0] == 'irsync':
+            locals_, icollection, threads = cls.transfer_arguments(command[0])
+            cls.rsync(session=session, local=locals_[0], icollection=icollection, threads=threads)
+        elif command[0][0] == 'iput' and '-k' in command[0]:
+            locals_, icollection, threads = cls.transfer_arguments(command[0])
+            cls.md5put(session=session, local=locals_[0], icollection=icollection, threads=threads)
+        elif command[0][:2] == ['iput', '-b']:
+            locals_, icollection, threads = cls.transfer_arguments(command[0])
+            for local in locals_:
+                session.data_objects.put(local, f'{icollection}/{os.path.basename(local)}',
+                                         **{'verifyChksum': '', 'forceFlag': ''})
+        else:
+            raise ValueError(f'command not known to the native backend: {shlex.join(command[0])}')
+
+    @classmethod
+    def rsync(cls, session, local, icollection, threads=0):
+        """
+        same as irsync -K [-N <threads>] <local> i:<icollection>. The file is only uploaded if it is not in irods yet or
+        the size or checksum differ. The checksum is verified by the server after the upload
+        Args:
+            session: irods session
+            local: local file path
+            icollection: irods collection in which the file is uploaded
+            threads: number of transfer threads. 0 is the default of python-irodsclient
+        """
+        ipath = f'{icollection}/{os.path.basename(local)}'
+        if session.data_objects.exists(ipath):
+            obj = session.data_objects.get(ipath)
+            if obj.size == os.path.getsize(local) and obj.checksum and \
+                    obj.checksum == cls.local_checksum(local, scheme=obj.checksum):
+                return
+        # irods.keywords.VERIFY_CHKSUM_KW and FORCE_FLAG_KW
+        options = {'verifyChksum': '', 'forceFlag': ''}
+        if threads:
+            session.data_objects.put(local, ipath, num_threads=threads, **options)
+        else:
+            session.data_objects.put(local, ipath, **options)
+
+    @classmethod
+    def md5put(cls, session, local, icollection, threads=0):
+        """
+        same as iput -f -k [-N <threads>] <local> <icollection> with the checks of ShellExecutor.trusted_transfer. The
+        file is not uploaded if the checksum in irods already matches <local>.md5. Otherwise it is uploaded, the server
+        calculates the checksum and it is compared once with <local>.md5. The file is not hashed on the client
+        Args:
+            session: irods session
+            local: local file path
+            icollection: irods collection in which the file is uploaded
+            threads: number of transfer threads. 0 is the default of python-irodsclient
+        """
+        ipath = f'{icollection}/{os.path.basename(local)}'
+        expected = Verify.Md5Verify.reading_md5file(local)
+        if expected and session.data_objects.exists(ipath):
+            checksum = session.data_objects.get(ipath).checksum
+            if checksum and checksum.lower() == expected:
+                return
+        # irods.keywords.REG_CHKSUM_KW and FORCE_FLAG_KW
+        options = {'regChksum': '', 'forceFlag': ''}
+        if threads:
+            session.data_objects.put(local, ipath, num_threads=threads, **options)
+        else:
+            session.data_objects.put(local, ipath, **options)
+        obj = session.data_objects.get(ipath)
+        checksum = obj.checksum or obj.chksum()
+        if expected and not cls.checksum_matches(checksum=checksum or '', expected=expected):
+            raise ValueError(f'checksum of {ipath} in irods ({checksum}) does not match {local}.md5 ({expected})')
+
+    @classmethod
+    def local_checksum(cls, local, scheme=''):
+        """
+        checksum of a local file in the same format as the irods server. sha2:<base64> or md5 hex
+        Args:
+            local: local file path
+            scheme: a checksum from the server, used to know which algorithm the server uses
+
+        Returns: the checksum of the local file
+
+        """
+        digest = hashlib.sha256() if scheme.startswith('sha2:') else hashlib.md5()
+        with open(local, 'rb') as f:
+            for chunk in iter(lambda: f.read(8 * 1024 * 1024), b''):
+                digest.update(chunk)
+        if scheme.startswith('sha2:'):
+            import base64
+            return 'sha2:' + base64.b64encode(digest.digest()).decode()
+        return digest.hexdigest()
+
+    @classmethod
+    def metadata(cls, session, command):
+        """
+        runs imeta add and imeta rmw for a data object (-d) or a collection (-C). The AVUs of the data object are read
+        only once for all the rmw of a command. For a batched imeta call the removes and adds are sent in one atomic
+        call if python-irodsclient supports it
+        Args:
+            session: irods session
+            command: list of imeta argument lists. All of them for the same data object or collection
+        """
+        flag = command[0][2]
+        obj = session.collections.get(command[0][3]) if flag == '-C' else session.data_objects.get(command[0][3])
+        current = None
+        removes = []
+        adds = []
+        for argv in command:
+            if argv[1:3] == ['add', flag]:
+                adds.append((argv[4], argv[5], argv[6] if len(argv) > 6 else ''))
+            elif argv[1:3] == ['rmw', flag]:
+                if current is None:
+                    current = list(obj.metadata.items())
+                pattern = [cls.like(word) for word in argv[4:7]]
+                matched = [avu for avu in current if
+                           all(match.fullmatch(str(value or '')) is not None
+                               for value, match in zip((avu.name, avu.value, avu.units), pattern))]
+                removes.extend(matched)
+                current = [avu for avu in current if all(avu is not match for match in matched)]
+            else:
+                raise ValueError(f'imeta command not known to the native backend: {shlex.join(argv)}')
+        cls.applying_metadata(obj=obj, removes=removes, adds=adds)
+
+    @classmethod
+    def like(cls, pattern):
+        """
+        Args:
+            pattern: pattern of imeta rmw. % and _ are the wildcards, the same as LIKE of the iCAT database
+
+        Returns: compiled regular expression of the pattern. Every other character (also [, ], ? and *) is literal
+
+        """
+        return re.compile(''.join('.*' if char == '%' else '.' if char == '_' else re.escape(char) for char in pattern),
+                          flags=re.DOTALL)
+
+    @classmethod
+    def applying_metadata(cls, obj, removes, adds):
+        """
+        removes and adds the AVUs of a data object (or collection) in one atomic call. If the atomic call is not
+        available (older python-irodsclient or a fake session) it will do it one after the other
+        Args:
+            obj: irods data object or collection
+            removes: list of AVUs (iRODSMeta) to be removed
+            adds: list of (attribute, value, unit) to be added
+        """
+        try:
+            from irods.meta import AVUOperation, iRODSMeta
+            atomic = hasattr(obj.metadata, 'apply_atomic_operations')
+        except ImportError:
+            atomic = False
+        if atomic:
+            operations = [AVUOperation(operation='remove', avu=avu) for avu in removes] + \
+                         [AVUOperation(operation='add', avu=iRODSMeta(*avu)) for avu in adds]
+            if operations:
+                obj.metadata.apply_atomic_operations(*operations)
+        else:
+            for avu in removes:
+                obj.metadata.remove(avu)
+            for avu in adds:
+                obj.metadata.add(*avu)
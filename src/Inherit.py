@@ -0,0 +1,214 @@
+"""
+Metadata of the collections. By default every data object gets the whole row of the Metadata sheet, so the AVUs of a
+fastq pair are stored twice and the columns of a project (project name, tax id, scientific name, ...) are on every
+file of every sample. With --collection-meta the attributes which have the same values on all the files of a sample
+are added once to the sample collection, and with --collection-meta project the attributes which are the same in the
+whole plan are added once to the irods folder (the project collection). Only the file specific attributes
+(pair_end_read, flowcell lane, ...) stay on the data objects, and the metadata of a collection with a single data
+object stays on it (nothing is saved and imeta qu -d still finds it). The samples uploaded into the irods folder
+before inherit its metadata as well, so once it has metadata only the attributes with the same values are added to it,
+the others stay on the data objects of the plan. The effective metadata of a data object is its own metadata merged
+over the metadata of its collections, an attribute of a lower level replaces the same attribute of a higher level
+"""
+import os
+import subprocess
+
+LEVELS = ('sample', 'project')
+# attributes which always stay on the data object, even when all the files of a sample have the same value
+FILE_SPECIFIC = ('pair_end_read', 'pair_end_reads', 'flowcell lane')
+
+
+class InheritedMetadata:
+    """
+    This class will move the shared metadata of the plan to the collections and resolve the effective metadata of a
+    data object
+    """
+
+    @classmethod
+    def main(cls, table, level='sample', ifolder=None, current=None):
+        """
+        moves the metadata shared by all the data objects of a sample collection to the collection, and with
+        level=project the metadata shared by all the data objects of the table to ifolder. The rmw of the data objects
+        are kept, so the metadata of files which were uploaded before is moved as well (--meta)
+        Args:
+            table: Plan.OperationTable
+            level: sample or project
+            ifolder: The abs path of irods folder. It is the project collection
+            current: list of (attribute, value, unit) which ifolder has in irods now (Remote.RemoteState.metadata).
+            None if it is not known, then all the shared metadata of the table is added to ifolder
+
+        Returns: number of add operations which are saved
+
+        """
+        objects = {}
+        for sample, op, path, attribute, value, unit in table.rows():
+            if op == 'add':
+                avus = objects.setdefault((sample, os.path.dirname(path)), {}).setdefault(path, {})
+                avus.setdefault(attribute, []).append((value, unit))
+        if not objects:
+            return 0
+        ifolder = (ifolder or '').rstrip('/')
+        project = {}
+        if level == 'project' and ifolder:
+            project = cls.sharing([avus for collection in objects.values() for avus in collection.values()])
+            if current is not None:
+                project = cls.keeping(project=project, current=current, ifolder=ifolder)
+        shared = {}
+        for key, collection in objects.items():
+            sample = cls.sharing(list(collection.values()))
+            shared[key[1]] = {attribute: values for attribute, values in sample.items() if attribute not in project}
+        rows = []
+        moved = set()
+        saved = 0
+        for sample, op, path, attribute, value, unit in table.rows():
+            collection = os.path.dirname(path)
+            if op == 'add' and (attribute in project or attribute in shared.get(collection, {})):
+                saved += 1
+                continue
+            if op in ('rmw', 'add') and collection in shared and collection not in moved:
+                # the metadata of the collections is added where the metadata of their first data object starts
+                if project and ifolder not in moved:
+                    rows.extend(cls.collection_rows(sample=sample, collection=ifolder, shared=project))
+                    moved.add(ifolder)
+                rows.extend(cls.collection_rows(sample=sample, collection=collection, shared=shared[collection]))
+                moved.add(collection)
+            rows.append((sample, op, path, attribute, value, unit))
+        table.replacing(rows)
+        added = sum(1 for op in table.op if op == 'cadd')
+        collections = len({path for op, path in zip(table.op, table.path) if op == 'cadd'})
+        print(f'collection-meta: {saved} AVUs of data objects are {added} AVUs of {collections} collections now')
+        return saved - added
+
+    @classmethod
+    def sharing(cls, objects):
+        """
+        Args:
+            objects: list of dict of attribute and its list of (value, unit) of every data object
+
+        Returns: dict of attribute and its list of (value, unit) of the attributes which are on all the data objects
+        with the same values. The FILE_SPECIFIC attributes are left out. Nothing is shared by less than 2 data objects
+
+        """
+        if len(objects) < 2:
+            return {}
+        shared = {}
+        for attribute, values in objects[0].items():
+            if attribute in FILE_SPECIFIC:
+                continue
+            if all(sorted(avus.get(attribute, []), key=str) == sorted(values, key=str) for avus in objects[1:]):
+                shared[attribute] = values
+        return shared
+
+    @classmethod
+    def keeping(cls, project, current, ifolder):
+        """
+        Args:
+            project: dict of attribute and its list of (value, unit) which are shared by the whole table
+            current: list of (attribute, value, unit) which ifolder has in irods now
+            ifolder: The abs path of irods folder
+
+        Returns: the attributes of project which can be added to ifolder. If ifolder has metadata already (samples were
+        uploaded into it before) only the attributes it has with the same values, the others stay on the data objects
+
+        """
+        existing = {}
+        for attribute, value, unit in current:
+            existing.setdefault(attribute, []).append((str(value), str(unit or '')))
+        if not existing:
+            return project
+        kept = {}
+        for attribute, values in project.items():
+            if sorted(existing.get(attribute, [])) == sorted((str(value), str(unit or '')) for value, unit in values):
+                kept[attribute] = values
+        if len(kept) < len(project):
+            print(f'collection-meta: {ifolder} does not have the same values for the samples uploaded before. These '
+                  f'attributes stay on the data objects:',
+                  ", ".join(attribute for attribute in project if attribute not in kept))
+        return kept
+
+    @classmethod
+    def collection_rows(cls, sample, collection, shared):
+        """
+        Args:
+            sample: sample (upload folder) name
+            collection: irods collection
+            shared: dict of attribute and its list of (value, unit)
+
+        Returns: list of the crmw and cadd rows of the collection (check Plan.OperationTable)
+
+        """
+        rows = [(sample, 'crmw', collection, attribute, '%', '%') for attribute in shared]
+        rows.extend((sample, 'cadd', collection, attribute, value, unit) for attribute in shared
+                    for value, unit in shared[attribute])
+        return rows
+
+    @classmethod
+    def ancestors(cls, ipath):
+        """
+        Args:
+            ipath: irods data object path
+
+        Returns: list of all the collections of the data object, from the zone down to its own collection
+
+        """
+        parts = ipath.rstrip('/').split('/')[1:-1]
+        return ['/' + '/'.join(parts[:index]) for index in range(1, len(parts) + 1)]
+
+    @classmethod
+    def merging(cls, levels):
+        """
+        the effective metadata. An attribute of a lower level replaces all the values of the same attribute of a
+        higher level
+        Args:
+            levels: list of (path, list of (attribute, value, unit)) from the highest collection down to the data object
+
+        Returns: list of (attribute, value, unit, path the AVU comes from)
+
+        """
+        merged = {}
+        for path, avus in levels:
+            own = {}
+            for attribute, value, unit in avus:
+                own.setdefault(attribute, []).append((attribute, value, unit or '', path))
+            merged.update(own)
+        return [avu for avus in merged.values() for avu in avus]
+
+    @classmethod
+    def resolving(cls, ipath, backend='shell', irods_env=None, session_factory=None):
+        """
+        reads the metadata of a data object and of all its collections from irods and merges them. A collection
+        which can not be read (e.g. the zone) has no metadata
+        Args:
+            ipath: irods data object path
+            backend: shell (imeta ls) or native (python-irodsclient)
+            irods_env: path of the irods environment file for the native backend
+            session_factory: callable returning a new session for the native backend. by default an iRODSSession
+
+        Returns: list of (attribute, value, unit, path the AVU comes from)
+
+        """
+        import Executor
+        import Sync
+        if backend != 'native':
+            levels = []
+            for path in cls.ancestors(ipath):
+                try:
+                    levels.append((path, Sync.MetadataSync.shell_current(path, flag='-C')))
+                except subprocess.CalledProcessError:
+                    levels.append((path, []))
+            return cls.merging(levels + [(ipath, Sync.MetadataSync.shell_current(ipath))])
+        session_factory = session_factory or Executor.NativeExecutor.irods_session_factory(irods_env=irods_env)
+        session = session_factory()
+        try:
+            levels = []
+            for path in cls.ancestors(ipath):
+                try:
+                    levels.append((path, [(avu.name, avu.value, avu.units or '')
+                                          for avu in session.collections.get(path).metadata.items()]))
+                except Exception:
+                    levels.append((path, []))
+            obj = session.data_objects.get(ipath)
+            levels.append((ipath, [(avu.name, avu.value, avu.units or '') for avu in obj.metadata.items()]))
+        finally:
+            session.cleanup()
+        return cls.merging(levels)
@@ -0,0 +1,157 @@
+"""
+Local journal of the finished uploads and metadata, so a run which died halfway can be restarted without doing
+everything again. It is a small sqlite database. An upload is keyed by the local path, size, modification time and the
+md5sum from the .md5 file and the irods target. The metadata of a data object is keyed by a digest of its imeta
+commands, so it is applied again as soon as anything changes in the excel sheet
+"""
+import hashlib
+import os
+import sqlite3
+import time
+
+import Executor
+import Verify
+
+
+class UploadJournal:
+    """
+    This class will remove the already finished commands before a run and record the finished samples during the run
+    """
+
+    def __init__(self, path='upload_journal.sqlite', force=False):
+        """
+        Args:
+            path: path of the sqlite journal. It is created if it does not exist
+            force: If force=True nothing is skipped but the finished samples are still recorded
+        """
+        self.path = path
+        self.force = force
+        self.planned = {}
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS uploads (local TEXT, target TEXT, size INTEGER, mtime_ns INTEGER, md5 TEXT,
+                                                done_at TEXT, PRIMARY KEY (local, target));
+            CREATE TABLE IF NOT EXISTS metadata (ipath TEXT PRIMARY KEY, digest TEXT, done_at TEXT);
+            CREATE TABLE IF NOT EXISTS samples (name TEXT, prefix TEXT, exit_code INTEGER, done_at TEXT);
+        """)
+
+    def pending(self, commands, prefix):
+        """
+        removes the commands which are already done according to the journal. A sample where nothing is left to do
+        (only imkdir) is removed completely
+        Args:
+            commands: dict of sample name and the newline joined commands or its list of typed operations (Plan.py).
+            Output of UploadFastq.main or UploadCram.main
+            prefix: prefix of the shell script. upload, meta or all
+
+        Returns: dict of sample name and the commands which still have to be run, in the same form as they were given
+
+        """
+        pending = {}
+        skipped = 0
+        for name in commands:
+            uploads = []
+            metadata = {}
+            keep = []
+            work = 0
+            steps = Executor.ShellExecutor.steps(commands[name])
+            items = [text for text, argvs in steps] if isinstance(commands[name], str) else commands[name]
+            for item, (text, argvs) in zip(items, steps):
+                transfer = Executor.ShellExecutor.transfer_arguments(argvs[0])
+                if transfer:
+                    locals_, icollection, threads = transfer
+                    files = [self.fingerprint(local=local, target=f'i:{icollection}') for local in locals_]
+                    uploads.extend(files)
+                    if all(self.uploaded(upload) for upload in files):
+                        skipped += 1
+                        continue
+                    keep.append(item)
+                    work += 1
+                elif argvs[0][0] == 'imeta':
+                    metadata.setdefault(argvs[0][3], []).append((item, text))
+                else:
+                    keep.append(item)
+            digests = {ipath: hashlib.sha1("\n".join(text for item, text in metadata[ipath]).encode()).hexdigest()
+                       for ipath in metadata}
+            for ipath in metadata:
+                if self.meta_applied(ipath=ipath, digest=digests[ipath]):
+                    skipped += len(metadata[ipath])
+                    continue
+                keep.extend(item for item, text in metadata[ipath])
+                work += 1
+            self.planned[name] = (prefix, uploads, digests)
+            if work:
+                pending[name] = "\n".join(keep) if isinstance(commands[name], str) else keep
+        print(f'journal: {len(commands) - len(pending)} of {len(commands)} samples are already done, {skipped} '
+              f'commands are skipped. check {self.path}')
+        return pending
+
+    def fingerprint(self, local, target):
+        """
+        the key of an upload
+        Args:
+            local: local file path
+            target: irods target of the transfer (i:<collection>)
+
+        Returns: tuple of local, target, size, modification time and md5sum from <local>.md5 (empty if there is none)
+
+        """
+        stat = os.stat(local)
+        return local, target, stat.st_size, stat.st_mtime_ns, Verify.Md5Verify.reading_md5file(local)
+
+    def uploaded(self, upload):
+        """
+        Args:
+            upload: output of fingerprint
+
+        Returns: True if the file was uploaded with the same size, modification time and md5sum
+
+        """
+        if self.force:
+            return False
+        row = self.connection.execute("SELECT size, mtime_ns, md5 FROM uploads WHERE local = ? AND target = ?",
+                                      upload[:2]).fetchone()
+        return row is not None and tuple(row) == tuple(upload[2:])
+
+    def meta_applied(self, ipath, digest):
+        """
+        Args:
+            ipath: irods data object path
+            digest: digest of the imeta commands of the data object
+
+        Returns: True if the same metadata was applied already
+
+        """
+        if self.force:
+            return False
+        row = self.connection.execute("SELECT digest FROM metadata WHERE ipath = ?", (ipath,)).fetchone()
+        return row is not None and row[0] == digest
+
+    def resuming(self):
+        """
+        Returns: True if an earlier run recorded a sample in the journal, so a data object in irods may be left over
+        from a run which died halfway
+
+        """
+        return self.connection.execute("SELECT 1 FROM samples LIMIT 1").fetchone() is not None
+
+    def record(self, name, exit_code):
+        """
+        records a finished sample. Only if it finished without error its uploads and metadata are marked as done.
+        It is meant to be given as on_done to Executor
+        Args:
+            name: sample name
+            exit_code: exit code of the sample
+        """
+        prefix, uploads, digests = self.planned.get(name, ('', [], {}))
+        now = time.strftime('%Y-%m-%dT%H:%M:%S')
+        with self.connection:
+            self.connection.execute("INSERT INTO samples VALUES (?, ?, ?, ?)", (name, prefix, exit_code, now))
+            if exit_code == 0:
+                self.connection.executemany("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?)",
+                                            [upload + (now,) for upload in uploads])
+                self.connection.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?)",
+                                            [(ipath, digests[ipath], now) for ipath in digests])
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,82 @@
+"""
+Detecting the layout of the fastq files of a sample folder. The folder used to need exactly Read1, Read2 and their
+.md5 files. Every file name is now classified with one regular expression into its read role (R1, R2 or the index
+reads I1, I2), lane and chunk (_001, _002 ...), so single-end runs, runs with index reads and runs split into several
+chunks are uploaded the same way as a plain paired-end run
+<prefix>[_L<lane>]_<role>_<chunk>.fastq.gz (or .fq.gz)
+"""
+import os
+import re
+from collections import namedtuple
+
+FASTQ = re.compile(r'^(?P<prefix>.+?)(?:_L(?P<lane>\d{3}))?_(?P<role>[RI][12])_(?P<chunk>\d{3})\.f(?:ast)?q\.gz$')
+# order of the read roles inside a lane and chunk, and their pair_end_read metadata
+ROLES = {'R1': 'Read1', 'R2': 'Read2', 'I1': 'Index1', 'I2': 'Index2'}
+
+FastqFile = namedtuple('FastqFile', ['path', 'role', 'lane', 'chunk'])
+
+
+class FastqLayout:
+    """
+    This class holds the classified fastq files of a sample folder and the problems found in it
+    """
+
+    def __init__(self, target_folder, fastqs, problems):
+        """
+        Args:
+            target_folder: the sample folder
+            fastqs: list of FastqFile, sorted by lane, chunk and read role
+            problems: list of (check, message). empty if the folder can be uploaded
+        """
+        self.target_folder = target_folder
+        self.fastqs = fastqs
+        self.problems = problems
+
+    @classmethod
+    def detecting(cls, files, target_folder=''):
+        """
+        classifies the files of a sample folder. Every file has to be a fastq file matching FASTQ or the .md5 file of
+        one. Every fastq file needs its .md5 file, there has to be at least one R1 file and every read role has to have
+        the same lanes and chunks as R1 (an R2 for every R1 of a paired-end run)
+        Args:
+            files: list of file paths of the folder. e.g. Scan.FolderIndex.listing
+            target_folder: the sample folder, only used in the messages
+
+        Returns: FastqLayout
+
+        """
+        names = {os.path.basename(file): file for file in files}
+        fastqs = []
+        problems = []
+        for name, path in names.items():
+            if name.endswith('.md5'):
+                if name[:-len('.md5')] not in names:
+                    problems.append(('md5', f'{path} has no fastq file'))
+                continue
+            match = FASTQ.match(name)
+            if match is None:
+                problems.append(('files', f'{path} is not a fastq file '
+                                          f'(<name>[_L<lane>]_<R1|R2|I1|I2>_<chunk>.fastq.gz)'))
+                continue
+            if name + '.md5' not in names:
+                problems.append(('md5', f'cant find the md5sum for {path}'))
+            fastqs.append(FastqFile(path=path, role=match.group('role'), lane=match.group('lane') or '',
+                                    chunk=match.group('chunk')))
+        fastqs.sort(key=lambda fastq: (fastq.lane, fastq.chunk, list(ROLES).index(fastq.role)))
+        parts = {}
+        for fastq in fastqs:
+            parts.setdefault(fastq.role, set()).add((fastq.lane, fastq.chunk))
+        if 'R1' not in parts:
+            problems.append(('reads', f'{target_folder} has no R1 fastq file'))
+        else:
+            for role in parts:
+                if parts[role] != parts['R1']:
+                    problems.append(('reads', f'{target_folder} does not have a {role} file for every R1 file'))
+        return cls(target_folder=target_folder, fastqs=fastqs, problems=problems)
+
+    def uploads(self):
+        """
+        Returns: list of the local files to upload. Every fastq file followed by its .md5 file
+
+        """
+        return [file for fastq in self.fastqs for file in (fastq.path, fastq.path + '.md5')]
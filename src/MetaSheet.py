@@ -0,0 +1,200 @@
+"""
+Loading the Metadata sheet. The sheet is read once with openpyxl in read only mode (or from a csv/tsv file) and kept
+column wise: units and attributes only once and the values of every attribute as a list. The parsed sheet is cached
+beside the file (<file>.cache.json) with the hash of the file, so the next run does not parse it again
+"""
+import csv
+import datetime
+import hashlib
+import json
+import os
+import sys
+
+
+class MetadataSheet:
+    """
+    This class holds the Metadata sheet. units[i] and attributes[i] belong to columns[i], which has one value for every
+    sample (None if the cell is empty)
+    """
+
+    def __init__(self, units, attributes, columns):
+        """
+        Args:
+            units: list of units (first row of the sheet)
+            attributes: list of attribute names (second row of the sheet)
+            columns: list of the values of every attribute, one value per sample
+        """
+        self.units = units
+        self.attributes = attributes
+        self.columns = columns
+
+    @property
+    def samples(self):
+        """
+        number of samples (rows in the sheet)
+        """
+        return len(self.columns[0]) if self.columns else 0
+
+    def column(self, attribute):
+        """
+        Args:
+            attribute: attribute name
+
+        Returns: the values of the attribute for every sample. list of None if the attribute is not in the sheet
+
+        """
+        if attribute in self.attributes:
+            return self.columns[self.attributes.index(attribute)]
+        return [None] * self.samples
+
+    @classmethod
+    def loading(cls, metadata, cache=True):
+        """
+        loads the Metadata sheet of an excel file or a csv/tsv file with the same layout (first row units, second row
+        attribute names and everything else values). The cache beside the file is used if the hash of the file did not
+        change
+        Args:
+            metadata: path of the <metadata>.xlsx, .csv or .tsv file
+            cache: If cache=False the cache is neither read nor written
+
+        Returns: MetadataSheet
+
+        """
+        digest = cls.hashing(metadata)
+        cachefile = metadata + '.cache.json'
+        if cache and os.path.exists(cachefile):
+            try:
+                with open(cachefile) as f:
+                    cached = json.load(f)
+                if cached.get('hash') == digest:
+                    return cls(units=cached['units'], attributes=cached['attributes'], columns=cached['columns'])
+            except (OSError, ValueError, KeyError):
+                pass
+        if metadata.endswith(('.csv', '.tsv', '.txt')):
+            rows = cls.reading_text(metadata)
+        else:
+            rows = cls.reading_excel(metadata)
+        sheet = cls.normalising(rows)
+        if cache:
+            try:
+                with open(cachefile, 'w') as f:
+                    json.dump({'hash': digest, 'units': sheet.units, 'attributes': sheet.attributes,
+                               'columns': sheet.columns}, f)
+            except OSError:
+                pass
+        return sheet
+
+    @classmethod
+    def hashing(cls, metadata):
+        """
+        Args:
+            metadata: path of the metadata file
+
+        Returns: sha1 of the file
+
+        """
+        digest = hashlib.sha1()
+        with open(metadata, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @classmethod
+    def reading_excel(cls, metadata):
+        """
+        reads the Metadata sheet of the excel file in read only (streaming) mode
+        Args:
+            metadata: path of the <metadata>.xlsx
+
+        Returns: list of rows. every row is a list of cell values
+
+        """
+        import openpyxl
+        workbook = openpyxl.load_workbook(metadata, read_only=True, data_only=True)
+        try:
+            if "Metadata" not in workbook.sheetnames:
+                print("Could not find the Metadata sheet in the excel file. Please check", metadata)
+                sys.exit(1)
+            return [list(row) for row in workbook["Metadata"].iter_rows(values_only=True)]
+        finally:
+            workbook.close()
+
+    @classmethod
+    def reading_text(cls, metadata):
+        """
+        reads a csv or tsv file. tsv and txt files are tab separated
+        Args:
+            metadata: path of the .csv or .tsv file
+
+        Returns: list of rows. every row is a list of cell values (empty cells are None)
+
+        """
+        delimiter = ',' if metadata.endswith('.csv') else '\t'
+        with open(metadata, newline='', encoding='utf-8-sig') as f:
+            return [[cell if cell != '' else None for cell in row] for row in csv.reader(f, delimiter=delimiter)]
+
+    @classmethod
+    def normalising(cls, rows):
+        """
+        turns the rows of the sheet into the column wise MetadataSheet. Empty rows and columns without attribute name
+        are left out. Empty units are filled from the column before, same as pandas does for a two row header. Every
+        value is kept as string, dates in the same format as pandas (2023-03-17 00:00:00)
+        Args:
+            rows: list of rows of the sheet
+
+        Returns: MetadataSheet
+
+        """
+        if len(rows) < 2:
+            print("The Metadata sheet should have at least two rows. first row is units and second row attribute name")
+            sys.exit(1)
+        width = max(len(row) for row in rows)
+        rows = [list(row) + [None] * (width - len(row)) for row in rows]
+        units_row, attributes_row = rows[0], rows[1]
+        values = [row for row in rows[2:] if any(cls.cell(cell) is not None for cell in row)]
+        units, attributes, columns = [], [], []
+        unit = None
+        for index in range(width):
+            unit = cls.cell(units_row[index]) or unit
+            attribute = cls.cell(attributes_row[index])
+            if attribute is None:
+                continue
+            units.append(unit or f'Unnamed: {index}_level_0')
+            attributes.append(attribute)
+            columns.append([cls.cell(row[index]) for row in values])
+        return cls(units=units, attributes=attributes, columns=columns)
+
+    @classmethod
+    def cell(cls, value):
+        """
+        Args:
+            value: value of a cell
+
+        Returns: the value as string. None if the cell is empty
+
+        """
+        if value is None:
+            return None
+        if isinstance(value, datetime.datetime):
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        if isinstance(value, datetime.date):
+            return value.strftime('%Y-%m-%d 00:00:00')
+        # pandas wrote 9606.0 for a numeric column with an empty cell. Here a whole number is always 9606, which changes
+        # those values of files uploaded before once (check README.md)
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        value = str(value)
+        return value if value.strip() != '' else None
+
+    def to_frame(self):
+        """
+        The sheet in the same shape as pandas.read_excel(metadata, sheet_name="Metadata", header=[0, 1]).transpose():
+        every sample is a column and the index is (unit, attribute). It is build directly from the columns, without
+        any transpose
+
+        Returns: pandas.DataFrame
+
+        """
+        import pandas
+        index = pandas.MultiIndex.from_arrays([self.units, self.attributes])
+        return pandas.DataFrame(self.columns, index=index, columns=range(self.samples), dtype=object)
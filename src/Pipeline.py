@@ -0,0 +1,319 @@
+"""
+Pipelined running of the samples with asyncio. The commands of a sample go through three stages: verification of the
+local files against their .md5 files, transfer (imkdir and the uploads) and metadata (imeta). Every stage has its own
+number of workers and a bounded queue before it, so the irods server adds the metadata of one sample while the next
+samples are still hashed and uploaded. A sample only enters the pipeline if the bytes of all the samples which are not
+uploaded yet stay below max_bytes
+"""
+import asyncio
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import Executor
+import Verify
+
+
+class ByteBudget:
+    """
+    The number of bytes which are in the pipeline (not uploaded yet). A sample waits until its bytes fit. A sample
+    which is bigger than the whole budget is let in when the pipeline is empty
+    """
+
+    def __init__(self, limit=0):
+        """
+        Args:
+            limit: maximum number of bytes in the pipeline. 0 is no limit
+        """
+        self.limit = limit
+        self.used = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, size):
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.limit or self.used == 0 or self.used + size <= self.limit)
+            self.used += size
+
+    async def release(self, size):
+        async with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+class PipelineExecutor:
+    """
+    This class will run the commands of every sample in the verification, transfer and metadata stages. The commands
+    are run with the icommands (shell) or python-irodsclient (native), same as Executor.py. The shell scripts are still
+    written in shfiles/ as a record
+    """
+
+    @classmethod
+    def main(cls, commands, prefix, verify_jobs=1, transfer_jobs=1, meta_jobs=1, max_bytes=0, verify=False,
+             backend='shell', session_factory=None, irods_env=None, on_done=None, timing=None, limiter=None,
+             md5_report='md5_report.tsv', precheck=True):
+        """
+        The main wrapper to run all the samples in the pipeline
+        Args:
+            commands: dict of sample (upload folder) name and the newline joined commands or its list of typed
+            operations (Plan.py). Output of UploadFastq.main or UploadCram.main
+            prefix: prefix of the shell script. upload, meta or all
+            verify_jobs: number of files which are hashed at the same time
+            transfer_jobs: number of samples which are uploaded at the same time
+            meta_jobs: number of samples whose metadata is added at the same time
+            max_bytes: maximum number of bytes of the samples which are in the pipeline and not uploaded yet. 0 is no
+            limit
+            verify: If verify=True every uploaded file is checked against its .md5 file before its upload. Otherwise
+            the verification stage is skipped
+            backend: shell or native
+            session_factory: callable returning a new session for the native backend. by default an iRODSSession
+            irods_env: path of the irods environment file for the native backend
+            on_done: callable(name, exit_code) which is called as soon as a sample is finished. e.g. Journal
+            timing: Timing.TimingLog where the timing of every command is written. None for no timing
+            limiter: Adaptive.ConcurrencyLimiter shared by the transfer and metadata stages. None for no limit and no
+            retries
+            md5_report: the report of the verification, same as Verify.Md5Verify.main. Files with the same size and
+            modification time in the report are not hashed again. It is updated at the end
+            precheck: If precheck=False a trusted transfer of the shell backend is run without asking irods for its
+            checksum first, same as Executor.ShellExecutor.main
+
+        Returns: dict of sample name and the exit code. 0 means everything went fine
+
+        """
+        shfiles = Executor.ShellExecutor.writing_shfiles(commands=commands, prefix=prefix)
+        pool = None
+        if backend == 'native':
+            session_factory = session_factory or Executor.NativeExecutor.irods_session_factory(irods_env=irods_env)
+            pool = Executor.SessionPool(session_factory=session_factory, size=transfer_jobs + meta_jobs)
+        pipeline = cls(shfiles=shfiles, commands=commands, prefix=prefix, verify_jobs=verify_jobs,
+                       transfer_jobs=transfer_jobs, meta_jobs=meta_jobs, max_bytes=max_bytes, verify=verify, pool=pool,
+                       on_done=on_done, timing=timing, limiter=limiter, md5_report=md5_report, precheck=precheck)
+        try:
+            return asyncio.run(pipeline.running())
+        finally:
+            if pool is not None:
+                pool.close()
+            if verify:
+                Verify.Md5Verify.writing_report(rows=pipeline.md5_rows, report=md5_report)
+
+    def __init__(self, shfiles, prefix, commands=None, verify_jobs=1, transfer_jobs=1, meta_jobs=1, max_bytes=0,
+                 verify=False, pool=None, on_done=None, timing=None, limiter=None, md5_report=None, precheck=True):
+        """
+        Args:
+            shfiles: dict of sample name and its shell script. output of Executor.ShellExecutor.writing_shfiles
+            prefix: prefix of the shell script. upload, meta or all
+            commands: dict of sample name and its commands, as given to main. None to read them from the shell scripts
+            verify_jobs: number of files which are hashed at the same time
+            transfer_jobs: number of samples which are uploaded at the same time
+            meta_jobs: number of samples whose metadata is added at the same time
+            max_bytes: maximum number of bytes in the pipeline. 0 is no limit
+            verify: If verify=True the verification stage checks the files against their .md5 files
+            pool: Executor.SessionPool for the native backend. None for the shell backend
+            on_done: callable(name, exit_code) which is called as soon as a sample is finished
+            timing: Timing.TimingLog where the timing of every command is written. None for no timing
+            limiter: Adaptive.ConcurrencyLimiter of the irods calls. None for no limit and no retries
+            md5_report: the report of the verification. The files in it which did not change are not hashed again.
+            None for no report
+            precheck: If precheck=False a trusted transfer is run without asking irods for its checksum first
+        """
+        self.shfiles = shfiles
+        self.commands = commands
+        self.prefix = prefix
+        self.jobs = {'verify': max(1, verify_jobs), 'transfer': max(1, transfer_jobs), 'meta': max(1, meta_jobs)}
+        self.max_bytes = max_bytes
+        self.verify = verify
+        self.pool = pool
+        self.on_done = on_done
+        self.timing = timing
+        self.limiter = limiter
+        self.precheck = precheck
+        # rows of the md5 report. The verification stage adds the files it hashed, main writes them at the end
+        self.md5_rows = Verify.Md5Verify.reading_report(md5_report) if verify else {}
+        self.stages = {}
+        self.sizes = {}
+        self.exit_codes = {}
+
+    def staging(self, name):
+        """
+        splits the commands of a sample into the transfer commands (everything which is not imeta) and the metadata
+        commands. The order of the commands inside a stage is kept
+        Args:
+            name: sample name
+
+        Returns: dict with the files to verify, the transfer commands and the metadata commands
+
+        """
+        if self.commands is None:
+            with open(self.shfiles[name]) as f:
+                commands = Executor.ShellExecutor.splitting_commands(f.read())
+        else:
+            commands = Executor.ShellExecutor.steps(self.commands[name])
+        stage = {'files': [], 'transfer': [], 'meta': []}
+        for text, argvs in commands:
+            if argvs[0][0] == 'imeta':
+                stage['meta'].append((text, argvs))
+                continue
+            stage['transfer'].append((text, argvs))
+            transfer = Executor.ShellExecutor.transfer_arguments(argvs[0])
+            if transfer:
+                stage['files'].extend(transfer[0])
+        self.sizes[name] = sum(os.path.getsize(file) for file in stage['files'] if os.path.exists(file))
+        return stage
+
+    async def running(self):
+        """
+        feeds the samples into the pipeline and waits until every sample went through all the stages
+
+        Returns: dict of sample name and the exit code
+
+        """
+        loop = asyncio.get_running_loop()
+        self.budget = ByteBudget(limit=self.max_bytes)
+        self.threads = ThreadPoolExecutor(max_workers=self.jobs['transfer'] + self.jobs['meta'])
+        self.processes = ProcessPoolExecutor(max_workers=self.jobs['verify']) if self.verify else None
+        queues = {stage: asyncio.Queue(maxsize=2 * self.jobs[stage]) for stage in ('verify', 'transfer', 'meta')}
+        workers = {stage: [loop.create_task(self.working(stage=stage, queues=queues))
+                           for _ in range(self.jobs[stage])] for stage in queues}
+        try:
+            for name in self.shfiles:
+                with open(self.shfiles[name][:-len('.sh')] + '.log', 'w'):
+                    pass
+                self.stages[name] = self.staging(name)
+                await self.budget.acquire(self.sizes[name])
+                await queues['verify'].put(name)
+            for stage in queues:
+                await queues[stage].join()
+                for worker in workers[stage]:
+                    worker.cancel()
+        finally:
+            self.threads.shutdown()
+            if self.processes is not None:
+                self.processes.shutdown()
+        return self.exit_codes
+
+    async def working(self, stage, queues):
+        """
+        a worker of a stage. It takes the next sample from the queue of the stage, runs it and gives it to the next
+        stage. A failed sample does not go to the next stage
+        Args:
+            stage: verify, transfer or meta
+            queues: dict of stage and its queue
+        """
+        following = {'verify': 'transfer', 'transfer': 'meta', 'meta': None}[stage]
+        while True:
+            name = await queues[stage].get()
+            try:
+                try:
+                    if stage == 'verify':
+                        exit_code = await self.verifying(name)
+                    else:
+                        exit_code = await self.commanding(name=name, commands=self.stages[name][stage])
+                except Exception:
+                    with open(self.shfiles[name][:-len('.sh')] + '.log', 'a') as log:
+                        log.write(traceback.format_exc())
+                    exit_code = 1
+                if stage == 'transfer' or (stage == 'verify' and exit_code != 0):
+                    await self.budget.release(self.sizes[name])
+                if exit_code != 0 or following is None:
+                    self.finishing(name=name, exit_code=exit_code)
+                else:
+                    await queues[following].put(name)
+            finally:
+                queues[stage].task_done()
+
+    async def verifying(self, name):
+        """
+        checks the files of a sample against their .md5 files on the process pool. The files which are in the md5
+        report with the same size and modification time are not hashed again
+        Args:
+            name: sample name
+
+        Returns: 0 if every file matches its .md5 file (or verify=False), 1 otherwise
+
+        """
+        files = [os.path.abspath(file) for file in self.stages[name]['files']
+                 if not file.endswith('.md5') and os.path.exists(file + '.md5')]
+        if not self.verify or not files:
+            return 0
+        results = {}
+        to_hash = []
+        for file in files:
+            row = Verify.Md5Verify.reusing(cached=self.md5_rows, file=file)
+            if row is not None:
+                results[file] = row
+            else:
+                to_hash.append(file)
+        loop = asyncio.get_running_loop()
+        rows = await asyncio.gather(*[loop.run_in_executor(self.processes, Verify.Md5Verify.hashing, file)
+                                      for file in to_hash])
+        for file, row in zip(to_hash, rows):
+            seconds = row.pop('seconds')
+            results[file] = Verify.Md5Verify.comparing(row=row, expected=Verify.Md5Verify.reading_md5file(file))
+            if self.timing is not None:
+                self.timing.record(sample=name, op='checksum', seconds=seconds, size=row['size'],
+                                   status=0 if row['status'] == 'ok' else 1, detail=file)
+        self.md5_rows.update(results)
+        exit_code = 0
+        with open(self.shfiles[name][:-len('.sh')] + '.log', 'a') as log:
+            for file in files:
+                source = '' if file in to_hash else ' (md5 report)'
+                log.write(f"md5: {file} {results[file]['status']}{source}\n")
+                if results[file]['status'] != 'ok':
+                    exit_code = 1
+        return exit_code
+
+    async def commanding(self, name, commands):
+        """
+        runs the commands of a stage of a sample one after the other on the thread pool and stops at the first failing
+        command
+        Args:
+            name: sample name
+            commands: list of (text, argvs). output of Executor.ShellExecutor.splitting_commands
+
+        Returns: the exit code of the first failing command, 0 if all of them went fine
+
+        """
+        if not commands:
+            return 0
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.threads, self.blocking, name, commands)
+
+    def blocking(self, name, commands):
+        """
+        runs the commands in a thread with the icommands or a session of the pool
+        Args:
+            name: sample name
+            commands: list of (text, argvs)
+
+        Returns: the exit code of the first failing command, 0 if all of them went fine
+
+        """
+        with open(self.shfiles[name][:-len('.sh')] + '.log', 'a') as log:
+            for text, argvs in commands:
+                if self.pool is None:
+                    exit_code = Executor.ShellExecutor.running_command(text=text, argvs=argvs, log=log, name=name,
+                                                                       timing=self.timing, limiter=self.limiter,
+                                                                       precheck=self.precheck)
+                else:
+                    with self.pool.session() as session:
+                        exit_code = Executor.NativeExecutor.running_session_command(session=session, command=argvs,
+                                                                                    log=log, name=name,
+                                                                                    timing=self.timing,
+                                                                                    limiter=self.limiter)
+                if exit_code != 0:
+                    return exit_code
+        return 0
+
+    def finishing(self, name, exit_code):
+        """
+        records a finished (or failed) sample, same output as Executor.ShellExecutor.running_pool
+        Args:
+            name: sample name
+            exit_code: exit code of the sample
+        """
+        self.exit_codes[name] = exit_code
+        if exit_code == 0:
+            print(f'{self.prefix} {name} is done')
+        else:
+            print(f'{self.prefix} {name} failed with exit code {exit_code}. check shfiles/{self.prefix}_{name}.log')
+        if self.on_done is not None:
+            self.on_done(name, exit_code)
@@ -0,0 +1,422 @@
+"""
+The flat operation table of a run. Every operation (creating a collection, uploading a file, removing or adding a
+metadata attribute) is one row: sample, path, op, attribute, value, unit. It is planned in one pass over the whole
+Metadata sheet (check UploadFastq.planning) and can be given to any executor, rendered as the icommands of the shell
+scripts or turned into the metadata every data object should have. OperationTable.operations gives the same plan as
+typed operation objects per sample (Mkdir, Put, BulkPut, MetaRemove, MetaSet, MetaBatch), which the executors, the
+dry-run printer and the shell scripts use without parsing command strings again. The metadata operations can be on a
+collection too (crmw, cadd), for the metadata shared by all the files of a sample or project (check Inherit.py)
+"""
+import sys
+
+OPS = ('mkdir', 'put', 'md5put', 'bulk', 'rmw', 'add', 'crmw', 'cadd')
+
+
+class OperationTable:
+    """
+    This class holds the operations column wise. The meaning of path and value depends on op
+    mkdir: path is the irods collection
+    put: path is the irods collection, value is the local file and unit the number of transfer threads ('' is the
+    default of the server)
+    md5put: same as put, but the checksum is calculated by the server and compared with the .md5 file of the local
+    file instead of hashing the file on the client (check Transfer.py)
+    bulk: path is the irods collection and value is the tuple of small local files which are uploaded together
+    rmw: path is the irods data object, every value and unit of attribute is removed
+    add: path is the irods data object and attribute, value, unit is added
+    crmw, cadd: same as rmw and add, but path is an irods collection
+    """
+
+    def __init__(self):
+        self.sample = []
+        self.path = []
+        self.op = []
+        self.attribute = []
+        self.value = []
+        self.unit = []
+
+    def __len__(self):
+        return len(self.op)
+
+    def append(self, sample, op, path, attribute='', value='', unit=''):
+        """
+        adds a single operation at the end of the table
+        Args:
+            sample: sample (upload folder) name
+            op: one of mkdir, put, md5put, bulk, rmw, add, crmw, cadd
+            path: irods collection or data object
+            attribute: metadata attribute for rmw, add, crmw and cadd
+            value: local file for put, tuple of local files for bulk, metadata value for add and cadd
+            unit: metadata unit for add and cadd, number of transfer threads for put and md5put
+        """
+        self.sample.append(sample)
+        self.op.append(op)
+        self.path.append(path)
+        self.attribute.append(attribute)
+        self.value.append(value)
+        self.unit.append(unit)
+
+    def adding_metadata(self, sample, path, avus, collection=False):
+        """
+        adds an add operation for every (attribute, value, unit)
+        Args:
+            sample: sample (upload folder) name
+            path: irods data object
+            avus: list of (attribute, value, unit)
+            collection: If collection=True path is an irods collection (cadd)
+        """
+        for attribute, value, unit in avus:
+            self.append(sample=sample, op='cadd' if collection else 'add', path=path, attribute=attribute, value=value,
+                        unit=unit)
+
+    def removing_metadata(self, sample, path, attributes, collection=False):
+        """
+        adds a rmw operation for every attribute
+        Args:
+            sample: sample (upload folder) name
+            path: irods data object
+            attributes: list of attributes
+            collection: If collection=True path is an irods collection (crmw)
+        """
+        for attribute in attributes:
+            self.append(sample=sample, op='crmw' if collection else 'rmw', path=path, attribute=attribute, value='%',
+                        unit='%')
+
+    def keeping(self, indexes):
+        """
+        keeps only the operations at indexes, in the given order
+        Args:
+            indexes: list of row indexes
+        """
+        for column in (self.sample, self.op, self.path, self.attribute, self.value, self.unit):
+            column[:] = [column[index] for index in indexes]
+
+    def replacing(self, rows):
+        """
+        replaces all the operations of the table
+        Args:
+            rows: list of (sample, op, path, attribute, value, unit) in the new order
+        """
+        rows = list(rows)
+        for column, values in zip((self.sample, self.op, self.path, self.attribute, self.value, self.unit),
+                                  zip(*rows) if rows else [()] * 6):
+            column[:] = values
+
+    def rows(self):
+        """
+        Returns: iterator of (sample, op, path, attribute, value, unit) in the planned order
+
+        """
+        return zip(self.sample, self.op, self.path, self.attribute, self.value, self.unit)
+
+    def samples(self):
+        """
+        Returns: list of the sample names in the planned order
+
+        """
+        return list(dict.fromkeys(self.sample))
+
+    def operations(self, batch_meta=False):
+        """
+        the operations of every sample as typed operation objects, in the planned order
+        Args:
+            batch_meta: If batch_meta=True all the metadata operations of a data object are one MetaBatch, after the
+            other operations of the sample (check MetaBatch)
+
+        Returns: dict of sample name and its list of operations
+
+        """
+        operations = {}
+        for sample, op, path, attribute, value, unit in self.rows():
+            if op == 'mkdir':
+                operation = Mkdir(sample=sample, collection=path)
+            elif op in ('put', 'md5put'):
+                operation = Put(sample=sample, collection=path, local=value, threads=unit, trusted=op == 'md5put')
+            elif op == 'bulk':
+                operation = BulkPut(sample=sample, collection=path, locals_=value)
+            elif op in ('rmw', 'crmw'):
+                operation = MetaRemove(sample=sample, path=path, attribute=attribute, collection=op == 'crmw')
+            else:
+                operation = MetaSet(sample=sample, path=path, attribute=attribute, value=value, unit=unit,
+                                    collection=op == 'cadd')
+            operations.setdefault(sample, []).append(operation)
+        if batch_meta:
+            operations = {sample: MetaBatch.batching(operations[sample]) for sample in operations}
+        return operations
+
+    def commands(self):
+        """
+        renders every operation as the icommand of the shell scripts
+        mkdir: imkdir -p <collection>
+        put: irsync -K [-N <threads>] <local> i:<collection>
+        md5put: iput -f -k [-N <threads>] <local> <collection>
+        bulk: iput -b -f -K <local> <local> ... <collection>
+        rmw: imeta rmw -d <irods_file> "<attribute>" % %
+        add: imeta add -d <irods_file> "<attribute>" "<value>" <unit>
+        crmw, cadd: the same with -C <irods_collection>
+
+        Returns: dict of sample name and its list of commands
+
+        """
+        operations = self.operations()
+        return {sample: [operation.command() for operation in operations[sample]] for sample in operations}
+
+    def avus(self):
+        """
+        the metadata every data object should have, from the add operations. The metadata of the collections (cadd)
+        is left out
+
+        Returns: dict of sample name and the dict of irods data object path and its list of (attribute, value, unit)
+
+        """
+        avus = {}
+        for sample, op, path, attribute, value, unit in self.rows():
+            if op == 'add':
+                avus.setdefault(sample, {}).setdefault(path, []).append((attribute, value, unit))
+        return avus
+
+    def local_files(self):
+        """
+        the local data files which are uploaded. The .md5 files are left out
+
+        Returns: list of local file paths
+
+        """
+        files = []
+        for op, value in zip(self.op, self.value):
+            if op in ('put', 'md5put'):
+                files.append(value)
+            elif op == 'bulk':
+                files.extend(value)
+        return [file for file in files if not file.endswith('.md5')]
+
+
+class Operation:
+    """
+    A single typed operation of a sample. Every operation knows its icommand (command) and the argument lists of it
+    (argvs), the same as Executor.ShellExecutor.splitting_commands would give for the command
+    """
+    __slots__ = ('sample',)
+
+    def __init__(self, sample):
+        self.sample = sample
+
+    def __repr__(self):
+        fields = [name for cls in reversed(type(self).__mro__) for name in getattr(cls, '__slots__', ())]
+        return f'{type(self).__name__}({", ".join(f"{name}={getattr(self, name)!r}" for name in fields)})'
+
+    def command(self):
+        """
+        Returns: the icommand of the shell scripts
+
+        """
+        raise NotImplementedError
+
+    def argvs(self):
+        """
+        Returns: list of argument lists. it has more than one argument list only for MetaBatch
+
+        """
+        raise NotImplementedError
+
+    def describe(self):
+        """
+        Returns: a short human readable line for the dry-run
+
+        """
+        return self.command()
+
+
+class Mkdir(Operation):
+    """
+    creates an irods collection with its parents. imkdir -p <collection>
+    """
+    __slots__ = ('collection',)
+
+    def __init__(self, sample, collection):
+        super().__init__(sample)
+        self.collection = collection
+
+    def command(self):
+        return f'imkdir -p {self.collection}'
+
+    def argvs(self):
+        return [['imkdir', '-p', self.collection]]
+
+    def describe(self):
+        return f'mkdir       {self.collection}'
+
+
+class Put(Operation):
+    """
+    uploads a single local file in an irods collection. irsync -K [-N <threads>] <local> i:<collection> or with
+    trusted=True iput -f -k [-N <threads>] <local> <collection> (check Transfer.py)
+    """
+    __slots__ = ('collection', 'local', 'threads', 'trusted')
+
+    def __init__(self, sample, collection, local, threads='', trusted=False):
+        super().__init__(sample)
+        self.collection = collection
+        self.local = local
+        self.threads = threads
+        self.trusted = trusted
+
+    def command(self):
+        threads = f'-N {self.threads} ' if self.threads else ''
+        if self.trusted:
+            return f'iput -f -k {threads}{self.local} {self.collection}'
+        return f'irsync -K {threads}{self.local} i:{self.collection}'
+
+    def argvs(self):
+        threads = ['-N', str(self.threads)] if self.threads else []
+        if self.trusted:
+            return [['iput', '-f', '-k'] + threads + [self.local, self.collection]]
+        return [['irsync', '-K'] + threads + [self.local, f'i:{self.collection}']]
+
+    def describe(self):
+        details = [f'{self.threads} threads'] if self.threads else []
+        if self.trusted:
+            details.append('checksum of the server')
+        return f'put         {self.local} -> {self.collection}' + (f' ({", ".join(details)})' if details else '')
+
+
+class BulkPut(Operation):
+    """
+    uploads several small local files in one bulk call. iput -b -f -K <local> ... <collection>
+    """
+    __slots__ = ('collection', 'locals_')
+
+    def __init__(self, sample, collection, locals_):
+        super().__init__(sample)
+        self.collection = collection
+        self.locals_ = tuple(locals_)
+
+    def command(self):
+        return f'iput -b -f -K {" ".join(self.locals_)} {self.collection}'
+
+    def argvs(self):
+        return [['iput', '-b', '-f', '-K'] + list(self.locals_) + [self.collection]]
+
+    def describe(self):
+        return f'bulk put    {len(self.locals_)} files -> {self.collection} ({", ".join(self.locals_)})'
+
+
+class MetaRemove(Operation):
+    """
+    removes every value and unit of a metadata attribute of a data object. imeta rmw -d <path> "<attribute>" % %
+    or with collection=True of a collection. imeta rmw -C <path> "<attribute>" % %
+    """
+    __slots__ = ('path', 'attribute', 'collection')
+
+    def __init__(self, sample, path, attribute, collection=False):
+        super().__init__(sample)
+        self.path = path
+        self.attribute = attribute
+        self.collection = collection
+
+    def command(self):
+        return f'imeta rmw {"-C" if self.collection else "-d"} {self.path} "{self.attribute}" % %'
+
+    def argvs(self):
+        return [['imeta', 'rmw', '-C' if self.collection else '-d', self.path, self.attribute, '%', '%']]
+
+    def describe(self):
+        return f'meta-remove {self.path}{"/" if self.collection else ""} {self.attribute}'
+
+
+class MetaSet(Operation):
+    """
+    adds a metadata attribute, value and unit to a data object. imeta add -d <path> "<attribute>" "<value>" <unit>
+    or with collection=True to a collection. imeta add -C <path> "<attribute>" "<value>" <unit>
+    """
+    __slots__ = ('path', 'attribute', 'value', 'unit', 'collection')
+
+    def __init__(self, sample, path, attribute, value, unit='', collection=False):
+        super().__init__(sample)
+        self.path = path
+        self.attribute = attribute
+        self.value = value
+        self.unit = unit
+        self.collection = collection
+
+    def command(self):
+        flag = '-C' if self.collection else '-d'
+        return f'imeta add {flag} {self.path} "{self.attribute}" "{self.value}" {self.unit}'
+
+    def argvs(self):
+        return [['imeta', 'add', '-C' if self.collection else '-d', self.path, self.attribute, self.value] +
+                ([self.unit] if self.unit else [])]
+
+    def describe(self):
+        return f'meta-set    {self.path}{"/" if self.collection else ""} {self.attribute}={self.value}' + \
+            (f' [{self.unit}]' if self.unit else '')
+
+
+class MetaBatch(Operation):
+    """
+    all the MetaRemove and MetaSet of a data object (or a collection) in one imeta call (imeta pipe mode), in their
+    order
+    imeta <<'EOF'
+    rmw -d <path> "<attribute>" % %
+    add -d <path> "<attribute>" "<value>" <unit>
+    quit
+    EOF
+    """
+    __slots__ = ('path', 'operations')
+
+    def __init__(self, sample, path, operations):
+        super().__init__(sample)
+        self.path = path
+        self.operations = list(operations)
+
+    @classmethod
+    def batching(cls, operations):
+        """
+        puts the metadata operations of every data object in one MetaBatch. The other operations are kept as they are
+        and stay before the metadata
+        Args:
+            operations: list of operations of a sample
+
+        Returns: list of operations where there is only one MetaBatch per data object
+
+        """
+        others = []
+        metadata = {}
+        for operation in operations:
+            if isinstance(operation, (MetaRemove, MetaSet)):
+                metadata.setdefault(operation.path, []).append(operation)
+            else:
+                others.append(operation)
+        return others + [cls(sample=metadata[path][0].sample, path=path, operations=metadata[path])
+                         for path in metadata]
+
+    def command(self):
+        return "\n".join(["imeta <<'EOF'"] + [operation.command()[len('imeta '):] for operation in self.operations] +
+                         ['quit', 'EOF'])
+
+    def argvs(self):
+        return [operation.argvs()[0] for operation in self.operations]
+
+    def describe(self):
+        removes = sum(1 for operation in self.operations if isinstance(operation, MetaRemove))
+        return f'meta-batch  {self.path} ({removes} remove, {len(self.operations) - removes} set)'
+
+
+def printing(operations, output=None):
+    """
+    the dry-run printer. It prints what would be done for every sample, without running anything
+    Args:
+        operations: dict of sample name and its list of operations. output of OperationTable.operations
+        output: opened file to print to. default is stdout
+
+    Returns: number of operations
+
+    """
+    output = output or sys.stdout
+    count = 0
+    for sample in operations:
+        print(f'# {sample}: {len(operations[sample])} operations', file=output)
+        for operation in operations[sample]:
+            print(f'  {operation.describe()}', file=output)
+        count += len(operations[sample])
+    print(f'dry-run: {count} operations for {len(operations)} samples. nothing was run', file=output)
+    return count
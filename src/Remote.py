@@ -0,0 +1,224 @@
+"""
+Pre-flight query of what is already in irods. Every sample used to go through imkdir -p and irsync, which each ask the
+server about the collection and the data object on their own. Here the whole ifolder is queried at once (iquest, or
+GenQuery with python-irodsclient): the size and checksum of every data object, the number of its AVUs and all the
+collections. Uploads which are already in irods with the same size and checksum and collections which already exist
+are removed from the plan before anything is run
+"""
+import os
+import subprocess
+import sys
+
+import Executor
+import Transfer
+import Verify
+
+SEPARATOR = '\t'
+
+
+class RemoteState:
+    """
+    This class holds the data objects and collections under an irods folder
+    """
+
+    def __init__(self, ifolder, objects, avus, collections, metadata=None):
+        """
+        Args:
+            ifolder: the irods folder which was queried
+            objects: dict of irods data object path and (size, checksum)
+            avus: dict of irods data object path and its number of AVUs
+            collections: set of the irods collections under ifolder
+            metadata: list of (attribute, value, unit) of ifolder itself (check Inherit.py)
+        """
+        self.ifolder = ifolder
+        self.objects = objects
+        self.avus = avus
+        self.collections = collections
+        self.metadata = metadata or []
+
+    @classmethod
+    def main(cls, ifolder, backend='shell', irods_env=None, session_factory=None):
+        """
+        The main wrapper to query the state of ifolder. It is a constant number of queries, whatever the number of
+        samples
+        Args:
+            ifolder: The abs path of irods folder
+            backend: shell (iquest) or native (python-irodsclient)
+            irods_env: path of the irods environment file for the native backend
+            session_factory: callable returning a new session for the native backend. by default an iRODSSession
+
+        Returns: RemoteState
+
+        """
+        ifolder = ifolder.rstrip('/')
+        cls.checking(ifolder)
+        if backend == 'native':
+            session_factory = session_factory or Executor.NativeExecutor.irods_session_factory(irods_env=irods_env)
+            session = session_factory()
+            try:
+                state = cls.native_query(session=session, ifolder=ifolder)
+            finally:
+                session.cleanup()
+        else:
+            state = cls.shell_query(ifolder=ifolder)
+        print(f'preflight: {len(state.objects)} data objects and {len(state.collections)} collections are already in '
+              f'{ifolder}. {sum(1 for ipath in state.objects if not state.avus.get(ipath))} of them have no metadata')
+        return state
+
+    @classmethod
+    def shell_query(cls, ifolder):
+        """
+        queries ifolder with iquest
+        Args:
+            ifolder: The abs path of irods folder
+
+        Returns: RemoteState
+
+        """
+        like = f"COLL_NAME like '{ifolder}/%'"
+        objects = {}
+        for coll, name, size, checksum in cls.iquest(['%s', '%s', '%s', '%s'],
+                                                     f'SELECT COLL_NAME, DATA_NAME, DATA_SIZE, DATA_CHECKSUM WHERE '
+                                                     f'{like}'):
+            if cls.inside(coll, ifolder):
+                objects.setdefault(f'{coll}/{name}', (int(size), checksum))
+        avus = {f'{coll}/{name}': int(count) for coll, name, count in
+                cls.iquest(['%s', '%s', '%s'], f'SELECT COLL_NAME, DATA_NAME, COUNT(META_DATA_ATTR_NAME) WHERE {like}')
+                if cls.inside(coll, ifolder)}
+        collections = {row[0] for row in cls.iquest(['%s'], f'SELECT COLL_NAME WHERE {like}')
+                       if cls.inside(row[0], ifolder)}
+        metadata = [tuple(row) for row in cls.iquest(['%s', '%s', '%s'],
+                                                     f"SELECT META_COLL_ATTR_NAME, META_COLL_ATTR_VALUE, "
+                                                     f"META_COLL_ATTR_UNITS WHERE COLL_NAME = '{ifolder}'")]
+        return cls(ifolder=ifolder, objects=objects, avus=avus, collections=collections, metadata=metadata)
+
+    @classmethod
+    def checking(cls, ifolder):
+        """
+        exits if ifolder can not be put in a GenQuery. GenQuery has no escaping, so a ' in the name ends the value
+        Args:
+            ifolder: The abs path of irods folder
+        """
+        if "'" in ifolder:
+            print("The irods folder has a ' in its name, which can not be queried. Please rename it or do not use "
+                  "--preflight", ifolder)
+            sys.exit(1)
+
+    @classmethod
+    def inside(cls, collection, ifolder):
+        """
+        % and _ in ifolder are wildcards of COLL_NAME like '<ifolder>/%', so the query can give back collections of
+        other folders as well (/zone/run_1 for /zone/run1). Every row is checked with this
+        Args:
+            collection: irods collection of a row of the query
+            ifolder: The abs path of irods folder
+
+        Returns: True if the collection is ifolder or under it
+
+        """
+        return collection == ifolder or collection.startswith(ifolder + '/')
+
+    @classmethod
+    def iquest(cls, formats, query):
+        """
+        runs a single iquest query
+        Args:
+            formats: list of the format of every column (%s)
+            query: the GenQuery
+
+        Returns: list of rows. every row is a list of the column values. empty list if nothing was found
+
+        """
+        process = subprocess.run(['iquest', '--no-page', SEPARATOR.join(formats), query], capture_output=True,
+                                 text=True)
+        if 'CAT_NO_ROWS_FOUND' in process.stdout + process.stderr:
+            return []
+        if process.returncode != 0:
+            print("iquest failed. Please check that you are logged in (iinit)")
+            print(process.stderr)
+            sys.exit(1)
+        return [line.split(SEPARATOR) for line in process.stdout.split("\n")
+                if line.count(SEPARATOR) == len(formats) - 1 and line.strip()]
+
+    @classmethod
+    def native_query(cls, session, ifolder):
+        """
+        queries ifolder with GenQuery of python-irodsclient
+        Args:
+            session: irods session
+            ifolder: The abs path of irods folder
+
+        Returns: RemoteState
+
+        """
+        from irods.column import Criterion, Like
+        from irods.models import Collection, CollectionMeta, DataObject, DataObjectMeta
+        like = Like(Collection.name, f'{ifolder}/%')
+        objects = {}
+        for row in session.query(Collection.name, DataObject.name, DataObject.size, DataObject.checksum).filter(like):
+            if cls.inside(row[Collection.name], ifolder):
+                objects.setdefault(f'{row[Collection.name]}/{row[DataObject.name]}',
+                                   (int(row[DataObject.size]), row[DataObject.checksum]))
+        avus = {}
+        for row in session.query(Collection.name, DataObject.name, DataObjectMeta.id).filter(like):
+            if cls.inside(row[Collection.name], ifolder):
+                ipath = f'{row[Collection.name]}/{row[DataObject.name]}'
+                avus[ipath] = avus.get(ipath, 0) + 1
+        collections = {row[Collection.name] for row in session.query(Collection.name).filter(like)
+                       if cls.inside(row[Collection.name], ifolder)}
+        metadata = [(row[CollectionMeta.name], row[CollectionMeta.value], row[CollectionMeta.units] or '')
+                    for row in session.query(CollectionMeta.name, CollectionMeta.value, CollectionMeta.units).filter(
+                        Criterion('=', Collection.name, ifolder))]
+        return cls(ifolder=ifolder, objects=objects, avus=avus, collections=collections, metadata=metadata)
+
+    def pruning(self, table):
+        """
+        removes the operations from the plan which are already done in irods: imkdir of an existing collection and
+        the upload of files which are in irods with the same size and checksum. The checksum is compared with the .md5
+        file of the local file, a .md5 file itself (or a small file without .md5 file) is hashed
+        Args:
+            table: Plan.OperationTable. It is changed in place
+
+        Returns: the same table
+
+        """
+        keep = []
+        skipped = 0
+        for index, (op, path, value) in enumerate(zip(table.op, table.path, table.value)):
+            if op == 'mkdir' and path.rstrip('/') in self.collections:
+                continue
+            if op in ('put', 'md5put') and self.uploaded(local=value, icollection=path):
+                skipped += 1
+                continue
+            if op == 'bulk':
+                files = tuple(local for local in value if not self.uploaded(local=local, icollection=path))
+                skipped += len(value) - len(files)
+                if not files:
+                    continue
+                table.value[index] = files
+            keep.append(index)
+        table.keeping(keep)
+        print(f'preflight: {skipped} files are already in irods with the same size and checksum and are not uploaded')
+        return table
+
+    def uploaded(self, local, icollection):
+        """
+        Args:
+            local: local file path
+            icollection: irods collection in which the file is uploaded
+
+        Returns: True if the file is in irods with the same size and checksum
+
+        """
+        remote = self.objects.get(f'{icollection.rstrip("/")}/{os.path.basename(local)}')
+        if remote is None or remote[0] != os.path.getsize(local) or not remote[1]:
+            return False
+        size, checksum = remote
+        expected = Verify.Md5Verify.reading_md5file(local)
+        if expected and not checksum.startswith('sha2:'):
+            return checksum.lower() == expected
+        if local.endswith('.md5') or not expected:
+            if size >= Transfer.SMALL_FILE:
+                return False
+            return checksum == Executor.NativeExecutor.local_checksum(local, scheme=checksum)
+        return False
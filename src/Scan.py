@@ -0,0 +1,193 @@
+"""
+One pass index of the local run folder. Instead of a glob for every row of the metadata (and one more for the files of
+every folder) the run folder is read once with os.scandir and every row is looked up in the index. The index can be
+saved and loaded again, so a scan of a big NFS mounted run folder can be done once and used by many runs
+"""
+import bisect
+import json
+import os
+import sys
+
+
+class FolderIndex:
+    """
+    This class holds the sample folders of a run folder and the files inside every sample folder
+    """
+    indexes = {}
+
+    def __init__(self, folder, folders):
+        """
+        Args:
+            folder: absolute path of the run folder
+            folders: dict of sample folder name and the sorted list of its file names
+        """
+        self.folder = folder
+        self.folders = folders
+        self.names = sorted(folders)
+        self.libraries = {}
+        for name in self.names:
+            self.libraries.setdefault(self.library_key(name), []).append(name)
+
+    @classmethod
+    def scanning(cls, folder=None):
+        """
+        gives the index of a run folder. The folder is only scanned the first time, after that (or after loading a
+        saved index) the same index is given back
+        Args:
+            folder: The path of the run folder. default is current working directory
+
+        Returns: FolderIndex of the folder
+
+        """
+        folder = os.path.abspath(folder or os.getcwd())
+        if folder not in cls.indexes:
+            cls.indexes[folder] = cls.main(folder)
+        return cls.indexes[folder]
+
+    @classmethod
+    def rescanning(cls, folder=None):
+        """
+        scans the run folder again and replaces the index which was kept. e.g. when new sample folders are written
+        into it (check Watch.py)
+        Args:
+            folder: The path of the run folder. default is current working directory
+
+        Returns: FolderIndex of the folder
+
+        """
+        folder = os.path.abspath(folder or os.getcwd())
+        cls.indexes[folder] = cls.main(folder)
+        return cls.indexes[folder]
+
+    @classmethod
+    def main(cls, folder):
+        """
+        scans the run folder and all its sample folders with os.scandir. Hidden files and folders are left out, same
+        as glob
+        Args:
+            folder: absolute path of the run folder
+
+        Returns: FolderIndex of the folder
+
+        """
+        folders = {}
+        if os.path.isdir(folder):
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.') or not entry.is_dir():
+                        continue
+                    with os.scandir(entry.path) as files:
+                        folders[entry.name] = sorted(file.name for file in files if not file.name.startswith('.'))
+        return cls(folder=folder, folders=folders)
+
+    @classmethod
+    def library_key(cls, name):
+        """
+        the barcode_library part of a fastq folder name (<barcode>_<library>_S<number>_L<lane>)
+        Args:
+            name: sample folder name
+
+        Returns: the first two fields of the name separated by _
+
+        """
+        return "_".join(name.split("_")[:2])
+
+    def matching_folders(self, prefix):
+        """
+        all the sample folders of prefix: the folder named prefix and the folders starting with prefix_ (the fields of
+        a folder name are separated by _). So <barcode>_LIB1 does not match <barcode>_LIB10_S1_L001. The
+        barcode_library prefix of fastq folders is a dict look up. Everything else is a binary search in the sorted
+        folder names
+        Args:
+            prefix: the first fields of the sample folder name
+
+        Returns: list of sample folder paths with / at the end
+
+        """
+        names = self.libraries.get(prefix)
+        if names is None:
+            names = [prefix] if prefix in self.folders else []
+            start = bisect.bisect_left(self.names, prefix + '_')
+            while start < len(self.names) and self.names[start].startswith(prefix + '_'):
+                names.append(self.names[start])
+                start += 1
+        return [f'{self.folder}/{name}/' for name in names]
+
+    def exact_folder(self, name):
+        """
+        the sample folder with exactly this name, same as glob.glob(f'{folder}/{name}/')
+        Args:
+            name: sample folder name
+
+        Returns: list with the sample folder path with / at the end. empty list if it does not exist
+
+        """
+        return [f'{self.folder}/{name}/'] if name in self.folders else []
+
+    def listing(self, target_folder):
+        """
+        all the files in a sample folder, same as glob.glob(f'{target_folder}*')
+        Args:
+            target_folder: sample folder path with / at the end
+
+        Returns: list of file paths
+
+        """
+        name = os.path.basename(target_folder.rstrip('/'))
+        return [f'{self.folder}/{name}/{file}' for file in self.folders.get(name, [])]
+
+    def exists(self, filepath):
+        """
+        Args:
+            filepath: path of a file inside a sample folder
+
+        Returns: True if the file is in the index
+
+        """
+        name, file = filepath.split("/")[-2:]
+        files = self.folders.get(name, [])
+        index = bisect.bisect_left(files, file)
+        return index < len(files) and files[index] == file
+
+    @classmethod
+    def of(cls, target_folder):
+        """
+        the index of the run folder a sample folder is in
+        Args:
+            target_folder: sample folder path with / at the end
+
+        Returns: FolderIndex of the run folder
+
+        """
+        return cls.scanning(os.path.dirname(target_folder.rstrip('/')))
+
+    def saving(self, output='scan.json'):
+        """
+        writes the index in a json file, so it can be used again with loading
+        Args:
+            output: path of the json file
+
+        Returns: path of the json file
+
+        """
+        with open(output, 'w') as f:
+            json.dump({'folder': self.folder, 'folders': self.folders}, f)
+        return output
+
+    @classmethod
+    def loading(cls, path):
+        """
+        loads a saved index. After this the run folder of the index is not scanned again
+        Args:
+            path: path of the json file written by saving
+
+        Returns: FolderIndex of the saved run folder
+
+        """
+        with open(path) as f:
+            saved = json.load(f)
+        if 'folder' not in saved or 'folders' not in saved:
+            print("This is not a saved scan of a folder. please check", path)
+            sys.exit(1)
+        cls.indexes[saved['folder']] = cls(folder=saved['folder'], folders=saved['folders'])
+        return cls.indexes[saved['folder']]
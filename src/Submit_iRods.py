@@ -1,28 +1,33 @@
 """
-Uploading the files in the Yoda/iRods system and adding the metadata
+Uploading the files in the Yoda/iRods system and adding the metadata. Only the parser is built when it is imported,
+the arguments are parsed in main() and the modules of every sub-command (asyncio, multiprocessing, python-irodsclient)
+are only imported when it runs, so --help, scan, validate and plan start without them
 """
 import argparse
-import os
+import sys
 
 import Misc
-import iRodsClass
 from _version import __version__
 parser = argparse.ArgumentParser(description="Uploading the files in the Yoda/iRods system and adding the metadata. "
                                              "You need to login first using iinit")
 parser.add_argument('-v', '--version', action='version',
                     version='catch-all {version}'.format(version=__version__))
 subparsers = parser.add_subparsers(help='sub-commands help')
-sp = subparsers.add_parser('fastq', help='Uploading the fastq files. For now only works for pair end Illumina'
-                                         'genome sequences')
+sp = subparsers.add_parser('fastq', help='Uploading the fastq files of Illumina genome sequences. Single-end and '
+                                         'pair end runs, index reads (I1, I2) and runs split into chunks')
 sp.set_defaults(cmd='fastq')
 sp.add_argument('xlsx', help="Path of the metadata info excel sheet that is generated. check "
                              "https://github.com/ikmb/data-management/scripts/metadata_set_table_from_lims.rb for more "
                              "information on excel sheet. Mainly it will read Metadata sheet in excel file. Metadata "
                              "sheet should have information in rows. first row is units, second row attribute name"
-                             "and everything else is values needed for irods to be uploaded",
-                type=lambda x: Misc.args_valid_file(parser, x))
+                             "and everything else is values needed for irods to be uploaded. A csv or tsv file with "
+                             "the same layout can be used as well. Many sheets are planned and uploaded as one batch",
+                type=lambda x: Misc.args_valid_file(parser, x), nargs='*')
+sp.add_argument('--manifest', help="File with a Metadata sheet on every line, optionally followed by a tab and its "
+                                   "irods folder and a tab and its local folder (default --ifolder and --folder). Its "
+                                   "sheets are added to the batch", type=lambda x: Misc.args_valid_file(parser, x))
 sp.add_argument('--ifolder', help="The abs path of irods folder. Please do not upload relative "
-                                  "path", required=True)
+                                  "path. Needed unless every line of --manifest has one")
 sp.add_argument('--folder', help="The path of the folder where fastq is present in locally. default is "
                                  "current working directory")
 sp.add_argument('--upload',
@@ -32,6 +37,79 @@ sp.add_argument('--meta',
                 help='By default it will upload and add the meta data. But you can run it separately. If --meta is '
                      'used it will remove the previously uploaded files metadata and add new meta data. Only use'
                      'after --upload', action="store_true")
+sp.add_argument('--sync',
+                help='Like --meta but the metadata of every uploaded file is read first and only the metadata which '
+                     'changed in the excel sheet is removed and added. Only use after --upload', action="store_true")
+sp.add_argument('--verify', help='Check every file against its .md5 file before uploading. The run stops if any of '
+                                   'them does not match', action="store_true")
+sp.add_argument('--md5-report', help='Report of --verify. Files with the same size and modification time in the '
+                                     'report are not hashed again. default is md5_report.tsv', default='md5_report.tsv')
+sp.add_argument('--validation-report', help='Report of the validation of the whole sheet, which is done before '
+                                            'planning. All the problems of all the rows are written in it. default is '
+                                            'validation_report.tsv', default='validation_report.tsv')
+sp.add_argument('--scan', help='Saved index of the local folder (check the scan sub-command). By default the folder '
+                                 'is scanned once at the start')
+sp.add_argument('--batch-meta', help='Send all the metadata of a file in one imeta call instead of one imeta call '
+                                     'per attribute', action="store_true")
+sp.add_argument('--collection-meta', help='sample: add the metadata which is the same on all the files of a sample '
+                                          'once to the sample collection. project: and the metadata which is the same '
+                                          'in the whole sheet once to --ifolder (needs --preflight or '
+                                          '--preflight-catalog). Only the file specific metadata (pair_end_read, '
+                                          'flowcell lane) stays on the files. Check the resolve sub-command',
+                choices=['sample', 'project'])
+sp.add_argument('--threads', help='Number of transfer threads (irsync -N) for files of at least --large-file MB. '
+                                  'default is 0, the irods server decides', type=int, default=0)
+sp.add_argument('--large-file', help='Size in MB from which a file is sent with --threads. default is 1024', type=int,
+                default=1024)
+sp.add_argument('--bulk-small', help='Upload the small files of a folder (.md5, .crai) in one bulk iput instead of one '
+                                     'transfer per file', action="store_true")
+sp.add_argument('--trusted-md5', help='Trust the .md5 files: upload with a checksum calculated by the server (iput -k) '
+                                      'instead of irsync -K and compare it with the .md5 file. Files which are already '
+                                      'in irods with the same checksum are not uploaded again', action="store_true")
+sp.add_argument('--preflight', help='Query everything which is already in --ifolder once before planning (iquest). '
+                                    'Files which are already in irods with the same size and checksum are not uploaded '
+                                    'and existing collections are not created again', action="store_true")
+sp.add_argument('--backend', help='How the commands are run. shell: every command is run with the icommands (default). '
+                                  'native: the commands are run in process with python-irodsclient over a pool of '
+                                  'reusable sessions', choices=['shell', 'native'], default='shell')
+sp.add_argument('--irods-env', help='irods environment file for the native backend. default is '
+                                    '~/.irods/irods_environment.json')
+sp.add_argument('--journal', help='Journal of the finished uploads and metadata. A restarted run skips everything '
+                                    'which is already done. default is upload_journal.sqlite',
+                default='upload_journal.sqlite')
+sp.add_argument('--force', help='Do not skip anything which is done according to the journal', action="store_true")
+sp.add_argument('--catalog', help='Local mirror of the uploaded data objects and their metadata. It is updated as soon '
+                                  'as a sample is finished (check the query and reconcile sub-commands). default is '
+                                  'irods_catalog.sqlite', default='irods_catalog.sqlite')
+sp.add_argument('--preflight-catalog', help='Same as --preflight but from --catalog, without any query to the irods '
+                                            'server. Run reconcile first if others change --ifolder too',
+                action="store_true")
+sp.add_argument('--pipeline', help='Run the samples in a pipeline of three stages: --verify (if it is used), upload '
+                                   'and metadata. The metadata of a sample is added while the next samples are still '
+                                   'uploaded', action="store_true")
+sp.add_argument('--meta-jobs', help='Number of samples whose metadata is added at the same time with --pipeline. '
+                                    'default is --jobs', type=int)
+sp.add_argument('--max-inflight', help='Maximum GB of the samples in the --pipeline which are not uploaded yet. '
+                                       'default is 0, no limit', type=float, default=0)
+sp.add_argument('--timing-log', help='Json lines file where the timing of every operation is written. A summary is '
+                                     'printed at the end of the run. default is timing.jsonl', default='timing.jsonl')
+sp.add_argument('--dry-run', help='Only print the planned operations of every sample (mkdir, put, meta-set, '
+                                  'meta-remove). Nothing is run and no shell script is written', action='store_true')
+sp.add_argument('--watch', help='Keep running and upload every sample as soon as its folder in --folder is complete '
+                                'and did not change for --settle seconds, instead of the whole sheet at once. The '
+                                'sheet is loaded again when it changes. Ctrl-C to stop', action='store_true')
+sp.add_argument('--interval', help='Seconds between two checks of --folder in --watch mode. default is 60', type=float,
+                default=60)
+sp.add_argument('--settle', help='Seconds the files of a sample folder have to stay the same before it is uploaded in '
+                                 '--watch mode. default is 300', type=float, default=300)
+sp.add_argument('--jobs', help='Number of samples which are uploaded at the same time. default is 1', type=int,
+                default=1)
+sp.add_argument('--adaptive', help='--jobs (and --meta-jobs) is only the maximum. The number of irods calls running at '
+                                   'the same time starts at 1, grows while the iCAT server answers as fast as before '
+                                   'and is cut in half when it slows down or a call fails with a transient error. '
+                                   'Transient failures are tried again after a random back-off', action='store_true')
+sp.add_argument('--retries', help='Number of times a call with a transient error is tried again with --adaptive. '
+                                  'default is 3', type=int, default=3)
 sp = subparsers.add_parser('cram', help='Uploading the cram files. ')
 sp.set_defaults(cmd='cram')
 sp.add_argument('xlsx', help="Path of the metadata info excel sheet that is generated. check "
@@ -39,10 +117,14 @@ sp.add_argument('xlsx', help="Path of the metadata info excel sheet that is gene
                              "information on excel sheet. Mainly it will read Metadata sheet in excel file. Metadata "
                              "sheet should have information in rows. first row is units, second row attribute name"
                              "and everything else is values needed for irods to be uploaded. with the by default xlsx "
-                             "file, particularly for cram fasta is mandatory",
-                type=lambda x: Misc.args_valid_file(parser, x))
+                             "file, particularly for cram fasta is mandatory. A csv or tsv file with the same layout "
+                             "can be used as well. Many sheets are planned and uploaded as one batch",
+                type=lambda x: Misc.args_valid_file(parser, x), nargs='*')
+sp.add_argument('--manifest', help="File with a Metadata sheet on every line, optionally followed by a tab and its "
+                                   "irods folder and a tab and its local folder (default --ifolder and --folder). Its "
+                                   "sheets are added to the batch", type=lambda x: Misc.args_valid_file(parser, x))
 sp.add_argument('--ifolder', help="The abs path of irods folder. Please do not upload relative "
-                                  "path", required=True)
+                                  "path. Needed unless every line of --manifest has one")
 sp.add_argument('--folder', help="The path of the folder where fastq is present in locally. default is "
                                  "current working directory")
 sp.add_argument('--upload',
@@ -52,33 +134,452 @@ sp.add_argument('--meta',
                 help='By default it will upload and add the meta data. But you can run it separately. If --meta is '
                      'used it will remove the previously uploaded files metadata and add new meta data. Only use'
                      'after --upload', action="store_true")
-args = parser.parse_args()
-if __name__ == "__main__":
-    if args.cmd == "fastq":
-        commands = iRodsClass.UploadFastq.main(metadata=args.xlsx, ifolder=args.ifolder, folder=args.folder,
-                                               upload=args.upload, meta=args.meta)
-        Misc.creatingfolders("shfiles")
-        if args.upload:
-            prefix = "upload"
-        elif args.meta:
-            prefix = "meta"
+sp.add_argument('--sync',
+                help='Like --meta but the metadata of every uploaded file is read first and only the metadata which '
+                     'changed in the excel sheet is removed and added. Only use after --upload', action="store_true")
+sp.add_argument('--verify', help='Check every file against its .md5 file before uploading. The run stops if any of '
+                                   'them does not match', action="store_true")
+sp.add_argument('--md5-report', help='Report of --verify. Files with the same size and modification time in the '
+                                     'report are not hashed again. default is md5_report.tsv', default='md5_report.tsv')
+sp.add_argument('--validation-report', help='Report of the validation of the whole sheet, which is done before '
+                                            'planning. All the problems of all the rows are written in it. default is '
+                                            'validation_report.tsv', default='validation_report.tsv')
+sp.add_argument('--scan', help='Saved index of the local folder (check the scan sub-command). By default the folder '
+                                 'is scanned once at the start')
+sp.add_argument('--batch-meta', help='Send all the metadata of a file in one imeta call instead of one imeta call '
+                                     'per attribute', action="store_true")
+sp.add_argument('--collection-meta', help='sample: add the metadata which is the same on all the files of a sample '
+                                          'once to the sample collection. project: and the metadata which is the same '
+                                          'in the whole sheet once to --ifolder (needs --preflight or '
+                                          '--preflight-catalog). Only the file specific metadata (pair_end_read, '
+                                          'flowcell lane) stays on the files. Check the resolve sub-command',
+                choices=['sample', 'project'])
+sp.add_argument('--threads', help='Number of transfer threads (irsync -N) for files of at least --large-file MB. '
+                                  'default is 0, the irods server decides', type=int, default=0)
+sp.add_argument('--large-file', help='Size in MB from which a file is sent with --threads. default is 1024', type=int,
+                default=1024)
+sp.add_argument('--bulk-small', help='Upload the small files of a folder (.md5, .crai) in one bulk iput instead of one '
+                                     'transfer per file', action="store_true")
+sp.add_argument('--trusted-md5', help='Trust the .md5 files: upload with a checksum calculated by the server (iput -k) '
+                                      'instead of irsync -K and compare it with the .md5 file. Files which are already '
+                                      'in irods with the same checksum are not uploaded again', action="store_true")
+sp.add_argument('--preflight', help='Query everything which is already in --ifolder once before planning (iquest). '
+                                    'Files which are already in irods with the same size and checksum are not uploaded '
+                                    'and existing collections are not created again', action="store_true")
+sp.add_argument('--backend', help='How the commands are run. shell: every command is run with the icommands (default). '
+                                  'native: the commands are run in process with python-irodsclient over a pool of '
+                                  'reusable sessions', choices=['shell', 'native'], default='shell')
+sp.add_argument('--irods-env', help='irods environment file for the native backend. default is '
+                                    '~/.irods/irods_environment.json')
+sp.add_argument('--journal', help='Journal of the finished uploads and metadata. A restarted run skips everything '
+                                    'which is already done. default is upload_journal.sqlite',
+                default='upload_journal.sqlite')
+sp.add_argument('--force', help='Do not skip anything which is done according to the journal', action="store_true")
+sp.add_argument('--catalog', help='Local mirror of the uploaded data objects and their metadata. It is updated as soon '
+                                  'as a sample is finished (check the query and reconcile sub-commands). default is '
+                                  'irods_catalog.sqlite', default='irods_catalog.sqlite')
+sp.add_argument('--preflight-catalog', help='Same as --preflight but from --catalog, without any query to the irods '
+                                            'server. Run reconcile first if others change --ifolder too',
+                action="store_true")
+sp.add_argument('--pipeline', help='Run the samples in a pipeline of three stages: --verify (if it is used), upload '
+                                   'and metadata. The metadata of a sample is added while the next samples are still '
+                                   'uploaded', action="store_true")
+sp.add_argument('--meta-jobs', help='Number of samples whose metadata is added at the same time with --pipeline. '
+                                    'default is --jobs', type=int)
+sp.add_argument('--max-inflight', help='Maximum GB of the samples in the --pipeline which are not uploaded yet. '
+                                       'default is 0, no limit', type=float, default=0)
+sp.add_argument('--timing-log', help='Json lines file where the timing of every operation is written. A summary is '
+                                     'printed at the end of the run. default is timing.jsonl', default='timing.jsonl')
+sp.add_argument('--dry-run', help='Only print the planned operations of every sample (mkdir, put, meta-set, '
+                                  'meta-remove). Nothing is run and no shell script is written', action='store_true')
+sp.add_argument('--watch', help='Keep running and upload every sample as soon as its folder in --folder is complete '
+                                'and did not change for --settle seconds, instead of the whole sheet at once. The '
+                                'sheet is loaded again when it changes. Ctrl-C to stop', action='store_true')
+sp.add_argument('--interval', help='Seconds between two checks of --folder in --watch mode. default is 60', type=float,
+                default=60)
+sp.add_argument('--settle', help='Seconds the files of a sample folder have to stay the same before it is uploaded in '
+                                 '--watch mode. default is 300', type=float, default=300)
+sp.add_argument('--jobs', help='Number of samples which are uploaded at the same time. default is 1', type=int,
+                default=1)
+sp.add_argument('--adaptive', help='--jobs (and --meta-jobs) is only the maximum. The number of irods calls running at '
+                                   'the same time starts at 1, grows while the iCAT server answers as fast as before '
+                                   'and is cut in half when it slows down or a call fails with a transient error. '
+                                   'Transient failures are tried again after a random back-off', action='store_true')
+sp.add_argument('--retries', help='Number of times a call with a transient error is tried again with --adaptive. '
+                                  'default is 3', type=int, default=3)
+sp = subparsers.add_parser('scan', help='Scanning the local folder once and saving the index of its sample folders and '
+                                        'files. It can be given to fastq or cram with --scan, so the folder is not '
+                                        'scanned again')
+sp.set_defaults(cmd='scan')
+sp.add_argument('--folder', help="The path of the folder where fastq or cram is present in locally. default is "
+                                 "current working directory")
+sp.add_argument('--output', help="Path of the saved index. default is scan.json", default='scan.json')
+sp = subparsers.add_parser('validate', help='Validating the whole Metadata sheet against the local folder (sample '
+                                            'folders, files, .md5 files, mandatory columns, repeated sample names). '
+                                            'Nothing is planned or uploaded. It exits with 1 if there is any error')
+sp.set_defaults(cmd='validate')
+sp.add_argument('xlsx', help="Path of the metadata info excel sheet (or csv, tsv)",
+                type=lambda x: Misc.args_valid_file(parser, x))
+sp.add_argument('--kind', help='fastq or cram. default is fastq', choices=['fastq', 'cram'], default='fastq')
+sp.add_argument('--ifolder', help="The abs path of irods folder. It is only checked to be absolute")
+sp.add_argument('--folder', help="The path of the folder where fastq or cram is present in locally. default is "
+                                 "current working directory")
+sp.add_argument('--scan', help='Saved index of the local folder (check the scan sub-command)')
+sp.add_argument('--upload', help='Only check what is needed for the upload, not the metadata', action="store_true")
+sp.add_argument('--validation-report', help='Report of all the problems. default is validation_report.tsv',
+                default='validation_report.tsv')
+sp.add_argument('--jobs', help='Number of rows which are checked at the same time. default is 1', type=int,
+                default=1)
+sp = subparsers.add_parser('plan', help='Printing the planned operations of every sample (mkdir, put, meta-set, '
+                                        'meta-remove) or with --shell their shell commands. The parsed sheet is '
+                                        'cached beside it, so a second plan of the same sheet does not read it again. '
+                                        'Nothing is run')
+sp.set_defaults(cmd='plan')
+sp.add_argument('xlsx', help="Path of the metadata info excel sheet (or csv, tsv)",
+                type=lambda x: Misc.args_valid_file(parser, x))
+sp.add_argument('--kind', help='fastq or cram. default is fastq', choices=['fastq', 'cram'], default='fastq')
+sp.add_argument('--ifolder', help="The abs path of irods folder", required=True)
+sp.add_argument('--folder', help="The path of the folder where fastq or cram is present in locally. default is "
+                                 "current working directory")
+sp.add_argument('--scan', help='Saved index of the local folder (check the scan sub-command)')
+sp.add_argument('--upload', help='Only plan the upload', action="store_true")
+sp.add_argument('--meta', help='Only plan the metadata', action="store_true")
+sp.add_argument('--batch-meta', help='One imeta call for all the metadata of a file', action="store_true")
+sp.add_argument('--collection-meta', help='Add the shared metadata to the sample collection (sample) and to --ifolder '
+                                          '(project)', choices=['sample', 'project'])
+sp.add_argument('--threads', help='Number of transfer threads for files of at least --large-file MB. default is 0',
+                type=int, default=0)
+sp.add_argument('--large-file', help='Size in MB from which a file is sent with --threads. default is 1024', type=int,
+                default=1024)
+sp.add_argument('--bulk-small', help='Upload the small files of a folder in one bulk iput', action="store_true")
+sp.add_argument('--trusted-md5', help='Upload with a checksum calculated by the server (iput -k)',
+                action="store_true")
+sp.add_argument('--shell', help='Print the shell commands of every sample instead of the operations',
+                action="store_true")
+sp.add_argument('--validation-report', help='Report of the validation of the whole sheet. default is '
+                                            'validation_report.tsv', default='validation_report.tsv')
+
+sp = subparsers.add_parser('query', help='Finding the data objects by their metadata in the local mirror of the '
+                                         'catalog (--catalog of fastq and cram), without any query to the irods server')
+sp.set_defaults(cmd='query')
+sp.add_argument('--catalog', help='Local mirror of the catalog. default is irods_catalog.sqlite',
+                default='irods_catalog.sqlite')
+sp.add_argument('--where', help='attribute=value the data objects have. %% in the value matches anything. It can be '
+                                'used more than once, e.g. --where "project name=X" --where "tax id=9606"',
+                action='append', default=[])
+sp.add_argument('--ifolder', help='Only the data objects under this irods folder')
+sp.add_argument('--avus', help='Print all the metadata of every data object', action="store_true")
+sp.add_argument('--samples', help='Print the samples (the collections of the data objects) instead of the data objects',
+                action="store_true")
+sp = subparsers.add_parser('reconcile', help='Replacing the local mirror of --ifolder with what is in irods now, with '
+                                             'one bulk query (iquest or python-irodsclient)')
+sp.set_defaults(cmd='reconcile')
+sp.add_argument('--ifolder', help="The abs path of irods folder", required=True)
+sp.add_argument('--catalog', help='Local mirror of the catalog. default is irods_catalog.sqlite',
+                default='irods_catalog.sqlite')
+sp.add_argument('--backend', help='shell (iquest, default) or native (python-irodsclient)', choices=['shell', 'native'],
+                default='shell')
+sp.add_argument('--irods-env', help='irods environment file for the native backend. default is '
+                                    '~/.irods/irods_environment.json')
+sp = subparsers.add_parser('resolve', help='Printing the effective metadata of a data object: its own metadata merged '
+                                           'over the metadata of its collections (--collection-meta), with where every '
+                                           'attribute comes from')
+sp.set_defaults(cmd='resolve')
+sp.add_argument('ipath', help="The abs path of the irods data object")
+sp.add_argument('--catalog', help='Resolve it from this local mirror of the catalog instead of asking the irods server')
+sp.add_argument('--backend', help='shell (imeta, default) or native (python-irodsclient)', choices=['shell', 'native'],
+                default='shell')
+sp.add_argument('--irods-env', help='irods environment file for the native backend. default is '
+                                    '~/.irods/irods_environment.json')
+
+
+def run_commands(commands, args, timing=None):
+    """
+    runs the commands of all the samples with the backend chosen in the command line and exits with 1 if any of the
+    samples failed
+    Args:
+        commands: dict of sample name and its typed operations. output of UploadFastq.main or UploadCram.main with
+        operations=True. With --sync the dict of sample name and the metadata of its data objects
+        args: the parsed command line arguments
+        timing: Timing.TimingLog where the timing of every operation is written and which summary is printed at the end
+    """
+    import Catalog
+    import Executor
+    import Plan
+    import Sync
+    if args.dry_run:
+        if args.sync:
+            print(f'dry-run: the metadata of {sum(len(commands[name]) for name in commands)} data objects of '
+                  f'{len(commands)} samples would be synced. nothing was run')
         else:
-            prefix = "all"
-        _ = [Misc.writing_bylines4mlist([commands[name]], output=f'shfiles/{prefix}_{name}.sh') for name in commands]
-        for name in commands:
-            os.system(f'sh shfiles/{prefix}_{name}.sh')
-            print(f'{prefix} {name} is done')
-    elif args.cmd == "cram":
-        commands = iRodsClass.UploadCram.main(metadata=args.xlsx, ifolder=args.ifolder, folder=args.folder,
-                                               upload=args.upload, meta=args.meta)
-        Misc.creatingfolders("shfiles")
-        if args.upload:
-            prefix = "upload"
-        elif args.meta:
-            prefix = "meta"
+            Plan.printing(operations=commands)
+        return
+    if args.sync:
+        limiter = limiting(args=args, maximum=args.jobs)
+        exit_codes, counts = Sync.MetadataSync.main(avus=commands, jobs=args.jobs, backend=args.backend,
+                                                    irods_env=args.irods_env, timing=timing, limiter=limiter)
+        Sync.MetadataSync.report(counts=counts)
+        if limiter is not None:
+            limiter.report()
+        catalog = Catalog.CatalogMirror(path=args.catalog)
+        catalog.syncing(avus=commands, exit_codes=exit_codes)
+        catalog.close()
+        if timing is not None:
+            timing.summary()
+        if Executor.ShellExecutor.report(exit_codes=exit_codes, prefix="sync"):
+            sys.exit(1)
+        return
+    prefix = "upload" if args.upload else "meta" if args.meta else "all"
+    exit_codes = executing(commands=commands, args=args, timing=timing)
+    if timing is not None:
+        timing.summary()
+    if Executor.ShellExecutor.report(exit_codes=exit_codes, prefix=prefix):
+        sys.exit(1)
+
+
+def executing(commands, args, timing=None):
+    """
+    runs the typed operations of the samples with the journal and the backend chosen in the command line
+    Args:
+        commands: dict of sample name and its typed operations
+        args: the parsed command line arguments
+        timing: Timing.TimingLog where the timing of every operation is written
+
+    Returns: dict of sample name and exit code
+
+    """
+    import Catalog
+    import Executor
+    import Journal
+    prefix = "upload" if args.upload else "meta" if args.meta else "all"
+    journal = Journal.UploadJournal(path=args.journal, force=args.force)
+    commands = journal.pending(commands=commands, prefix=prefix)
+    # the preflight already removed the files which are in irods. Without it, a trusted upload can only be in irods if
+    # an earlier run died halfway
+    precheck = journal.resuming() and (args.watch or not (args.preflight or args.preflight_catalog))
+    catalog = Catalog.CatalogMirror(path=args.catalog)
+    catalog.planning(commands=commands)
+
+    def recording(name, exit_code):
+        journal.record(name, exit_code)
+        catalog.record(name, exit_code)
+    if args.pipeline:
+        import Pipeline
+        limiter = limiting(args=args, maximum=args.jobs + (args.meta_jobs or args.jobs))
+        exit_codes = Pipeline.PipelineExecutor.main(commands=commands, prefix=prefix, verify_jobs=args.jobs,
+                                                    transfer_jobs=args.jobs, meta_jobs=args.meta_jobs or args.jobs,
+                                                    max_bytes=int(args.max_inflight * 1024 ** 3), verify=args.verify,
+                                                    backend=args.backend, irods_env=args.irods_env,
+                                                    on_done=recording, timing=timing, limiter=limiter,
+                                                    md5_report=args.md5_report, precheck=precheck)
+    elif args.backend == "native":
+        limiter = limiting(args=args, maximum=args.jobs)
+        exit_codes = Executor.NativeExecutor.main(commands=commands, prefix=prefix, jobs=args.jobs,
+                                                  irods_env=args.irods_env, on_done=recording, timing=timing,
+                                                  limiter=limiter)
+    else:
+        limiter = limiting(args=args, maximum=args.jobs)
+        exit_codes = Executor.ShellExecutor.main(commands=commands, prefix=prefix, jobs=args.jobs,
+                                                 on_done=recording, timing=timing, limiter=limiter, precheck=precheck)
+    journal.close()
+    catalog.close()
+    if limiter is not None:
+        limiter.report()
+    return exit_codes
+
+
+def limiting(args, maximum):
+    """
+    Args:
+        args: the parsed command line arguments
+        maximum: the highest number of irods calls at the same time
+
+    Returns: Adaptive.ConcurrencyLimiter with --adaptive, None otherwise
+
+    """
+    if not args.adaptive:
+        return None
+    import Adaptive
+    return Adaptive.ConcurrencyLimiter(maximum=maximum, retries=args.retries)
+
+
+def watching(uploader, args, timing=None):
+    """
+    the watch mode of fastq and cram. check Watch.py
+    Args:
+        uploader: iRodsClass.UploadFastq or iRodsClass.UploadCram
+        args: the parsed command line arguments
+        timing: Timing.TimingLog where the timing of every operation is written
+    """
+    import Plan
+    import Watch
+    if args.meta or args.sync:
+        print("--watch uploads the new samples. It can not be used with --meta or --sync")
+        sys.exit(1)
+    if args.collection_meta == 'project':
+        print("--watch only sees the samples which are ready, not the whole project. Please use --collection-meta "
+              "sample")
+        sys.exit(1)
+    if len(args.xlsx) != 1 or args.manifest or not args.ifolder:
+        print("--watch needs a single Metadata sheet and --ifolder")
+        sys.exit(1)
+
+    def running(operations):
+        if args.dry_run:
+            Plan.printing(operations=operations)
+            return {}
+        return executing(commands=operations, args=args, timing=timing)
+
+    Watch.FolderWatcher.main(uploader=uploader, metadata=args.xlsx[0], ifolder=args.ifolder, running=running,
+                             folder=args.folder, upload=args.upload, batch_meta=args.batch_meta,
+                             verify=args.verify and not args.pipeline, interval=args.interval, settle=args.settle,
+                             transfer={'threads': args.threads, 'large_file': args.large_file * 1024 * 1024,
+                                       'bulk_small': args.bulk_small, 'trusted_md5': args.trusted_md5},
+                             collection_meta=args.collection_meta == 'sample', jobs=args.jobs,
+                             md5_report=args.md5_report)
+    if timing is not None:
+        timing.summary()
+
+
+def planning(args):
+    """
+    the validate and plan sub-commands. They only read the sheet (or its cache) and the local folder, so neither the
+    executors nor the irods modules are imported
+    Args:
+        args: the parsed command line arguments
+    """
+    import MetaSheet
+    import Plan
+    import Scan
+    import Validate
+    import iRodsClass
+    uploader = iRodsClass.UploadFastq if args.kind == "fastq" else iRodsClass.UploadCram
+    if args.cmd == "validate":
+        if args.scan:
+            Scan.FolderIndex.loading(args.scan)
+        Validate.SheetValidator.main(sheet=MetaSheet.MetadataSheet.loading(args.xlsx), uploader=uploader,
+                                     ifolder=args.ifolder, folder=args.folder, upload=args.upload, jobs=args.jobs,
+                                     report=args.validation_report)
+        return
+    operations = uploader.main(metadata=args.xlsx, ifolder=args.ifolder, folder=args.folder, upload=args.upload,
+                               meta=args.meta, batch_meta=args.batch_meta, scan=args.scan,
+                               validation_report=args.validation_report, threads=args.threads,
+                               large_file=args.large_file * 1024 * 1024, bulk_small=args.bulk_small,
+                               trusted_md5=args.trusted_md5, operations=True, collection_meta=args.collection_meta)
+    if args.shell:
+        import Executor
+        for name in operations:
+            print(f'# {name}')
+            print(Executor.ShellExecutor.script(operations[name]))
+    else:
+        Plan.printing(operations=operations)
+
+
+def cataloging(args):
+    """
+    the query, reconcile and resolve sub-commands of the local mirror of the catalog. check Catalog.py. resolve asks
+    the irods server if no --catalog is given (check Inherit.py)
+    Args:
+        args: the parsed command line arguments
+    """
+    import Catalog
+    if args.cmd == "resolve":
+        if args.catalog:
+            catalog = Catalog.CatalogMirror(path=args.catalog)
+            avus = catalog.resolving(ipath=args.ipath)
+            catalog.close()
         else:
-            prefix = "all"
-        _ = [Misc.writing_bylines4mlist([commands[name]], output=f'shfiles/{prefix}_{name}.sh') for name in commands]
-        for name in commands:
-            os.system(f'sh shfiles/{prefix}_{name}.sh')
-            print(f'{prefix} {name} is done')
\ No newline at end of file
+            import Inherit
+            avus = Inherit.InheritedMetadata.resolving(ipath=args.ipath, backend=args.backend,
+                                                        irods_env=args.irods_env)
+        for attribute, value, units, source in avus:
+            print(f'{attribute}\t{value}\t{units}\t{source}')
+        print(f'resolve: {len(avus)} AVUs, {sum(1 for avu in avus if avu[3] != args.ipath)} of them from the '
+              f'collections')
+        return
+    catalog = Catalog.CatalogMirror(path=args.catalog)
+    if args.cmd == "reconcile":
+        catalog.reconciling(ifolder=args.ifolder, backend=args.backend, irods_env=args.irods_env)
+        catalog.close()
+        return
+    conditions = []
+    for where in args.where:
+        if "=" not in where:
+            print(f"--where {where} is not attribute=value")
+            sys.exit(1)
+        conditions.append(tuple(where.split("=", 1)))
+    found = catalog.querying(conditions=conditions, ifolder=args.ifolder)
+    catalog.close()
+    samples = sorted({path.rsplit("/", 2)[-2] for path in found})
+    for path in samples if args.samples else found:
+        print(path)
+        if args.avus and not args.samples:
+            for attribute, value, units in found[path]:
+                print(f'\t{attribute}\t{value}\t{units}')
+    print(f'query: {len(found)} data objects of {len(samples)} samples')
+
+
+def main(argv=None):
+    """
+    the command line entry point. The modules of a sub-command are imported when it is run
+    Args:
+        argv: list of the command line arguments. default is sys.argv[1:]
+    """
+    args = parser.parse_args(argv)
+    if getattr(args, 'cmd', None) is None:
+        parser.print_help()
+        sys.exit(1)
+    if args.cmd in ("validate", "plan"):
+        planning(args=args)
+    elif args.cmd in ("fastq", "cram") and args.watch:
+        import Timing
+        import iRodsClass
+        timing = Timing.TimingLog(path=args.timing_log)
+        watching(uploader=iRodsClass.UploadFastq if args.cmd == "fastq" else iRodsClass.UploadCram, args=args,
+                 timing=timing)
+        timing.close()
+    elif args.cmd in ("fastq", "cram"):
+        import Batch
+        import Catalog
+        import Remote
+        import Timing
+        import iRodsClass
+        uploader = iRodsClass.UploadFastq if args.cmd == "fastq" else iRodsClass.UploadCram
+        entries = Batch.SheetBatch.reading_entries(sheets=args.xlsx, manifest=args.manifest, ifolder=args.ifolder,
+                                                   folder=args.folder)
+        if args.collection_meta == 'project' and not (args.preflight or args.preflight_catalog):
+            print("--collection-meta project adds metadata to --ifolder, which the samples uploaded before inherit as "
+                  "well. Please use --preflight or --preflight-catalog, so the metadata already on --ifolder is kept")
+            sys.exit(1)
+        timing = Timing.TimingLog(path=args.timing_log)
+        remotes = {}
+        catalog = Catalog.CatalogMirror(path=args.catalog) if args.preflight_catalog else None
+        for ifolder in dict.fromkeys(ifolder for sheet, ifolder, folder in entries):
+            if catalog is not None:
+                remotes[ifolder] = catalog.remote_state(ifolder=ifolder)
+            elif args.preflight:
+                remotes[ifolder] = Remote.RemoteState.main(ifolder=ifolder, backend=args.backend,
+                                                           irods_env=args.irods_env)
+        if catalog is not None:
+            catalog.close()
+        commands = Batch.SheetBatch.main(uploader=uploader, entries=entries, remotes=remotes,
+                                         validation_report=args.validation_report, upload=args.upload, meta=args.meta,
+                                         batch_meta=args.batch_meta, sync=args.sync,
+                                         verify=args.verify and not args.pipeline, jobs=args.jobs,
+                                         md5_report=args.md5_report, scan=args.scan, threads=args.threads,
+                                         large_file=args.large_file * 1024 * 1024, bulk_small=args.bulk_small,
+                                         trusted_md5=args.trusted_md5, timing=timing, operations=True,
+                                         collection_meta=args.collection_meta)
+        run_commands(commands=commands, args=args, timing=timing)
+        timing.close()
+    elif args.cmd in ("query", "reconcile", "resolve"):
+        cataloging(args=args)
+    elif args.cmd == "scan":
+        import Scan
+        index = Scan.FolderIndex.scanning(args.folder)
+        print(f'{len(index.folders)} sample folders of {index.folder} are saved in',
+              index.saving(output=args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+Updating only the metadata which changed. --meta removes every attribute with imeta rmw and adds all of them again, even
+if only one column changed in the excel sheet. Here the metadata (AVUs) of every data object is read once, compared
+with the metadata it should have and only the difference is removed and added
+"""
+import subprocess
+import time
+from functools import partial
+
+import Adaptive
+import Executor
+import Misc
+
+
+class MetadataSync:
+    """
+    This class will sync the metadata of the uploaded files with the excel sheet. It works with the shell (imeta) and
+    the native (python-irodsclient) backend
+    """
+
+    @classmethod
+    def main(cls, avus, jobs=1, backend="shell", irods_env=None, session_factory=None, timing=None, limiter=None):
+        """
+        The main wrapper to sync the metadata of all the samples. Every sample is a job on the bounded pool of workers
+        and the log of every sample is written in shfiles/sync_<name>.log
+        Args:
+            avus: dict of sample name and the dict of irods data object path and its list of (attribute, value, unit).
+            Output of UploadFastq.main or UploadCram.main with sync=True
+            jobs: number of samples which are synced at the same time
+            backend: shell or native. check Executor.py
+            irods_env: path of the irods environment file for the native backend
+            session_factory: callable returning a new session for the native backend. by default an iRODSSession
+            timing: Timing.TimingLog where the timing of every data object is written. None for no timing
+            limiter: Adaptive.ConcurrencyLimiter which limits the data objects synced at the same time and tries the
+            transient failures again. None for no limit and no retries
+
+        Returns: dict of sample name and exit code and dict of sample name and the number of AVUs which are added,
+        removed, modified and unchanged
+
+        """
+        Misc.creatingfolders("shfiles")
+        counts = {}
+        pool = None
+        if backend == "native":
+            session_factory = session_factory or Executor.NativeExecutor.irods_session_factory(irods_env=irods_env)
+            pool = Executor.SessionPool(session_factory=session_factory, size=jobs)
+        jobs_to_run = {name: partial(cls.sync_sample, avus=avus[name], counts=counts.setdefault(name, {}),
+                                     logfile=f'shfiles/sync_{name}.log', pool=pool, name=name, timing=timing,
+                                     limiter=limiter)
+                       for name in avus}
+        try:
+            exit_codes = Executor.ShellExecutor.running_pool(jobs_to_run=jobs_to_run, prefix="sync", jobs=jobs)
+        finally:
+            if pool is not None:
+                pool.close()
+        return exit_codes, counts
+
+    @classmethod
+    def sync_sample(cls, avus, counts, logfile, pool=None, name=None, timing=None, limiter=None):
+        """
+        syncs the metadata of all the data objects of a single sample. It stops at the first failing data object
+        Args:
+            avus: dict of irods data object path and its list of (attribute, value, unit)
+            counts: dict where the number of added, removed, modified and unchanged AVUs are written
+            logfile: log file of the sample
+            pool: Executor.SessionPool for the native backend. None for the shell backend
+            name: sample name for the timing
+            timing: Timing.TimingLog where the timing of every data object is written. None for no timing
+            limiter: Adaptive.ConcurrencyLimiter. None for no limit and no retries
+
+        Returns: the exit code. 0 if everything went fine
+
+        """
+        for key in ('added', 'removed', 'modified', 'unchanged'):
+            counts[key] = 0
+        with open(logfile, 'w') as log:
+            for ipath in avus:
+                start = time.perf_counter()
+                changes = {}
+
+                def attempt():
+                    try:
+                        changes['removes'], changes['adds'] = cls.sync_object(ipath=ipath, desired=avus[ipath],
+                                                                              pool=pool)
+                    except Exception as error:
+                        log.write(f'{ipath}\tfailed\t{error}\n')
+                        return 1, Adaptive.ConcurrencyLimiter.transient_error(error)
+                    return 0, False
+
+                if limiter is None:
+                    exit_code, retries = attempt()[0], 0
+                else:
+                    exit_code, retries = limiter.retrying(op='sync', attempt=attempt, log=log)
+                if timing is not None:
+                    timing.record(sample=name, op='sync', seconds=time.perf_counter() - start, retries=retries,
+                                  status=exit_code, detail=ipath)
+                if exit_code != 0:
+                    return 1
+                removes, adds = changes['removes'], changes['adds']
+                modified = len({avu[0] for avu in removes} & {avu[0] for avu in adds})
+                counts['added'] += len(adds)
+                counts['removed'] += len(removes)
+                counts['modified'] += modified
+                counts['unchanged'] += len(avus[ipath]) - len(adds)
+                log.write(f'{ipath}\tadded {len(adds)}\tremoved {len(removes)}\tmodified {modified}\n')
+        return 0
+
+    @classmethod
+    def sync_object(cls, ipath, desired, pool=None):
+        """
+        reads the metadata of a data object and removes and adds only what differs from the desired metadata
+        Args:
+            ipath: irods data object path
+            desired: list of (attribute, value, unit) the data object should have
+            pool: Executor.SessionPool for the native backend. None for the shell backend
+
+        Returns: list of the removed and list of the added AVUs, as (attribute, value, unit)
+
+        """
+        if pool is None:
+            current = cls.shell_current(ipath)
+        else:
+            with pool.session() as session:
+                obj = session.data_objects.get(ipath)
+                current = [(avu.name, avu.value, avu.units or '') for avu in obj.metadata.items()]
+        removes, adds = cls.diff(current=current, desired=desired)
+        if removes or adds:
+            if pool is None:
+                cls.shell_apply(ipath=ipath, removes=removes, adds=adds)
+            else:
+                with pool.session() as session:
+                    obj = session.data_objects.get(ipath)
+                    stale = [avu for avu in obj.metadata.items() if (avu.name, avu.value, avu.units or '') in removes]
+                    Executor.NativeExecutor.applying_metadata(obj=obj, removes=stale, adds=adds)
+        return removes, adds
+
+    @classmethod
+    def diff(cls, current, desired):
+        """
+        the minimal set of AVUs to be removed and added, so that a data object has the desired metadata. Only the
+        attributes of the desired metadata are looked at, every other metadata of the data object is kept as it is.
+        A modified value is one remove and one add
+        Args:
+            current: list of (attribute, value, unit) the data object has now
+            desired: list of (attribute, value, unit) the data object should have
+
+        Returns: list of (attribute, value, unit) to remove and list of (attribute, value, unit) to add
+
+        """
+        current = [(str(attribute), str(value), str(unit or '')) for attribute, value, unit in current]
+        desired = [(str(attribute), str(value), str(unit or '')) for attribute, value, unit in desired]
+        attributes = {avu[0] for avu in desired}
+        current_set = set(current)
+        desired_set = set(desired)
+        removes = [avu for avu in dict.fromkeys(current) if avu[0] in attributes and avu not in desired_set]
+        adds = [avu for avu in dict.fromkeys(desired) if avu not in current_set]
+        return removes, adds
+
+    @classmethod
+    def shell_current(cls, ipath, flag='-d'):
+        """
+        reads all the metadata of a data object (or collection) with imeta ls
+        Args:
+            ipath: irods data object path
+            flag: -d for a data object, -C for a collection
+
+        Returns: list of (attribute, value, unit)
+
+        """
+        output = subprocess.run(['imeta', 'ls', flag, ipath], capture_output=True, text=True, check=True).stdout
+        avus = []
+        avu = {}
+        for line in output.split("\n"):
+            for key in ('attribute', 'value', 'units'):
+                if line.startswith(f'{key}:'):
+                    avu[key] = line[len(key) + 1:].strip()
+            if 'units' in avu:
+                avus.append((avu.get('attribute', ''), avu.get('value', ''), avu['units']))
+                avu = {}
+        return avus
+
+    @classmethod
+    def shell_apply(cls, ipath, removes, adds):
+        """
+        removes and adds the AVUs of a data object in one imeta call (imeta pipe mode). imeta exits with 0 after quit
+        even if some of the sub-commands failed, so its output is checked for errors as well
+        Args:
+            ipath: irods data object path
+            removes: list of (attribute, value, unit) to remove
+            adds: list of (attribute, value, unit) to add
+        """
+        words = [ipath] + [str(word) for avu in removes + adds for word in avu]
+        unquotable = [word for word in words if '"' in word or "\n" in word]
+        if unquotable:
+            # the pipe mode of imeta has no escaping inside "..."
+            raise ValueError(f'{ipath}: imeta can not sync a value with " or a new line: {unquotable[0]}')
+        lines = [Misc.joinginglistbyspecificstring([operation, '-d', f'"{ipath}"'] +
+                                                   [f'"{word}"' for word in avu if word != ''])
+                 for operation, avus in (('rm', removes), ('add', adds)) for avu in avus]
+        process = subprocess.run(['imeta'], input=Misc.joinginglistbyspecificstring(lines + ['quit'], "\n") + "\n",
+                                 text=True, capture_output=True, check=True)
+        errors = cls.pipe_errors(process.stdout + process.stderr)
+        if errors:
+            raise RuntimeError(f'imeta failed for {ipath}: {"; ".join(errors)}')
+
+    @classmethod
+    def pipe_errors(cls, output):
+        """
+        Args:
+            output: stdout and stderr of imeta in pipe mode
+
+        Returns: list of the lines which are errors of a sub-command. empty list if all of them went fine
+
+        """
+        return [line.strip() for line in output.split("\n") if 'error' in line.lower()]
+
+    @classmethod
+    def report(cls, counts):
+        """
+        prints how many AVUs were touched in total
+        Args:
+            counts: dict of sample name and its counts. output of main
+        """
+        total = {key: sum(count.get(key, 0) for count in counts.values())
+                 for key in ('added', 'removed', 'modified', 'unchanged')}
+        print(f"sync: {total['added'] + total['removed']} AVUs touched. {total['added']} added, {total['removed']} "
+              f"removed ({total['modified']} of them modified) and {total['unchanged']} unchanged")
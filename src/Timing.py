@@ -0,0 +1,142 @@
+"""
+Timing of every operation of a run. Every mkdir, file transfer, imeta call, metadata sync and md5 check is written as
+one json line (timing.jsonl) with its sample, duration, bytes, MB/s, retries and exit code. At the end of the run a
+summary is printed with the p50/p95 duration of every kind of operation and the slowest samples, so a slow night can
+be put down to the disk (checksum), the network (transfer) or the iCAT server (mkdir, imeta, sync)
+"""
+import json
+import os
+import threading
+import time
+
+import Executor
+
+
+class TimingLog:
+    """
+    This class will write the timing of the operations in a json lines file and keep them for the summary of the run.
+    It can be used from many threads at the same time
+    """
+
+    def __init__(self, path='timing.jsonl'):
+        """
+        Args:
+            path: path of the json lines file. The lines of a new run are added at the end. None to only keep them in
+            memory
+        """
+        self.path = path
+        self.run = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.records = []
+        self.lock = threading.Lock()
+        self.file = open(path, 'a') if path else None
+
+    def record(self, sample, op, seconds, size=0, retries=0, status=0, detail=''):
+        """
+        writes the timing of a single operation
+        Args:
+            sample: sample name
+            op: kind of operation. mkdir, transfer, imeta, sync, checksum or the name of the command
+            seconds: duration of the operation
+            size: number of bytes which were transferred or read
+            retries: number of retries of the operation
+            status: exit code of the operation. 0 means it went fine
+            detail: file or data object of the operation
+
+        Returns: the record (dict)
+
+        """
+        record = {'run': self.run, 'sample': sample, 'op': op, 'seconds': round(seconds, 4), 'bytes': size,
+                  'mb_s': round(size / 1e6 / seconds, 2) if size and seconds > 0 else 0.0, 'retries': retries,
+                  'status': status, 'detail': detail}
+        with self.lock:
+            self.records.append(record)
+            if self.file is not None:
+                self.file.write(json.dumps(record) + "\n")
+                self.file.flush()
+        return record
+
+    def recording_command(self, sample, argvs, seconds, status=0, retries=0):
+        """
+        writes the timing of a command of the shell scripts. The kind of operation and the bytes are taken from the
+        command
+        Args:
+            sample: sample name
+            argvs: list of argument lists of the command. output of Executor.ShellExecutor.splitting_commands
+            seconds: duration of the command
+            status: exit code of the command
+            retries: number of retries of the command
+
+        Returns: the record (dict)
+
+        """
+        transfer = Executor.ShellExecutor.transfer_arguments(argvs[0])
+        if transfer:
+            files = transfer[0]
+            size = sum(os.path.getsize(file) for file in files if os.path.exists(file))
+            return self.record(sample=sample, op='transfer', seconds=seconds, size=size, retries=retries,
+                               status=status, detail=" ".join(files))
+        if argvs[0][0] == 'imkdir':
+            return self.record(sample=sample, op='mkdir', seconds=seconds, retries=retries, status=status,
+                               detail=argvs[0][-1])
+        if argvs[0][0] == 'imeta':
+            return self.record(sample=sample, op='imeta', seconds=seconds, retries=retries, status=status,
+                               detail=argvs[0][3] if len(argvs[0]) > 3 else '')
+        return self.record(sample=sample, op=argvs[0][0], seconds=seconds, retries=retries, status=status)
+
+    @classmethod
+    def percentile(cls, values, q):
+        """
+        Args:
+            values: list of numbers
+            q: percentile between 0 and 100
+
+        Returns: the nearest rank percentile. 0 if there are no values
+
+        """
+        if not values:
+            return 0.0
+        values = sorted(values)
+        rank = max(1, -(-len(values) * q // 100))
+        return values[int(rank) - 1]
+
+    def summary(self, slowest=5):
+        """
+        prints the summary of the run. For every kind of operation the number, p50 and p95 duration, bytes and MB/s
+        and the samples which took the longest
+        Args:
+            slowest: number of slowest samples which are printed
+
+        Returns: dict of operation and its summary (count, p50, p95, bytes, mb_s, retries, failed)
+
+        """
+        operations = {}
+        samples = {}
+        for record in self.records:
+            operations.setdefault(record['op'], []).append(record)
+            samples[record['sample']] = samples.get(record['sample'], 0) + record['seconds']
+        summary = {}
+        for op in sorted(operations):
+            records = operations[op]
+            seconds = [record['seconds'] for record in records]
+            size = sum(record['bytes'] for record in records)
+            summary[op] = {'count': len(records), 'p50': self.percentile(seconds, 50),
+                           'p95': self.percentile(seconds, 95), 'bytes': size,
+                           'mb_s': round(size / 1e6 / sum(seconds), 2) if size and sum(seconds) > 0 else 0.0,
+                           'retries': sum(record['retries'] for record in records),
+                           'failed': sum(1 for record in records if record['status'] != 0)}
+        if not summary:
+            return summary
+        print(f'timing: {len(self.records)} operations. check {self.path}')
+        for op in summary:
+            print(f"{op}\t{summary[op]['count']} ops\tp50 {summary[op]['p50']:.2f} s\tp95 {summary[op]['p95']:.2f} s\t"
+                  f"{summary[op]['bytes']} bytes\t{summary[op]['mb_s']} MB/s\t{summary[op]['retries']} retries\t"
+                  f"{summary[op]['failed']} failed")
+        print("slowest samples")
+        for sample in sorted(samples, key=samples.get, reverse=True)[:slowest]:
+            print(f'{sample}\t{samples[sample]:.2f} s')
+        return summary
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,90 @@
+"""
+Size aware planning of the uploads. A 30-100 GB cram and its few KB .md5 file were both sent with the same plain
+irsync. Large files are now sent with several transfer threads (irsync -N) and the small files of a collection
+(.md5, .crai) can be sent together in one bulk upload (iput -b), so they do not pay the setup cost of a transfer each.
+With trusted_md5 the .md5 file beside a file is trusted: the file is uploaded with a checksum calculated by the server
+(iput -k) and only that checksum is compared with the .md5 file, so the file is not hashed on the client again. A file
+whose checksum in irods already matches is not transferred at all (check Executor.ShellExecutor.trusted_transfer)
+"""
+import os
+
+LARGE_FILE = 1024 * 1024 * 1024
+SMALL_FILE = 64 * 1024 * 1024
+
+
+class TransferPlanner:
+    """
+    This class will rewrite the put operations of a Plan.OperationTable depending on the size of the local files
+    """
+
+    @classmethod
+    def main(cls, table, threads=0, large_file=LARGE_FILE, bulk_small=False, small_file=SMALL_FILE,
+             trusted_md5=False):
+        """
+        The main wrapper to plan the transfers. Files of at least large_file bytes get <threads> transfer threads.
+        With bulk_small all the files smaller than small_file of the same collection (which are not sent with threads)
+        are put in one bulk operation, after the other files of the collection
+        Args:
+            table: Plan.OperationTable. It is changed in place
+            threads: number of transfer threads for large files. 0 leaves it to the irods server
+            large_file: size in bytes from which a file is sent with <threads> threads
+            bulk_small: If bulk_small=True small files are uploaded in one bulk operation per collection
+            small_file: size in bytes below which a file is small
+            trusted_md5: If trusted_md5=True every file with a .md5 file beside it is a md5put
+
+        Returns: the same table
+
+        """
+        sizes = {value: os.path.getsize(value) for op, value in zip(table.op, table.value) if op == 'put'}
+        if threads:
+            for index, op in enumerate(table.op):
+                if op == 'put' and sizes[table.value[index]] >= large_file:
+                    table.unit[index] = str(threads)
+        if trusted_md5:
+            for index, op in enumerate(table.op):
+                if op == 'put' and os.path.exists(table.value[index] + '.md5'):
+                    table.op[index] = 'md5put'
+        if bulk_small:
+            cls.bulking(table=table, small=[file for file in sizes if sizes[file] < small_file and
+                                            not (threads and sizes[file] >= large_file)])
+        return table
+
+    @classmethod
+    def bulking(cls, table, small):
+        """
+        replaces the put operations of small files by one bulk operation per collection. The bulk operation is at the
+        place of the last small file of the collection. A collection with only one small file is left as it is
+        Args:
+            table: Plan.OperationTable. It is changed in place
+            small: list of the small local files
+        """
+        small = set(small)
+        collections = {}
+        for index, (op, path, value) in enumerate(zip(table.op, table.path, table.value)):
+            if op == 'put' and value in small:
+                collections.setdefault((table.sample[index], path), []).append(index)
+        remove = set()
+        for indexes in collections.values():
+            if len(indexes) < 2:
+                continue
+            last = indexes[-1]
+            table.op[last] = 'bulk'
+            table.value[last] = tuple(table.value[index] for index in indexes)
+            remove.update(indexes[:-1])
+        if remove:
+            table.keeping([index for index in range(len(table)) if index not in remove])
+
+    @classmethod
+    def throughput(cls, files, seconds):
+        """
+        a line for the log of a sample with the throughput of a transfer
+        Args:
+            files: list of local files which were transferred
+            seconds: duration of the transfer
+
+        Returns: the log line. transfer: <file> <bytes> bytes in <seconds> s (<MB/s> MB/s)
+
+        """
+        size = sum(os.path.getsize(file) for file in files if os.path.exists(file))
+        rate = size / 1e6 / seconds if seconds > 0 else 0.0
+        return f'transfer: {" ".join(files)} {size} bytes in {seconds:.2f} s ({rate:.1f} MB/s)'
@@ -0,0 +1,138 @@
+"""
+Validation of the whole Metadata sheet before anything is planned. The checks used to exit at the first bad row, so a
+sheet with many problems needed as many runs (each loading the sheet and scanning the run folder again). Here every
+row is checked on a pool of workers (folder exists, exact set of files, .md5 files, mandatory columns) together with
+the checks of the whole sheet (repeated sample names, missing columns, relative ifolder) and all the problems are
+given in one report
+"""
+import csv
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import Scan
+
+REPORT_COLUMNS = ['row', 'sample', 'level', 'check', 'message']
+# row of the first sample in the Excel sheet (first row is units, second row attribute names)
+FIRST_ROW = 3
+
+
+class SheetValidator:
+    """
+    This class will check every row of a Metadata sheet and collect all the problems
+    """
+
+    @classmethod
+    def main(cls, sheet, uploader, ifolder, folder=None, upload=False, jobs=1, report='validation_report.tsv'):
+        """
+        The main wrapper to validate the whole sheet. It will print every problem, write them in the report and exit
+        if there is any error. Warnings are only printed
+        Args:
+            sheet: MetaSheet.MetadataSheet
+            uploader: iRodsClass.UploadFastq or iRodsClass.UploadCram. Its validating_row checks a single row
+            ifolder: The abs path of irods folder
+            folder: The path of the local run folder. default is current working directory
+            upload: If upload=True only the upload is checked, not the metadata
+            jobs: number of rows which are checked at the same time
+            report: path of the report (tab separated). None to not write it
+
+        Returns: list of problems (dict with the REPORT_COLUMNS). Only warnings, as it exits on errors
+
+        """
+        problems = cls.validating(sheet=sheet, uploader=uploader, ifolder=ifolder, folder=folder, upload=upload,
+                                  jobs=jobs)
+        if cls.reporting(problems=problems, rows=sheet.samples, report=report):
+            print("Please update the excel sheet (or the run folder) and run it again")
+            sys.exit(1)
+        return problems
+
+    @classmethod
+    def reporting(cls, problems, rows, report='validation_report.tsv'):
+        """
+        prints the problems and writes them in the report, without exiting
+        Args:
+            problems: list of problems (dict with the REPORT_COLUMNS). output of validating
+            rows: number of rows which were checked
+            report: path of the report (tab separated). None to not write it
+
+        Returns: list of the problems which are errors
+
+        """
+        errors = [problem for problem in problems if problem['level'] == 'error']
+        if report and problems:
+            cls.writing_report(problems=problems, report=report)
+        print(f'validation: {rows} rows checked, {len(errors)} errors and {len(problems) - len(errors)} '
+              f'warnings' + (f'. check {report}' if report and problems else ''))
+        for problem in problems:
+            print(f"row {problem['row']}\t{problem['sample']}\t{problem['level']}\t{problem['check']}\t"
+                  f"{problem['message']}")
+        return errors
+
+    @classmethod
+    def validating(cls, sheet, uploader, ifolder, folder=None, upload=False, jobs=1):
+        """
+        runs all the checks without printing or exiting
+        Args:
+            sheet: MetaSheet.MetadataSheet
+            uploader: iRodsClass.UploadFastq or iRodsClass.UploadCram
+            ifolder: The abs path of irods folder. None to not check it
+            folder: The path of the local run folder. default is current working directory
+            upload: If upload=True only the upload is checked, not the metadata
+            jobs: number of rows which are checked at the same time
+
+        Returns: list of problems (dict with the REPORT_COLUMNS), in the order of the rows. Problems of the whole
+        sheet have row 0
+
+        """
+        samples = [str(sample) if sample is not None else '' for sample in sheet.column('sample name')]
+        problems = []
+        if ifolder is not None and not os.path.isabs(ifolder):
+            problems.append(cls.problem(0, '', 'error', 'ifolder',
+                                        f'{ifolder} is not absolute. Please use an absolute path'))
+        for attribute in uploader.REQUIRED:
+            if attribute not in sheet.attributes:
+                problems.append(cls.problem(0, '', 'error', 'column', f'the sheet has no {attribute} column'))
+        counts = Counter(sample for sample in samples if sample)
+        for index, sample in enumerate(samples):
+            if counts[sample] > 1:
+                rows = [str(FIRST_ROW + other) for other in range(len(samples)) if samples[other] == sample]
+                problems.append(cls.problem(FIRST_ROW + index, sample, 'error', 'duplicate',
+                                            f'sample name is repeated in rows {", ".join(rows)}'))
+        # the run folder is scanned once before the workers start
+        Scan.FolderIndex.scanning(folder)
+        rows = uploader.sheet_rows(sheet)
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            results = pool.map(lambda row: uploader.validating_row(row=row, folder=folder, upload=upload), rows)
+            for index, row_problems in enumerate(results):
+                problems.extend(cls.problem(FIRST_ROW + index, samples[index], level, check, message)
+                                for level, check, message in row_problems)
+        return problems
+
+    @classmethod
+    def problem(cls, row, sample, level, check, message):
+        """
+        Args:
+            row: row in the Excel sheet. 0 for the whole sheet
+            sample: sample name of the row
+            level: error or warning
+            check: name of the check. ifolder, column, duplicate, folder, files, md5 or reads
+            message: what is wrong
+
+        Returns: dict with the REPORT_COLUMNS
+
+        """
+        return {'row': row, 'sample': sample, 'level': level, 'check': check, 'message': message}
+
+    @classmethod
+    def writing_report(cls, problems, report):
+        """
+        writes the problems as a tab separated report
+        Args:
+            problems: list of problems (dict with the REPORT_COLUMNS)
+            report: path of the report
+        """
+        with open(report, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS, delimiter='\t')
+            writer.writeheader()
+            writer.writerows(problems)
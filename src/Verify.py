@@ -0,0 +1,193 @@
+"""
+Checking the files against their .md5 files before uploading them. Truncated or broken files from the sequencer share
+are found before they are uploaded. Files are hashed in large chunks on a pool of processes and the result is written
+in a report, so a second run does not hash the files again whose size and modification time did not change
+"""
+import csv
+import hashlib
+import os
+import sys
+import time
+
+CHUNK_SIZE = 16 * 1024 * 1024
+REPORT_COLUMNS = ['path', 'size', 'mtime_ns', 'md5', 'expected', 'status']
+
+
+class Md5Verify:
+    """
+    This class will compare the md5sum of every file with the one in <file>.md5
+    """
+
+    @classmethod
+    def main(cls, files, jobs=1, report='md5_report.tsv', timing=None):
+        """
+        The main wrapper to verify all the files. The files which are in the report with the same size and
+        modification time are not hashed again. It will exit if any of the files does not match its .md5 file.
+        Args:
+            files: list of local files (.fastq.gz, .cram, .crai). <file>.md5 should be beside it
+            jobs: number of files which are hashed at the same time
+            report: path of the report (tab separated). it is read at the start and updated at the end
+            timing: Timing.TimingLog where the timing of every hashed file is written. None for no timing
+
+        Returns: dict of file path and its report row (dict with the REPORT_COLUMNS)
+
+        """
+        results = cls.verifying(files=files, jobs=jobs, report=report, timing=timing)
+        failed = [file for file in files if results[os.path.abspath(file)]['status'] != 'ok']
+        if failed:
+            print("These files do not match their md5 files. Please check them. More information in", report)
+            for file in failed:
+                print(file, results[os.path.abspath(file)]['status'])
+            sys.exit(1)
+        return results
+
+    @classmethod
+    def verifying(cls, files, jobs=1, report='md5_report.tsv', timing=None):
+        """
+        same as main, but it does not exit if a file does not match its .md5 file, e.g. for the watch mode which only
+        holds back the broken sample
+        Args:
+            files: list of local files. <file>.md5 should be beside it
+            jobs: number of files which are hashed at the same time
+            report: path of the report. None for no report
+            timing: Timing.TimingLog where the timing of every hashed file is written. None for no timing
+
+        Returns: dict of absolute file path and its report row
+
+        """
+        cached = cls.reading_report(report)
+        results = {}
+        to_hash = []
+        for file in files:
+            file = os.path.abspath(file)
+            row = cls.reusing(cached=cached, file=file)
+            if row is not None:
+                results[file] = row
+            else:
+                to_hash.append(file)
+        if to_hash:
+            # multiprocessing is only imported (and its workers started) when files are hashed, not by every command
+            # importing this module or a run where everything is taken from the report
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=max(1, min(jobs, len(to_hash)))) as pool:
+                for file, row in zip(to_hash, pool.map(cls.hashing, to_hash)):
+                    seconds = row.pop('seconds')
+                    results[file] = cls.comparing(row=row, expected=cls.reading_md5file(file))
+                    if timing is not None:
+                        timing.record(sample=os.path.basename(os.path.dirname(file)), op='checksum', seconds=seconds,
+                                      size=row['size'], status=0 if row['status'] == 'ok' else 1, detail=file)
+        cached.update(results)
+        cls.writing_report(rows=cached, report=report)
+        failed = [file for file in files if results[os.path.abspath(file)]['status'] != 'ok']
+        print(f'md5: {len(files) - len(failed)} of {len(files)} files are ok. {len(to_hash)} files were hashed, '
+              f'{len(files) - len(to_hash)} were taken from {report}')
+        return results
+
+    @classmethod
+    def hashing(cls, file):
+        """
+        md5sum of a single file. It is read in large chunks into the same buffer, so it runs at disk speed
+        Args:
+            file: local file path
+
+        Returns: report row of the file without expected and status, with the seconds it took
+
+        """
+        start = time.perf_counter()
+        stat = os.stat(file)
+        digest = hashlib.md5()
+        buffer = bytearray(CHUNK_SIZE)
+        view = memoryview(buffer)
+        with open(file, 'rb', buffering=0) as f:
+            while True:
+                size = f.readinto(buffer)
+                if not size:
+                    break
+                digest.update(view[:size])
+        return {'path': file, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'md5': digest.hexdigest(),
+                'seconds': time.perf_counter() - start}
+
+    @classmethod
+    def reusing(cls, cached, file):
+        """
+        Args:
+            cached: dict of file path and its report row. output of reading_report
+            file: absolute path of a local file
+
+        Returns: the report row of the file compared with its .md5 file, if the file has the same size and
+        modification time as in the report. None if the file has to be hashed
+
+        """
+        stat = os.stat(file)
+        row = cached.get(file)
+        if row and int(row['size']) == stat.st_size and int(row['mtime_ns']) == stat.st_mtime_ns:
+            return cls.comparing(row=dict(row), expected=cls.reading_md5file(file))
+        return None
+
+    @classmethod
+    def reading_md5file(cls, file):
+        """
+        reads <file>.md5. It can either only have the md5sum or the output of md5sum (<md5sum>  <filename>)
+        Args:
+            file: local file path (without .md5)
+
+        Returns: the md5sum. empty string if the md5 file does not exist or is empty
+
+        """
+        if not os.path.exists(file + '.md5'):
+            return ''
+        with open(file + '.md5') as f:
+            words = f.read().split()
+        return words[0].lower() if words else ''
+
+    @classmethod
+    def comparing(cls, row, expected):
+        """
+        updates the status of a report row. ok if the md5sum is same as expected
+        Args:
+            row: report row of the file
+            expected: md5sum from the .md5 file
+
+        Returns: the updated row
+
+        """
+        row['expected'] = expected
+        if not expected:
+            row['status'] = 'missing md5'
+        elif row['md5'] == expected:
+            row['status'] = 'ok'
+        else:
+            row['status'] = 'mismatch'
+        return row
+
+    @classmethod
+    def reading_report(cls, report):
+        """
+        reads the report of an earlier run
+        Args:
+            report: path of the report
+
+        Returns: dict of file path and its report row. empty if the report does not exist
+
+        """
+        if not report or not os.path.exists(report):
+            return {}
+        with open(report, newline='') as f:
+            return {row['path']: row for row in csv.DictReader(f, delimiter='\t')}
+
+    @classmethod
+    def writing_report(cls, rows, report):
+        """
+        writes the report. It is first written to a temporary file, so a broken run does not leave a broken report
+        Args:
+            rows: dict of file path and its report row
+            report: path of the report
+        """
+        if not report:
+            return
+        with open(report + '.tmp', 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS, delimiter='\t')
+            writer.writeheader()
+            for file in sorted(rows):
+                writer.writerow(rows[file])
+        os.replace(report + '.tmp', report)
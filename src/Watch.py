@@ -0,0 +1,285 @@
+"""
+Watch mode. Instead of one big upload after the whole run, the landing folder of the sequencer (or the pipeline
+writing the crams) is watched and every sample (lane) folder is uploaded as soon as it is complete: all its files and
+their .md5 files are there (same checks as Validate.py, and R1 and R2 of a paired-end run) and none of them changed for
+<settle> seconds. The Metadata sheet is loaded once and only loaded again when it changes. The folder is watched with
+inotify if inotify_simple is installed, otherwise it is checked every <interval> seconds
+"""
+import os
+import time
+
+import Inherit
+import MetaSheet
+import Plan
+import Scan
+import Transfer
+import Verify
+
+
+class FolderWatcher:
+    """
+    This class will watch a landing folder and upload every sample of the Metadata sheet once it is complete
+    """
+
+    def __init__(self, uploader, metadata, ifolder, folder=None, upload=False, batch_meta=False, verify=False,
+                 settle=300, transfer=None, collection_meta=False, jobs=1, md5_report='md5_report.tsv'):
+        """
+        Args:
+            uploader: iRodsClass.UploadFastq or iRodsClass.UploadCram
+            metadata: path of the Metadata sheet (.xlsx, .csv or .tsv)
+            ifolder: The abs path of irods folder
+            folder: the landing folder with the sample folders. default is current working directory
+            upload: If upload=True only the files are uploaded, without the metadata
+            batch_meta: If batch_meta=True all the metadata of a data object is sent in one imeta call
+            verify: If verify=True the files of a sample are checked against their .md5 files before its upload
+            settle: seconds the files of a sample folder have to stay the same before it is uploaded
+            transfer: dict of the arguments of Transfer.TransferPlanner.main (threads, large_file, bulk_small,
+            trusted_md5)
+            collection_meta: If collection_meta=True the metadata shared by all the files of a sample is added to the
+            sample collection (check Inherit.py)
+            jobs: number of files which are hashed at the same time with verify
+            md5_report: the report of the verification, same as Verify.Md5Verify.main. The files which did not change
+            since the last check are not hashed again
+        """
+        self.uploader = uploader
+        self.metadata = metadata
+        self.ifolder = ifolder
+        self.folder = os.path.abspath(folder or os.getcwd())
+        self.upload = upload
+        self.batch_meta = batch_meta
+        self.verify = verify
+        self.settle = settle
+        self.transfer = transfer or {}
+        self.collection_meta = collection_meta
+        self.jobs = jobs
+        self.md5_report = md5_report
+        self.sheet_mtime = None
+        self.rows = {}
+        self.seen = {}
+        self.reported = {}
+        self.done = set()
+        self.failed = {}
+
+    @classmethod
+    def main(cls, uploader, metadata, ifolder, running, folder=None, upload=False, batch_meta=False, verify=False,
+             interval=60, settle=300, transfer=None, collection_meta=False, jobs=1, md5_report='md5_report.tsv',
+             cycles=None):
+        """
+        The main wrapper of the watch mode. It runs until it is stopped (Ctrl-C) or after <cycles> checks
+        Args:
+            uploader: iRodsClass.UploadFastq or iRodsClass.UploadCram
+            metadata: path of the Metadata sheet (.xlsx, .csv or .tsv)
+            ifolder: The abs path of irods folder
+            running: callable(operations) returning the dict of upload folder name and exit code. It runs the typed
+            operations of the ready samples (check Plan.py), e.g. with the journal and an executor
+            folder: the landing folder with the sample folders. default is current working directory
+            upload: If upload=True only the files are uploaded, without the metadata
+            batch_meta: If batch_meta=True all the metadata of a data object is sent in one imeta call
+            verify: If verify=True the files of a sample are checked against their .md5 files before its upload
+            interval: seconds between two checks of the folder (the longest wait with inotify)
+            settle: seconds the files of a sample folder have to stay the same before it is uploaded
+            transfer: dict of the arguments of Transfer.TransferPlanner.main
+            collection_meta: If collection_meta=True the metadata shared by all the files of a sample is added to the
+            sample collection. Only the sample level, the samples of a check are not the whole project
+            jobs: number of files which are hashed at the same time with verify
+            md5_report: the report of the verification. The files in it which did not change are not hashed again
+            cycles: number of checks before it stops. None to run until it is stopped
+
+        Returns: dict of upload folder name and exit code of all the uploaded folders
+
+        """
+        watcher = cls(uploader=uploader, metadata=metadata, ifolder=ifolder, folder=folder, upload=upload,
+                      batch_meta=batch_meta, verify=verify, settle=settle, transfer=transfer,
+                      collection_meta=collection_meta, jobs=jobs, md5_report=md5_report)
+        waiting = cls.waiting_function(folder=watcher.folder)
+        exit_codes = {}
+        print(f'watch: watching {watcher.folder} for the samples of {metadata}. Ctrl-C to stop')
+        cycle = 0
+        try:
+            while cycles is None or cycle < cycles:
+                try:
+                    exit_codes.update(watcher.checking(running=running))
+                except (Exception, SystemExit) as error:
+                    # the folders of this check are not done, so they are tried again in the next check
+                    print(f'watch: the check failed ({error!r}). It is tried again in the next check')
+                cycle += 1
+                if cycles is None or cycle < cycles:
+                    waiting(interval)
+        except KeyboardInterrupt:
+            print('watch: stopped')
+        print(f'watch: {len(watcher.done)} sample folders uploaded, {len(watcher.failed)} failed')
+        return exit_codes
+
+    @classmethod
+    def waiting_function(cls, folder):
+        """
+        Args:
+            folder: the landing folder
+
+        Returns: callable(seconds) which waits until something changes in the folder (inotify) or for seconds
+
+        """
+        try:
+            from inotify_simple import INotify, flags
+        except ImportError:
+            return time.sleep
+        inotify = INotify()
+        mask = flags.CREATE | flags.MOVED_TO | flags.CLOSE_WRITE | flags.DELETE
+        watched = set()
+
+        def waiting(seconds):
+            # every new sample folder is watched too, the files are written inside them
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir() and entry.path not in watched:
+                        inotify.add_watch(entry.path, mask)
+                        watched.add(entry.path)
+            if folder not in watched:
+                inotify.add_watch(folder, mask)
+                watched.add(folder)
+            # the first event only wakes it up. A folder is still uploaded only after <settle> seconds without change
+            inotify.read(timeout=int(seconds * 1000))
+        return waiting
+
+    def loading(self):
+        """
+        loads the Metadata sheet if it is new or changed since the last check. A sheet which can not be read (e.g. it
+        is saved or renamed right now) is tried again in the next check, the samples of the previous sheet are kept
+
+        Returns: True if it was loaded
+
+        """
+        try:
+            mtime = os.stat(self.metadata).st_mtime_ns
+            if mtime == self.sheet_mtime:
+                return False
+            sheet = MetaSheet.MetadataSheet.loading(self.metadata)
+            samples = [str(sample) for sample in sheet.column('sample name')]
+            rows = dict(zip(samples, self.uploader.sheet_rows(sheet)))
+        except (Exception, SystemExit) as error:
+            # MetaSheet exits on a sheet it can not read. In watch mode it is only a sheet which is not saved yet
+            print(f'watch: could not load {self.metadata} ({error}). It is loaded again in the next check')
+            return False
+        self.rows = rows
+        self.sheet_mtime = mtime
+        print(f'watch: {len(self.rows)} samples in {self.metadata}')
+        return True
+
+    def checking(self, running):
+        """
+        a single check of the landing folder. Every complete and settled sample (lane) folder is uploaded
+        Args:
+            running: callable(operations) returning the dict of upload folder name and exit code
+
+        Returns: dict of upload folder name and exit code of the folders uploaded in this check
+
+        """
+        self.loading()
+        index = Scan.FolderIndex.rescanning(self.folder)
+        ready = []
+        for sample in self.rows:
+            try:
+                ready.extend(self.ready(sample=sample, index=index))
+            except OSError as error:
+                # a file was renamed or deleted while the folder was checked
+                print(f'watch: could not check {sample} ({error}). It is checked again in the next check')
+        if self.verify and ready:
+            table = self.planning(ready=ready, upload=True)
+            broken = self.verifying(files=table.local_files())
+            for name, lane_row, target_folder in list(ready):
+                if broken.intersection(index.listing(target_folder)):
+                    print(f'watch: {name} does not match its .md5 files. It waits until its files change')
+                    self.failed[name] = self.seen[name][0]
+                    ready.remove((name, lane_row, target_folder))
+        if not ready:
+            return {}
+        table = self.planning(ready=ready, upload=self.upload)
+        Transfer.TransferPlanner.main(table=table, **self.transfer)
+        if self.collection_meta and not self.upload:
+            Inherit.InheritedMetadata.main(table=table, level='sample')
+        exit_codes = running(table.operations(batch_meta=self.batch_meta))
+        for name, lane_row, target_folder in ready:
+            if exit_codes.get(name, 0) != 0:
+                self.failed[name] = self.seen[name][0]
+            else:
+                self.done.add(name)
+                self.failed.pop(name, None)
+        return exit_codes
+
+    def planning(self, ready, upload):
+        """
+        Args:
+            ready: list of (upload folder name, lane row, target folder) of the ready folders
+            upload: If upload=True only the upload operations are planned
+
+        Returns: Plan.OperationTable of the ready folders
+
+        """
+        table = Plan.OperationTable()
+        for name, lane_row, target_folder in ready:
+            self.uploader.planning_row(table=table, row=lane_row, target_folder=target_folder, ifolder=self.ifolder,
+                                       upload=upload)
+        return table
+
+    def ready(self, sample, index):
+        """
+        Every lane folder of a sample is uploaded on its own, so a lane which is written later is still uploaded
+        Args:
+            sample: sample name
+            index: Scan.FolderIndex of the landing folder
+
+        Returns: list of (upload folder name, lane row, target folder) of the folders of the sample which are not
+        uploaded yet, are complete (no error of validating_folder and all the expected_roles of the row) and did not
+        change for <settle> seconds. A folder which failed is only tried again when its files changed
+
+        """
+        row = self.rows[sample]
+        problems = self.uploader.validating_row(row=row, folder=self.folder, upload=self.upload)
+        # a missing folder is the normal state of a sample which is not written yet
+        if any(check == 'folder' for level, check, message in problems):
+            return []
+        messages = [message for level, check, message in problems if level == 'error' and check == 'column']
+        if messages:
+            if self.reported.get(sample) != messages:
+                print(f'watch: {sample} can not be uploaded:', "; ".join(messages))
+            self.reported[sample] = messages
+            return []
+        ready = []
+        roles = self.uploader.expected_roles(row)
+        for lane_row, target_folder in self.uploader.resolving_folders(row=row, folder=self.folder):
+            name = os.path.basename(target_folder.rstrip('/'))
+            if name in self.done:
+                continue
+            problems = self.uploader.validating_folder(target_folder=target_folder, index=index, roles=roles)
+            if problems:
+                self.seen.pop(name, None)
+                messages = [message for level, check, message in problems]
+                if self.reported.get(name) != messages:
+                    print(f'watch: {name} is not complete yet:', "; ".join(messages))
+                self.reported[name] = messages
+                continue
+            signature = tuple((path, os.stat(path).st_size, os.stat(path).st_mtime_ns)
+                              for path in index.listing(target_folder))
+            now = time.monotonic()
+            if name not in self.seen or self.seen[name][0] != signature:
+                self.seen[name] = (signature, now)
+            if self.failed.get(name) != signature and now - self.seen[name][1] >= self.settle:
+                ready.append((name, lane_row, target_folder))
+        return ready
+
+    def verifying(self, files):
+        """
+        checks the files against their .md5 files on <jobs> processes. The files in the md5 report which did not
+        change are not hashed again
+        Args:
+            files: list of local files
+
+        Returns: set of the files (and their .md5 files) which do not match
+
+        """
+        results = Verify.Md5Verify.verifying(files=files, jobs=self.jobs, report=self.md5_report)
+        broken = set()
+        for file in files:
+            if results[os.path.abspath(file)]['status'] != 'ok':
+                broken.update((file, file + '.md5'))
+        return broken
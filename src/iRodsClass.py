@@ -1,34 +1,45 @@
-import glob
 import os
 import sys
 
-import pandas
-
+import Inherit
 import Misc
+import MetaSheet
+import Layout
+import Plan
+import Scan
+import Transfer
+import Validate
+import Verify
 from _version import __version__
 
 class UploadFastq:
     """
     This class will help to upload fastq files in the irods/yoda system
     """
+    # columns which need a value in every row of the Metadata sheet
+    REQUIRED = ('sample name', 'sample barcode', 'library id')
 
     @classmethod
-    def main(cls, metadata, ifolder, folder=None, upload=False, meta=False):
+    def main(cls, metadata, ifolder, folder=None, upload=False, meta=False, batch_meta=False, sync=False,
+             verify=False, jobs=1, md5_report='md5_report.tsv', scan=None, threads=0,
+             large_file=Transfer.LARGE_FILE, bulk_small=False, trusted_md5=False, timing=None, remote=None,
+             operations=False, validation_report='validation_report.tsv', collection_meta=None, validate=True):
         """
         The main wrapper function for uploading the fastq files with all the necessary checks. given a metadata
         csv file. It will read it, guess the folder names from the metadata and search it in the <folder>. Every row
         in the metadata should have corresponding folder. folders should be same prefix as fastq files, without
         _R1_001.fastq.gz or _R2_001.fastq.gz. Fastq naming system are automatically created from the cluster. So does
-        not need much attention. it will check if every folder has 4 files. Read1.fastq.gz, Read2.fastq.gz,
-        Read1.fastq.gz.md5, Read2.fastq.gz.md5. Then it will give commands to start uploading the data irods and
-        remove all the metadata first but then after removing the metadata it will update the new metadata
+        not need much attention. it will check the fastq files of every folder (check Layout.py): every fastq file
+        needs its .md5 file, R1 is needed and every other read role (R2, I1, I2) needs the same lanes and chunks as R1.
+        Then it will give commands to start uploading the data irods and remove all the metadata first but then after
+        removing the metadata it will update the new metadata
 
         Args:
             metadata: Path of the metadata info Excel sheet that is generated. check
                 https://github.com/ikmb/data-management/scripts/metadata_set_table_from_lims.rb for more information on
                 Excel sheet. Mainly it will read Metadata sheet in Excel file. Metadata sheet should have information in
                 rows. first row is units, second row attribute name and everything else is values needed for irods to be
-            uploaded. <metadata>.xlsx
+            uploaded. <metadata>.xlsx. A .csv or .tsv file with the same layout can be used as well. check MetaSheet.py
             ifolder: The abs path of irods folder. Please do not upload relative path
             folder: The path of the folder where fastq is present in locally. default is current working directory
             upload: By default it will return commands for upload and add the metadata. But you can run it separately.
@@ -36,331 +47,424 @@ class UploadFastq:
             meta: By default it will return commands for upload and add the metadata. But you can run it separately.
             If meta=True is used it will return commands to remove the previously uploaded files metadata and
             add new metadata. Only use after you have uploaded the files
+            batch_meta: By default every metadata attribute is a single imeta command. If batch_meta=True all the
+            metadata commands of a data object are sent in one imeta call. Check Plan.OperationTable.operations
+            sync: If sync=True no commands are returned but the metadata every uploaded file should have. It is used
+            to only update the metadata which changed. Check Sync.py. Only use after you have uploaded the files
+            verify: If verify=True every file is checked against its .md5 file before any command is given. It will
+            exit if any of them does not match. Check Verify.py
+            jobs: number of files which are verified (and rows which are validated) at the same time
+            md5_report: the report of the verification. Files with the same size and modification time in the report
+            are not hashed again
+            scan: saved index of the local folder (Submit_iRods.py scan). If it is not given the folder is scanned
+            once. check Scan.py
+            threads: number of transfer threads (irsync -N) for large files. 0 leaves it to the irods server
+            large_file: size in bytes from which a file is a large file
+            bulk_small: If bulk_small=True the small files of a folder (.md5, .crai) are uploaded in one bulk iput.
+            check Transfer.py
+            trusted_md5: If trusted_md5=True the files are uploaded with a checksum calculated by the server, which is
+            compared with their .md5 file. Files which are already in irods with the same checksum are not uploaded
+            timing: Timing.TimingLog where the timing of the md5 check of every file is written. None for no timing
+            remote: Remote.RemoteState of ifolder. The uploads which are already in irods with the same size and
+            checksum and the existing collections are removed from the plan. None to upload everything
+            operations: If operations=True the typed operations of every sample are returned (check
+            Plan.OperationTable.operations) instead of the newline joined commands. It is the library mode, the
+            executors and Plan.printing take them as they are
+            validation_report: the report of the validation of the whole sheet. Every row is checked before planning
+            and all the problems are written in it. check Validate.py
+            collection_meta: sample or project. The metadata which is the same on all the files of a sample (or with
+            project of the whole sheet) is added once to the sample collection (or ifolder) instead of to every file.
+            check Inherit.py. None to add all the metadata to every file. project uses the metadata of ifolder in
+            remote, so the samples uploaded into ifolder before keep what they inherit
+            validate: If validate=False the sheet is not validated again. e.g. all the sheets of a batch are validated
+            before the first one is planned (check Batch.py)
 
         Returns: it will check necessary files present or not and then will return all the commands necessary to upload
         it. It will not run it. For running use os.system(list(dict_commands.values())) or check Submit_iRods.py
+        Every lane folder of a library is its own entry in the dict. With sync=True it will return for every sample
+        the dict of irods data object and its metadata (check Plan.OperationTable.avus)
 
         """
-        metadf = pandas.read_excel(metadata, sheet_name="Metadata", header=[0, 1]).transpose()
-        samples = metadf.loc[('String', 'sample name'), :]
-        if metadf.shape[1] != samples.unique().shape[0]:
-            print("There are repeated sample name for multiple sequences. Right now the code can not handle that.")
-            print("Please check these samples")
-            print(samples[samples()])
+        if scan:
+            Scan.FolderIndex.loading(scan)
+        sheet = MetaSheet.MetadataSheet.loading(metadata)
+        if sync and upload:
+            print("both sync and upload cant be True. sync only updates the metadata of the uploaded files")
+            sys.exit(1)
+        if sync and collection_meta:
+            print("sync only updates the metadata of the data objects. Please use meta to move the metadata to the "
+                  "collections")
             sys.exit(1)
-        commands = [
-            cls.single_meta_commands(single_meta=single_meta, ifolder=ifolder, folder=folder, upload=upload, meta=meta)
-            for index, single_meta in metadf.items()]
-        name, commands = zip(*commands)
-        dict_commands = dict(zip(name, commands))
+        if validate:
+            Validate.SheetValidator.main(sheet=sheet, uploader=cls, ifolder=ifolder, folder=folder, upload=upload,
+                                         jobs=jobs, report=validation_report)
+        table = cls.planning(sheet=sheet, ifolder=ifolder, folder=folder, upload=upload, meta=meta or sync)
+        if verify:
+            uploads = cls.planning(sheet=sheet, ifolder=ifolder, folder=folder, upload=True) if meta or sync else table
+            Verify.Md5Verify.main(files=uploads.local_files(), jobs=jobs, report=md5_report, timing=timing)
+        if sync:
+            return table.avus()
+        if collection_meta:
+            Inherit.InheritedMetadata.main(table=table, level=collection_meta, ifolder=ifolder,
+                                           current=remote.metadata if remote is not None else None)
+        Transfer.TransferPlanner.main(table=table, threads=threads, large_file=large_file, bulk_small=bulk_small,
+                                      trusted_md5=trusted_md5)
+        if remote is not None:
+            remote.pruning(table)
+        plan = table.operations(batch_meta=batch_meta)
+        if operations:
+            return plan
+        dict_commands = {name: Misc.joinginglistbyspecificstring([operation.command() for operation in plan[name]],
+                                                                 string="\n") for name in plan}
         return dict_commands
 
     @classmethod
-    def single_meta_commands(cls, single_meta, ifolder, folder=None, upload=False, meta=False):
-        """
-        commands necessary for a single row in the metadata to upload all the files and adding all the necessary
-        metadata. for fastq it means you need 4 files inside every folder. folder should be same prefix as fastq files,
-        without _R1_001.fastq.gz or _R2_001.fastq.gz. Fastq naming system are automatically created from the cluster.
-        So does not need much attention. it will check if every folder has 4 files. Read1.fastq.gz, Read2.fastq.gz,
-        Read1.fastq.gz.md5, Read2.fastq.gz.md5. Then it will give commands to start uploading the data irods and
-        remove all the metadata first but then after removing the metadata it will update the new metadata
+    def planning(cls, sheet, ifolder, folder=None, upload=False, meta=False):
+        """
+        plans all the operations of the whole Metadata sheet in one pass. The sheet is turned into rows column wise
+        once, every row is looked up in the folder index and its operations are added to one flat table. There is no
+        pandas and no command string is built here, so planning thousands of samples takes milliseconds
         Args:
-            single_meta: single row of Metadata sheet from <metadata>.xlsx
+            sheet: MetaSheet.MetadataSheet
             ifolder: The abs path of irods folder. Please do not upload relative path
             folder: The path of the folder where fastq is present in locally. default is current working directory
-            upload: By default it will return commands for upload and add the metadata. But you can run it separately.
-            If upload=True is used it will only return upload commands. Good in case very big multiple files
-            meta: By default it will return commands for upload and add the metadata. But you can run it separately.
-            If meta=True is used it will return commands to remove the previously uploaded files metadata and
-            add new metadata. Only use after you have uploaded the files
+            upload: If upload=True only the upload operations are planned
+            meta: If meta=True only the metadata operations are planned
 
-        Returns: it will check necessary files present or not and then will return all the commands necessary to upload
-        the files for a single row
-
-        """
-        single_meta = single_meta.reset_index(level=0)
-        single_meta.columns = ['units', 'value']
-        single_meta, target_folder = cls.checking_folder(single_meta=single_meta, ifolder=ifolder, folder=folder)
-        R1, R2 = cls.check_files(target_folder=target_folder)
-        if upload:
-            if meta:
-                print("both meta and upload cant be True. Use either one of them at a time. If you want run all do "
-                      "nothing. By default it will run the whole thing")
-                sys.exit(1)
-            commands, uploadfolder = cls.uploading_commands(R1=R1, R2=R2, ifolder=ifolder)
-
-        else:
-            upload_commands, uploadfolder = cls.uploading_commands(R1=R1, R2=R2, ifolder=ifolder)
-            R1_remove = cls.removing_metadata_commands(single_meta=single_meta, filepath=R1, ifolder=ifolder)
-            R1_add_command = cls.adding_metadata_commands(single_meta=single_meta, filepath=R1, ifolder=ifolder)
-            R1_special = cls.special_metadata(single_meta=single_meta, filepath=R1, ifolder=ifolder, read1=True)
-            R2_remove = cls.removing_metadata_commands(single_meta=single_meta, filepath=R2, ifolder=ifolder)
-            R2_add_command = cls.adding_metadata_commands(single_meta=single_meta, filepath=R2, ifolder=ifolder)
-            R2_special = cls.special_metadata(single_meta=single_meta, filepath=R2, ifolder=ifolder, read1=False)
-            if meta:
-                commands = R1_remove + R1_add_command + R1_special + R2_remove + R2_add_command + R2_special
-            else:
-                commands = upload_commands + R1_remove + R1_add_command + R2_remove + R2_add_command
-        return uploadfolder, Misc.joinginglistbyspecificstring(commands, string="\n")
+        Returns: Plan.OperationTable
+
+        """
+        if not os.path.isabs(ifolder):
+            print("Your ifolder is not absolute. Please use an absolute path to run it")
+            sys.exit(1)
+        if upload and meta:
+            print("both meta and upload cant be True. Use either one of them at a time. If you want run all do "
+                  "nothing. By default it will run the whole thing")
+            sys.exit(1)
+        return cls.planning_rows(rows=cls.sheet_rows(sheet), ifolder=ifolder, folder=folder, upload=upload, meta=meta)
 
     @classmethod
-    def checking_folder(cls, single_meta, ifolder, folder=None):
+    def planning_rows(cls, rows, ifolder, folder=None, upload=False, meta=False):
         """
-        It will check also ifolder is not relative as iRods system has problem with relative path.
-        Absolute path is recommended. It will check if the necessary folder exist in the local machine (the name of the
-        folder will be derived from the metadata itself). If there are more than one lane for same library it will also
-        complain as the proper code for multiple lane is not implemented yet. One library has run only for once.
+        plans the operations of some rows of the sheet. e.g. only the samples which are ready (check Watch.py)
         Args:
-            single_meta: single row of Metadata sheet from <metadata>.xlsx
-            ifolder: The abs path of irods folder. Please do not upload relative path
+            rows: list of rows. output of sheet_rows
+            ifolder: The abs path of irods folder
             folder: The path of the folder where fastq is present in locally. default is current working directory
+            upload: If upload=True only the upload operations are planned
+            meta: If meta=True only the metadata operations are planned
 
-        Returns: It will return updated single_meta Series by adding lae info and remove all the NAs. It will also
-        return the target folder which needs to be uploaded from local folder.
+        Returns: Plan.OperationTable
 
         """
-        if not os.path.isabs(ifolder):
-            print("Your ifolder is not absolute. Please use an absolute path to run it")
-            sys.exit(1)
-        prefix = single_meta.loc['sample barcode', 'value'].replace("-DL", "-DS") + '_' + single_meta.loc[
-            'library id', 'value']
+        table = Plan.OperationTable()
+        for row in rows:
+            for lane_row, target_folder in cls.resolving_folders(row=row, folder=folder):
+                cls.planning_row(table=table, row=lane_row, target_folder=target_folder, ifolder=ifolder,
+                                 upload=upload, meta=meta)
+        return table
+
+    @classmethod
+    def sheet_rows(cls, sheet):
+        """
+        turns the column wise sheet into one list of (attribute, value, unit) for every row, going once over every
+        column
+        Args:
+            sheet: MetaSheet.MetadataSheet
+
+        Returns: list of rows. value is None if the cell is empty
+
+        """
+        rows = [[] for _ in range(sheet.samples)]
+        for attribute, unit, values in zip(sheet.attributes, sheet.units, sheet.columns):
+            for row, value in zip(rows, values):
+                row.append((attribute, value, unit))
+        return rows
+
+    @classmethod
+    def resolving_folders(cls, row, folder=None):
+        """
+        It will find every lane folder of the library (<barcode>_<library>_S<number>_L<lane>) of a row of sheet_rows
+        in the folder index and set the flowcell lane of the folder. The folder name is derived from the metadata itself
+        Args:
+            row: list of (attribute, value, unit) of a single row
+            folder: The path of the folder where fastq is present in locally. default is current working directory
+
+        Returns: list of (row, target_folder) for every lane folder. The empty values are removed from the row
+
+        """
+        values = {attribute: value for attribute, value, unit in row}
+        prefix = str(values.get('sample barcode')).replace("-DL", "-DS") + '_' + str(values.get('library id'))
         folder = os.path.abspath(folder or os.getcwd())
-        target_folder = glob.glob(f'{folder}/{prefix}*/')
-        if len(target_folder) > 1:
-            print("currently not implemented for more than one lane. please update the code ")
-            sys.exit(1)
-        elif len(target_folder) == 0:
+        target_folders = Scan.FolderIndex.scanning(folder).matching_folders(prefix)
+        if len(target_folders) == 0:
             print(
                 "no folder found for corresponding folder. Please check and update the excel sheet. if the folder does "
                 "not exist please delete the row")
             print(f'expected folder: {folder}/{prefix}*/')
-            print(single_meta)
+            print({attribute: value for attribute, value in values.items() if value is not None})
             sys.exit(1)
-        else:
-            target_folder = target_folder[0]
-            filename = Misc.filename_manipulate.gettingfilename(target_folder[:-1])
-            single_meta.loc['flowcell lane', 'value'] = filename.split("_")[-1][1:]
-            return single_meta.dropna(), target_folder
+        lanes = []
+        for target_folder in target_folders:
+            lane = Misc.filename_manipulate.gettingfilename(target_folder[:-1]).split("_")[-1][1:]
+            lane_row = [(attribute, lane if attribute == 'flowcell lane' else value, unit)
+                        for attribute, value, unit in row]
+            lanes.append(([avu for avu in lane_row if avu[1] is not None], target_folder))
+        return lanes
 
     @classmethod
-    def check_files(cls, target_folder):
+    def validating_row(cls, row, folder=None, upload=False):
         """
-        This will check specific files are present in the folder or not. Basically Read1.fastq.gz, Read2.fastq.gz,
-        Read1.fastq.gz.md5, Read2.fastq.gz.md5
+        Same checks as resolving_folders and detecting_layout, but every problem of the row is given back instead of
+        exiting at the first one. Check Validate.py
         Args:
-            target_folder: The local folder which has to be uploaded
+            row: list of (attribute, value, unit) of a single row
+            folder: The path of the folder where fastq is present in locally. default is current working directory
+            upload: If upload=True only the upload is checked, not the metadata
 
-        Returns: it will check exact file names. If it has more or less number of files or the naming convention is
-        different it will complain. If every thing is ok it will send the full path of R1_gzfile and R2_gzfile
+        Returns: list of (level, check, message). level is error or warning. empty list if the row is fine
 
         """
-        files = Misc.filename_manipulate.folder_vs_list_single(target_folder)
-        if len(files) != 4:
-            print(
-                "Expected number of files in the folder is expected to be 4. Read1, Read2, Read1.md5 and "
-                "Read2.md5. did not find all of them. please check")
-            print(files)
-            sys.exit(1)
-        md5files = [file for file in files if file[-3:] == 'md5']
-        gzfiles = [file for file in files if file[-3:] != 'md5']
-        for gzfile in gzfiles:
-            if not gzfile + '.md5' in md5files:
-                print("cant find the md5sum for the corresponding gzfile")
-                print(gzfile)
-                sys.exit(1)
-        R1_gzfile, R2_gzfile = cls.R1_R2_file(gzfiles)
-        return R1_gzfile, R2_gzfile
+        values = {attribute: value for attribute, value, unit in row if value is not None}
+        missing = [attribute for attribute in cls.REQUIRED if attribute not in values]
+        if missing:
+            return [('error', 'column', f'no value for {", ".join(missing)}')]
+        prefix = str(values['sample barcode']).replace("-DL", "-DS") + '_' + str(values['library id'])
+        folder = os.path.abspath(folder or os.getcwd())
+        index = Scan.FolderIndex.scanning(folder)
+        target_folders = index.matching_folders(prefix)
+        if len(target_folders) == 0:
+            return [('error', 'folder', f'no folder found. expected folder: {folder}/{prefix}*/')]
+        problems = []
+        for target_folder in target_folders:
+            problems.extend(cls.validating_folder(target_folder=target_folder, index=index))
+        return problems
 
     @classmethod
-    def R1_R2_file(cls, gzfiles):
+    def validating_folder(cls, target_folder, index, roles=()):
         """
-        given a list of two gzfiles, it will decide which one is Read1 and which one is Read2.
+        the checks of the files of a single lane folder (check Layout.FastqLayout.detecting)
         Args:
-            gzfiles: gzfiles both Read1.fastq.gz, Read2.fastq.gz in a list format
+            target_folder: The local folder which has to be uploaded
+            index: Scan.FolderIndex of the folder
+            roles: read roles the folder needs. e.g. expected_roles of the row
 
-        Returns: will return Read1, Read2 fastq zipped path.
+        Returns: list of (level, check, message). empty list if the folder is fine
 
         """
-        Read = Misc.filename_manipulate.filenamewithoutextension_checking_zipped(gzfiles[0]).split("_")[-2]
-        if Read == 'R1':
-            R1_gzfile = gzfiles[0]
-            R2_gzfile = gzfiles[1]
-        else:
-            R2_gzfile = gzfiles[0]
-            R1_gzfile = gzfiles[1]
-        return R1_gzfile, R2_gzfile
+        layout = Layout.FastqLayout.detecting(files=index.listing(target_folder), target_folder=target_folder)
+        problems = [('error', check, message) for check, message in layout.problems]
+        found = {fastq.role for fastq in layout.fastqs}
+        problems.extend(('error', 'reads', f'{target_folder} does not have the {role} file')
+                        for role in roles if role not in found)
+        return problems
 
     @classmethod
-    def uploading_commands(cls, R1, R2, ifolder):
+    def expected_roles(cls, row):
         """
-        uploading files to irods commands. It uses irsync -K <local> i:<irods>. full path for irods is important
+        the read roles every lane folder of the row needs before it is complete. The run is single-end if the library
+        read length of the sheet is 1x<length> (e.g. 1x75), otherwise R1 and R2 are needed. The index reads are never
+        needed
         Args:
-            R1: R1.fastq.gz file path local
-            R2: R2.fastq.gz file path local
-            ifolder: irods uploading path full
+            row: list of (attribute, value, unit) of a single row
 
-        Returns: it will create commands for creating folder and uploading all the 4 files.
+        Returns: tuple of read roles (check Layout.py)
 
         """
-        uploadfolder = R1.split("/")[-2]
-        mkdir_command = f'imkdir -p {ifolder}/{uploadfolder}'
-        upload_R1_command = f'irsync -K {R1} i:{ifolder}/{uploadfolder}'
-        upload_R2_command = f'irsync -K {R2} i:{ifolder}/{uploadfolder}'
-        upload_R1md5_command = f'irsync -K {R1}.md5 i:{ifolder}/{uploadfolder}'
-        upload_R2md5_command = f'irsync -K {R2}.md5 i:{ifolder}/{uploadfolder}'
-        commands = [mkdir_command, upload_R1_command, upload_R1md5_command, upload_R2_command, upload_R2md5_command]
-        return commands, uploadfolder
+        values = {attribute: value for attribute, value, unit in row}
+        if str(values.get('library read length') or '').replace(' ', '').lower().startswith('1x'):
+            return ('R1',)
+        return ('R1', 'R2')
 
     @classmethod
-    def removing_metadata_commands(cls, single_meta, filepath, ifolder):
+    def planning_row(cls, table, row, target_folder, ifolder, upload=False, meta=False):
         """
-        It will give commands to remove the metadata first. no point adding new metadata in case it already existed.
-        imeta rmw -d <irods_file> <meta> % %
+        adds the operations of a single lane folder to the table. The folder is created and all the files of the
+        layout are uploaded, then for every fastq file the metadata is removed first and added again
         Args:
-            single_meta: single_meta: single row of Metadata sheet from <metadata>.xlsx. with added Lane info and
-            removed blank lines
-            filepath: fastq.gz file path local
+            table: Plan.OperationTable
+            row: list of (attribute, value, unit) of the row without empty values
+            target_folder: The local folder which has to be uploaded
             ifolder: irods uploading path full
-
-        Returns: will return all the commands which are needed to be removed before adding new metadata
-
+            upload: If upload=True only the upload operations are added
+            meta: If meta=True only the metadata operations are added
         """
-        uploadfile = Misc.joinginglistbyspecificstring(filepath.split("/")[-2:], "/")
-        commands = [f'imeta rmw -d {ifolder}/{uploadfile} "{meta}" % %' for meta in single_meta.index]
-        commands.append(f'imeta rmw -d {ifolder}/{uploadfile} "version" % %')
-        return commands
+        layout = cls.detecting_layout(target_folder=target_folder)
+        uploadfolder = os.path.basename(target_folder.rstrip('/'))
+        collection = f'{ifolder}/{uploadfolder}'
+        if not meta:
+            table.append(sample=uploadfolder, op='mkdir', path=collection)
+            for filepath in layout.uploads():
+                table.append(sample=uploadfolder, op='put', path=collection, value=filepath)
+        if not upload:
+            avus = row + [('version', f'v{__version__}', 'String')]
+            values = {attribute: value for attribute, value, unit in row}
+            for fastq in layout.fastqs:
+                ipath = f'{collection}/{os.path.basename(fastq.path)}'
+                table.removing_metadata(sample=uploadfolder, path=ipath, attributes=[avu[0] for avu in avus])
+                table.adding_metadata(sample=uploadfolder, path=ipath, avus=avus)
+                table.removing_metadata(sample=uploadfolder, path=ipath, attributes=['pair_end_read'])
+                table.adding_metadata(sample=uploadfolder, path=ipath, avus=cls.special_avus(values=values,
+                                                                                             role=fastq.role))
 
     @classmethod
-    def adding_metadata_commands(cls, single_meta, filepath, ifolder):
+    def detecting_layout(cls, target_folder):
         """
-        main point of all this. adding metadata to the uploaded irods file. imeta add -d <irods_file> <meta>
+        the fastq files of a sample folder with their read role, lane and chunk. It will exit if the folder can not be
+        uploaded (check Layout.FastqLayout.detecting)
         Args:
-            single_meta: single_meta: single row of Metadata sheet from <metadata>.xlsx. with added Lane info and
-            removed blank lines
-            filepath: fastq.gz file path local
-            ifolder:  irods uploading path full
+            target_folder: The local folder which has to be uploaded
 
-        Returns: will return all the necessary commands which are needed to add the metadata to uploaded files.
+        Returns: Layout.FastqLayout
 
         """
-        uploadfile = Misc.joinginglistbyspecificstring(filepath.split("/")[-2:], "/")
-        metainfo = list(('"' + single_meta.index + '" "' +
-                         single_meta.loc[:, 'value'].astype(str) + '" ' +
-                         single_meta.loc[:, 'units']).values)
-
-        commands = [f'imeta add -d {ifolder}/{uploadfile} {meta}' for meta in metainfo]
-        commands.append(f'imeta add -d {ifolder}/{uploadfile} "version" "v{__version__}" String')
-        return commands
+        files = Scan.FolderIndex.of(target_folder).listing(target_folder)
+        layout = Layout.FastqLayout.detecting(files=files, target_folder=target_folder)
+        if layout.problems:
+            print("The fastq files of the folder can not be uploaded. please check")
+            for check, message in layout.problems:
+                print(message)
+            sys.exit(1)
+        return layout
 
     @classmethod
-    def special_metadata(cls, single_meta, filepath, ifolder, read1=True):
+    def special_avus(cls, values, role='R1'):
         """
-        Special def for every Class. For example for fastq you need to add is this read1 or read2 of the file. if read1
-        then add read1 true and it will add necessary commands to update the metadata so that you know this file is
-        read1 or read2
+        the special metadata of a fastq file. is it Read1, Read2 or one of the index reads (Index1, Index2)
         Args:
-            single_meta: single_meta: single row of Metadata sheet from <metadata>.xlsx. with added Lane info and
-            removed blank lines
-            filepath: fastq.gz file path local
-            ifolder:  irods uploading path full
-            read1: to tell that the files is either read1 or read2. read1=True for default.
+            values: dict of attribute and value of a single row. with added Lane info and removed blank lines
+            role: read role of the file (R1, R2, I1 or I2, check Layout.py)
 
-        Returns: it will send two commands first to remove the metadata about pair_end_read and then will add the
-        metadata stating is it Read1 or Read2
+        Returns: list of (attribute, value, unit)
 
         """
-        uploadfile = Misc.joinginglistbyspecificstring(filepath.split("/")[-2:], string="/")
-        meta_remove = f'imeta rmw -d {ifolder}/{uploadfile} "pair_end_read" % %'
-        if read1:
-            meta_add = f'imeta add -d {ifolder}/{uploadfile} "pair_end_read" "Read1" String'
-        else:
-            meta_add = f'imeta add -d {ifolder}/{uploadfile} "pair_end_read" "Read2" String'
-        commands = [meta_remove, meta_add]
-        return commands
-
+        return [('pair_end_read', Layout.ROLES[role], 'String')]
 
 class UploadCram(UploadFastq):
     """
     This class will help to upload cram (and crai) files in the irods/yoda system
     """
+    REQUIRED = ('sample name',)
 
     @classmethod
-    def single_meta_commands(cls, single_meta, ifolder, folder=None, upload=False, meta=False):
+    def resolving_folders(cls, row, folder=None):
         """
-        commands necessary for a single row in the metadata to upload all the files and adding all the necessary
-        metadata. for cram it means you need 4 files inside every folder. folder should be same prefix as cram files,
-        which is generally the sample name. it will check if every folder has 4 files. Read1.fastq.gz, Read2.fastq.gz,
-        Read1.fastq.gz.md5, Read2.fastq.gz.md5. Then it will give commands to start uploading the data irods and
-        remove all the metadata first but then after removing the metadata it will update the new metadata
+        It will find the folder of a row of sheet_rows in the folder index. The folder is the sample name
         Args:
-            single_meta: single row of Metadata sheet from <metadata>.xlsx
-            ifolder: The abs path of irods folder. Please do not upload relative path
+            row: list of (attribute, value, unit) of a single row
             folder: The path of the folder where cram is present in locally. default is current working directory
-            upload: By default it will return commands for upload and add the metadata. But you can run it separately.
-            If upload=True is used it will only return upload commands. Good in case very big multiple files
-            meta: By default it will return commands for upload and add the metadata. But you can run it separately.
-            If meta=True is used it will return commands to remove the previously uploaded files metadata and
-            add new metadata. Only use after you have uploaded the files
 
-        Returns: it will check necessary files present or not and then will return all the commands necessary to upload
-        the files for a single row
+        Returns: list with one (row, target_folder). The empty values are removed from the row
 
         """
-        single_meta = single_meta.reset_index(level=0)
-        single_meta.columns = ['units', 'value']
-        single_meta, target_folder = cls.checking_folder(single_meta=single_meta, ifolder=ifolder, folder=folder)
-        files = cls.check_files(target_folder)
-        if 'fasta' not in single_meta.index:
-            print("Could not find the fasta column in the excel. Please add the fasta file is used")
-        if upload:
-            if meta:
-                print("both meta and upload cant be True. Use either one of them at a time. If you want run all do "
-                      "nothing. By default it will run the whole thing")
-                sys.exit(1)
-            commands, uploadfolder = cls.uploading_commands(files=files, ifolder=ifolder)
-        else:
-            upload_commands, uploadfolder = cls.uploading_commands(files=files, ifolder=ifolder)
-            cram_remove = cls.removing_metadata_commands(single_meta=single_meta, filepath=files[0], ifolder=ifolder)
-            cram_add = cls.adding_metadata_commands(single_meta=single_meta, filepath=files[0], ifolder=ifolder)
-            cram_special = cls.special_metadata(single_meta=single_meta, filepath=files[0], ifolder=ifolder)
-            if meta:
-                commands = cram_remove + cram_add + cram_special
-            else:
-                commands = upload_commands + cram_remove + cram_add + cram_special
-        commands = Misc.joinginglistbyspecificstring(commands, string="\n")
-        return uploadfolder, commands
+        values = {attribute: value for attribute, value, unit in row}
+        prefix = str(values.get('sample name'))
+        folder = os.path.abspath(folder or os.getcwd())
+        target_folder = Scan.FolderIndex.scanning(folder).exact_folder(prefix)
+        if len(target_folder) == 0:
+            print(
+                "no folder found for corresponding folder. Please check and update the excel sheet. if the folder does "
+                "not exist please delete the row")
+            print(f'expected folder: {folder}/{prefix}/')
+            print({attribute: value for attribute, value in values.items() if value is not None})
+            sys.exit(1)
+        return [([avu for avu in row if avu[1] is not None], target_folder[0])]
 
     @classmethod
-    def checking_folder(cls, single_meta, ifolder, folder=None):
+    def validating_row(cls, row, folder=None, upload=False):
         """
-        It will check ifolder is not relative as iRods system has problem with relative path.Absolute path is
-        recommended. It will check if the necessary folder exist in the local machine (the name of the folder will be
-        derived from the metadata itself, i.e. sample name).
+        Same checks as resolving_folders, check_files and special_avus, but every problem of the row is given back
+        instead of exiting at the first one. Check Validate.py
         Args:
-            single_meta: single row of Metadata sheet from <metadata>.xlsx
-            ifolder: The abs path of irods folder. Please do not upload relative path
-            folder: The path of the folder where fastq is present in locally. default is current working directory
+            row: list of (attribute, value, unit) of a single row
+            folder: The path of the folder where cram is present in locally. default is current working directory
+            upload: If upload=True only the upload is checked, not the metadata
 
-        Returns: It will return updated single_meta Series by adding lae info and remove all the NAs. It will also
-        return the target folder which needs to be uploaded from local folder.
+        Returns: list of (level, check, message). level is error or warning. empty list if the row is fine
 
         """
-        if not os.path.isabs(ifolder):
-            print("Your ifolder is not absolute. Please use an absolute path to run it")
-            sys.exit(1)
-        prefix = single_meta.loc['sample name', 'value']
+        values = {attribute: value for attribute, value, unit in row if value is not None}
+        problems = []
+        if not upload:
+            if 'flowcell lane' not in values:
+                problems.append(('error', 'column', 'no value for flowcell lane. It is mandatory for cram files'))
+            if 'fasta' not in values:
+                problems.append(('warning', 'column', 'no value for fasta. Please add the fasta file is used'))
+            barcode = str(values.get('sample barcode', ''))
+            if 'library id' not in values or len(barcode.split("-")) < 2:
+                problems.append(('error', 'column', 'sample barcode (<number>-DL<number>) and library id are needed '
+                                                    'for pair_end_reads'))
+        if 'sample name' not in values:
+            return problems + [('error', 'column', 'no value for sample name')]
+        samplename = str(values['sample name'])
         folder = os.path.abspath(folder or os.getcwd())
-        target_folder = glob.glob(f'{folder}/{prefix}/')
+        index = Scan.FolderIndex.scanning(folder)
+        target_folder = index.exact_folder(samplename)
         if len(target_folder) == 0:
-            print(
-                "no folder found for corresponding folder. Please check and update the excel sheet. if the folder does "
-                "not exist please delete the row")
-            print(f'expected folder: {folder}/{prefix}/')
-            print(single_meta)
-            sys.exit(1)
-        else:
-            target_folder = target_folder[0]
-            return single_meta.dropna(), target_folder
+            return problems + [('error', 'folder', f'no folder found. expected folder: {folder}/{samplename}/')]
+        return problems + cls.validating_folder(target_folder=target_folder[0], index=index)
+
+    @classmethod
+    def validating_folder(cls, target_folder, index, roles=()):
+        """
+        the checks of the files of a single cram folder, same as check_files
+        Args:
+            target_folder: The local folder which has to be uploaded
+            index: Scan.FolderIndex of the folder
+            roles: not used for cram files
+
+        Returns: list of (level, check, message). empty list if the folder is fine
+
+        """
+        samplename = os.path.basename(target_folder.rstrip('/'))
+        problems = []
+        for extension in ('.cram', '.cram.md5', '.cram.crai', '.cram.crai.md5'):
+            if not index.exists(f'{target_folder}{samplename}{extension}'):
+                problems.append(('error', 'md5' if extension.endswith('.md5') else 'files',
+                                 f'could not find {target_folder}{samplename}{extension}'))
+        return problems
+
+    @classmethod
+    def expected_roles(cls, row):
+        """
+        Args:
+            row: list of (attribute, value, unit) of a single row
+
+        Returns: empty tuple. A cram folder has no read roles
+
+        """
+        return ()
+
+    @classmethod
+    def planning_row(cls, table, row, target_folder, ifolder, upload=False, meta=False):
+        """
+        adds the operations of a single cram folder to the table. The folder is created and the 4 files are uploaded,
+        then the metadata of the cram file is removed first and added again
+        Args:
+            table: Plan.OperationTable
+            row: list of (attribute, value, unit) of the row without empty values
+            target_folder: The local folder which has to be uploaded
+            ifolder: irods uploading path full
+            upload: If upload=True only the upload operations are added
+            meta: If meta=True only the metadata operations are added
+        """
+        files = cls.check_files(target_folder)
+        values = {attribute: value for attribute, value, unit in row}
+        if 'fasta' not in values:
+            print("Could not find the fasta column in the excel. Please add the fasta file is used")
+        uploadfolder = files[0].split("/")[-2]
+        collection = f'{ifolder}/{uploadfolder}'
+        if not meta:
+            table.append(sample=uploadfolder, op='mkdir', path=collection)
+            for filepath in files:
+                table.append(sample=uploadfolder, op='put', path=collection, value=filepath)
+        if not upload:
+            avus = row + [('version', f'v{__version__}', 'String')]
+            ipath = f'{collection}/{os.path.basename(files[0])}'
+            table.removing_metadata(sample=uploadfolder, path=ipath, attributes=[avu[0] for avu in avus])
+            table.adding_metadata(sample=uploadfolder, path=ipath, avus=avus)
+            table.removing_metadata(sample=uploadfolder, path=ipath, attributes=['pair_end_reads'])
+            table.adding_metadata(sample=uploadfolder, path=ipath, avus=cls.special_avus(values=values))
 
     @classmethod
     def check_files(cls, target_folder):
@@ -375,16 +479,17 @@ class UploadCram(UploadFastq):
 
         """
         samplename = os.path.basename(target_folder[:-1])
-        if not os.path.exists(f'{target_folder}{samplename}.cram'):
+        index = Scan.FolderIndex.of(target_folder)
+        if not index.exists(f'{target_folder}{samplename}.cram'):
             print("could not find the cram file. please check:", f'{target_folder}{samplename}.cram')
             sys.exit(1)
-        if not os.path.exists(f'{target_folder}{samplename}.cram.md5'):
+        if not index.exists(f'{target_folder}{samplename}.cram.md5'):
             print("could not find the cram.md5 file. please check:", f'{target_folder}{samplename}.cram.md5')
             sys.exit(1)
-        if not os.path.exists(f'{target_folder}{samplename}.cram.crai'):
+        if not index.exists(f'{target_folder}{samplename}.cram.crai'):
             print("could not find the crai file. please check:", f'{target_folder}{samplename}.cram.crai')
             sys.exit(1)
-        if not os.path.exists(f'{target_folder}{samplename}.cram.crai.md5'):
+        if not index.exists(f'{target_folder}{samplename}.cram.crai.md5'):
             print("could not find the crai.md5 file. please check:", f'{target_folder}{samplename}.cram.crai.md5')
             sys.exit(1)
         files = [f'{target_folder}{samplename}.cram', f'{target_folder}{samplename}.cram.crai',
@@ -392,53 +497,26 @@ class UploadCram(UploadFastq):
         return files
 
     @classmethod
-    def uploading_commands(cls, files, ifolder):
-        """
-        uploading files to irods commands. It uses irsync -K <local> i:<irods>. full path for irods is important
-        Args:
-            files: list of files path (cram, cram.crai, cram.md5, cram.crai.md5)
-            ifolder: irods uploading path full
-
-        Returns: it will create commands for creating folder and uploading all the 4 files.
-
-        """
-        uploadfolder = files[0].split("/")[-2]
-        mkdir_command = f'imkdir -p {ifolder}/{uploadfolder}'
-        upload_cram_command = f'irsync -K {files[0]} i:{ifolder}/{uploadfolder}'
-        upload_crai_command = f'irsync -K {files[1]} i:{ifolder}/{uploadfolder}'
-        upload_crammd5_command = f'irsync -K {files[2]} i:{ifolder}/{uploadfolder}'
-        upload_craimd5_command = f'irsync -K {files[3]} i:{ifolder}/{uploadfolder}'
-        commands = [mkdir_command, upload_cram_command, upload_crai_command, upload_crammd5_command,
-                    upload_craimd5_command]
-        return commands, uploadfolder
-
-    @classmethod
-    def special_metadata(cls, single_meta, filepath, ifolder):
+    def special_avus(cls, values):
         """
-        Special def for every Class. For cram you need to add is the read1 or read2 that was used to create cram file
-        under pair_end_reads metadata
+        the special metadata of a cram file. The Read1 and Read2 fastq files that were used to create the cram file.
+        flowcell lane is important in this case. please add it in the excel sheet. add L001 format. If the cram file
+        was created from more than one lane add all of them separated by comma (L001,L002). The fastq files of every
+        lane are added
         Args:
-            single_meta: single_meta: single row of Metadata sheet from <metadata>.xlsx. with added Lane info and
-            removed blank lines
-            filepath: cram file path
-            ifolder: irods uploading path full
+            values: dict of attribute and value of a single row. with added Lane info and removed blank lines
 
-        Returns: it will first remove pair_end_reads from the meta data and then will generate necessary fastq file
-        names from excel sheet and add the pair_end_reads metadata. flowcell lane is important in this case. please
-        add it in the excel sheet. add L001 format
+        Returns: list of (attribute, value, unit)
 
         """
-        uploadfile = Misc.joinginglistbyspecificstring(filepath.split("/")[-2:], string="/")
-        meta_remove = f'imeta rmw -d {ifolder}/{uploadfile}  "pair_end_reads" % %'
-        if 'flowcell lane' not in single_meta.index:
+        if 'flowcell lane' not in values:
             print("flowcell lane column is mandatory for cram files. Please add")
             sys.exit(1)
-        barcode = single_meta.loc['sample barcode', 'value'].replace("-DL", "-DS")
-        library = single_meta.loc['library id', 'value']
-        lane = single_meta.loc['flowcell lane', 'value']
-        sample_number = single_meta.loc['sample barcode', 'value'].split("-")[1][2:]
-        R1 = f'{barcode}_{library}_S{sample_number}_{lane}_R1_001.fastq.gz'
-        R2 = f'{barcode}_{library}_S{sample_number}_R2_001.fastq.gz'
-        meta_add = f'imeta add -d {ifolder}/{uploadfile} "pair_end_reads" "{R1} {R2}" String'
-        commands = [meta_remove, meta_add]
-        return commands
+        barcode = values['sample barcode'].replace("-DL", "-DS")
+        library = values['library id']
+        lanes = str(values['flowcell lane']).replace(';', ',').replace(' ', ',').split(',')
+        lanes = [f'L{int(lane):03d}' if lane.isdigit() else lane for lane in lanes if lane]
+        sample_number = values['sample barcode'].split("-")[1][2:]
+        reads = [f'{barcode}_{library}_S{sample_number}_{lane}_{read}_001.fastq.gz'
+                 for lane in lanes for read in ('R1', 'R2')]
+        return [('pair_end_reads', Misc.joinginglistbyspecificstring(reads), 'String')]
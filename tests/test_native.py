@@ -0,0 +1,163 @@
+"""
+The native backend (python-irodsclient) run against a fake session, without an irods server
+"""
+import Executor
+import Plan
+import Sync
+
+
+class FakeAVU:
+    def __init__(self, name, value, units=''):
+        self.name = name
+        self.value = value
+        self.units = units
+
+
+class FakeMetadata:
+    def __init__(self):
+        self.avus = []
+
+    def items(self):
+        return list(self.avus)
+
+    def add(self, name, value, units=''):
+        self.avus.append(FakeAVU(name, value, units))
+
+    def remove(self, avu):
+        self.avus.remove(avu)
+
+
+class FakeObject:
+    def __init__(self, path, size=0):
+        self.path = path
+        self.size = size
+        self.checksum = ''
+        self.metadata = FakeMetadata()
+
+
+class FakeStore:
+    """
+    the collections and data objects of a fake zone. Every session of a test shares the same store
+    """
+
+    def __init__(self):
+        self.collections = {}
+        self.objects = {}
+        self.sessions = 0
+
+
+class FakeCollections:
+    def __init__(self, store):
+        self.store = store
+
+    def create(self, path, recurse=False):
+        self.store.collections.setdefault(path, FakeObject(path))
+
+    def get(self, path):
+        return self.store.collections[path]
+
+
+class FakeDataObjects:
+    def __init__(self, store):
+        self.store = store
+
+    def exists(self, path):
+        return path in self.store.objects
+
+    def get(self, path):
+        return self.store.objects[path]
+
+    def put(self, local, path, **options):
+        if path.rsplit('/', 1)[0] not in self.store.collections:
+            raise FileNotFoundError(path)
+        with open(local, 'rb') as f:
+            self.store.objects[path] = FakeObject(path, size=len(f.read()))
+
+
+class FakeSession:
+    def __init__(self, store):
+        store.sessions += 1
+        self.collections = FakeCollections(store)
+        self.data_objects = FakeDataObjects(store)
+
+    def cleanup(self):
+        pass
+
+
+def avus(obj):
+    return sorted((avu.name, avu.value, avu.units) for avu in obj.metadata.items())
+
+
+def test_native_plan_with_fake_session(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    local = tmp_path / 'S1_R1_001.fastq.gz'
+    local.write_bytes(b'@read\nACGT\n+\nFFFF\n')
+    collection = '/zone/home/x/S1'
+    ipath = f'{collection}/S1_R1_001.fastq.gz'
+    store = FakeStore()
+    # metadata of an earlier run. [ and ] are no wildcards of imeta, so 'size [bp]' has to be removed as well
+    store.collections[collection] = FakeObject(collection)
+    store.collections[collection].metadata.add('size [bp]', '100', 'bp')
+    plan = {'S1': [Plan.Mkdir(sample='S1', collection=collection),
+                   Plan.Put(sample='S1', collection=collection, local=str(local)),
+                   Plan.MetaRemove(sample='S1', path=ipath, attribute='tax id'),
+                   Plan.MetaSet(sample='S1', path=ipath, attribute='tax id', value='9606', unit='Integer'),
+                   Plan.MetaBatch(sample='S1', path=collection, operations=[
+                       Plan.MetaRemove(sample='S1', path=collection, attribute='size [bp]', collection=True),
+                       Plan.MetaSet(sample='S1', path=collection, attribute='size [bp]', value='150', unit='bp',
+                                    collection=True),
+                       Plan.MetaRemove(sample='S1', path=collection, attribute='project name', collection=True),
+                       Plan.MetaSet(sample='S1', path=collection, attribute='project name', value='P',
+                                    collection=True)])]}
+    done = {}
+    exit_codes = Executor.NativeExecutor.main(commands=plan, prefix='all', jobs=2,
+                                              session_factory=lambda: FakeSession(store),
+                                              on_done=lambda name, exit_code: done.update({name: exit_code}))
+    assert exit_codes == {'S1': 0}
+    assert done == {'S1': 0}
+    assert store.objects[ipath].size == local.stat().st_size
+    assert avus(store.objects[ipath]) == [('tax id', '9606', 'Integer')]
+    assert avus(store.collections[collection]) == [('project name', 'P', ''), ('size [bp]', '150', 'bp')]
+    # the plan again gives the same metadata, the rmw removes what the first run added
+    assert Executor.NativeExecutor.main(commands=plan, prefix='all', session_factory=lambda: FakeSession(store)) == \
+        {'S1': 0}
+    assert avus(store.objects[ipath]) == [('tax id', '9606', 'Integer')]
+    assert avus(store.collections[collection]) == [('project name', 'P', ''), ('size [bp]', '150', 'bp')]
+
+
+def test_native_failing_command_stops_the_sample(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = FakeStore()
+    plan = {'S2': [Plan.MetaSet(sample='S2', path='/zone/home/x/S2/missing.cram', attribute='a', value='1'),
+                   Plan.Mkdir(sample='S2', collection='/zone/home/x/S2')]}
+    assert Executor.NativeExecutor.main(commands=plan, prefix='meta', session_factory=lambda: FakeSession(store)) == \
+        {'S2': 1}
+    assert '/zone/home/x/S2' not in store.collections
+
+
+def test_session_pool_reuses_sessions():
+    store = FakeStore()
+    pool = Executor.SessionPool(session_factory=lambda: FakeSession(store), size=2)
+    for _ in range(5):
+        with pool.session() as session:
+            assert isinstance(session, FakeSession)
+    pool.close()
+    assert store.sessions == 1
+
+
+def test_native_sync_of_a_changed_avu(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ipath = '/zone/home/x/S3/S3.cram'
+    store = FakeStore()
+    store.objects[ipath] = FakeObject(ipath)
+    store.objects[ipath].metadata.add('tax id', '10090', 'Integer')
+    store.objects[ipath].metadata.add('project name', 'P', 'String')
+    store.objects[ipath].metadata.add('owner', 'someone', '')
+    desired = {'S3': {ipath: [('tax id', '9606', 'Integer'), ('project name', 'P', 'String'),
+                              ('sample name', 'S3', 'String')]}}
+    exit_codes, counts = Sync.MetadataSync.main(avus=desired, backend='native',
+                                                session_factory=lambda: FakeSession(store))
+    assert exit_codes == {'S3': 0}
+    assert counts['S3'] == {'added': 2, 'removed': 1, 'modified': 1, 'unchanged': 1}
+    assert avus(store.objects[ipath]) == [('owner', 'someone', ''), ('project name', 'P', 'String'),
+                                          ('sample name', 'S3', 'String'), ('tax id', '9606', 'Integer')]
@@ -0,0 +1,87 @@
+"""
+The diff of --sync and the counting of a sample, with a fake pool of sessions and a fake imeta
+"""
+import subprocess
+from contextlib import contextmanager
+
+import pytest
+
+import Sync
+from test_native import FakeObject, FakeSession, FakeStore
+
+
+class FakePool:
+    def __init__(self, store):
+        self.store = store
+
+    @contextmanager
+    def session(self):
+        yield FakeSession(self.store)
+
+
+def test_diff_unchanged():
+    avus = [('tax id', '9606', 'Integer'), ('project name', 'P', '')]
+    assert Sync.MetadataSync.diff(current=avus, desired=avus) == ([], [])
+
+
+def test_diff_changed_value():
+    removes, adds = Sync.MetadataSync.diff(current=[('tax id', '10090', 'Integer')],
+                                           desired=[('tax id', 9606, 'Integer')])
+    assert removes == [('tax id', '10090', 'Integer')]
+    assert adds == [('tax id', '9606', 'Integer')]
+
+
+def test_diff_changed_unit():
+    removes, adds = Sync.MetadataSync.diff(current=[('size', '150', 'bp')], desired=[('size', '150', None)])
+    assert removes == [('size', '150', 'bp')]
+    assert adds == [('size', '150', '')]
+
+
+def test_diff_keeps_other_remote_attributes():
+    removes, adds = Sync.MetadataSync.diff(current=[('owner', 'someone', ''), ('tax id', '9606', 'Integer')],
+                                           desired=[('tax id', '9606', 'Integer')])
+    assert (removes, adds) == ([], [])
+
+
+def test_sync_sample_counts(tmp_path):
+    store = FakeStore()
+    first, second = '/zone/x/S1/S1_R1_001.fastq.gz', '/zone/x/S1/S1_R2_001.fastq.gz'
+    for ipath in (first, second):
+        store.objects[ipath] = FakeObject(ipath)
+        store.objects[ipath].metadata.add('tax id', '9606', 'Integer')
+    store.objects[second].metadata.add('pair_end_read', 'Read1', 'String')
+    desired = {first: [('tax id', '9606', 'Integer'), ('pair_end_read', 'Read1', 'String')],
+               second: [('tax id', '9606', 'Integer'), ('pair_end_read', 'Read2', 'String')]}
+    counts = {}
+    logfile = tmp_path / 'sync_S1.log'
+    assert Sync.MetadataSync.sync_sample(avus=desired, counts=counts, logfile=str(logfile),
+                                         pool=FakePool(store)) == 0
+    assert counts == {'added': 2, 'removed': 1, 'modified': 1, 'unchanged': 2}
+    assert sorted((avu.name, avu.value) for avu in store.objects[second].metadata.items()) == \
+        [('pair_end_read', 'Read2'), ('tax id', '9606')]
+
+
+def test_sync_sample_stops_at_a_failing_object(tmp_path):
+    store = FakeStore()
+    counts = {}
+    desired = {'/zone/x/S2/missing.cram': [('tax id', '9606', 'Integer')]}
+    logfile = tmp_path / 'sync_S2.log'
+    assert Sync.MetadataSync.sync_sample(avus=desired, counts=counts, logfile=str(logfile),
+                                         pool=FakePool(store)) == 1
+    assert counts['added'] == 0
+    assert 'failed' in logfile.read_text()
+
+
+def test_shell_apply_raises_on_errors_of_the_pipe_mode(monkeypatch):
+    def imeta(argv, **options):
+        return subprocess.CompletedProcess(argv, 0, stdout='ERROR: rmAVUMetadata failed with error -817000\n',
+                                           stderr='')
+
+    monkeypatch.setattr(subprocess, 'run', imeta)
+    with pytest.raises(RuntimeError, match='rmAVUMetadata'):
+        Sync.MetadataSync.shell_apply(ipath='/zone/x/a.cram', removes=[('tax id', '1', '')], adds=[])
+
+
+def test_shell_apply_rejects_a_double_quote():
+    with pytest.raises(ValueError):
+        Sync.MetadataSync.shell_apply(ipath='/zone/x/a.cram', removes=[], adds=[('comment', 'a "b"', '')])